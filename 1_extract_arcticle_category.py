@@ -2,9 +2,26 @@
 import requests
 from bs4 import BeautifulSoup
 import pandas as pd
-import time
 import csv
 import os
+import sys
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from http_cache import http_get
+
+# Wikipedia API endpoint
+API_URL = "https://en.wikipedia.org/w/api.php"
+
+# seconds a cached category listing is reused without asking Wikipedia, after that
+# it is revalidated, so a rerun on the same day costs no requests
+CACHE_FRESH_FOR = 24 * 3600
+
+API_HEADERS = {
+    'User-Agent': 'WikipediaRevisionHistoryFetcher/1.0 (Research project; contact@example.com)'
+}
 
 def extract_articles_from_category(category_url):
     """
@@ -24,7 +41,7 @@ def extract_articles_from_category(category_url):
     }
     
     try:
-        response = requests.get(category_url, headers=headers)
+        response = http_get(None, category_url, headers=headers, fresh_for=CACHE_FRESH_FOR)
         
         if response.status_code != 200:
             print(f"Failed to retrieve the page: {response.status_code}")
@@ -82,8 +99,7 @@ def extract_articles_from_category(category_url):
         # Recursively get articles from next pages if they exist
         if next_page:
             print(f"Following next page: {next_page}")
-            # Add a small delay to avoid overloading the server
-            time.sleep(1)
+            # paced by the rate governor instead of a fixed delay
             next_page_articles = extract_articles_from_category(next_page)
             article_links.extend(next_page_articles)
         
@@ -93,9 +109,149 @@ def extract_articles_from_category(category_url):
         print(f"Error processing {category_url}: {e}")
         return []
 
-def process_categories_from_csv():
+def category_title_from_url(category_url):
+    """
+    Get the page title of a category from its URL, e.g. "Category:People's Republic of China".
+    """
+    path = urllib.parse.urlparse(category_url).path
+    return urllib.parse.unquote(path.split('/wiki/', 1)[1]).replace('_', ' ')
+
+def article_url_from_title(title):
+    # same encoding as the hrefs on category pages, e.g. People%27s_Republic
+    return "https://en.wikipedia.org/wiki/" + urllib.parse.quote(title.replace(' ', '_'), safe=";@$!*(),/~:")
+
+def get_category_members(category_title, session=None):
+    """
+    List the articles and subcategories of a category through the API,
+    following cmcontinue until every member has been returned.
+    :param category_title: Category page title
+    :param session: requests.Session to reuse connections
+    :return: Tuple of (list of (pageid, title) articles, list of subcategory titles)
+    """
+    params = {
+        "action": "query",
+        "format": "json",
+        "list": "categorymembers",
+        "cmtitle": category_title,
+        "cmtype": "page|subcat",
+        # articles and categories only, like the old ':' filter on links
+        "cmnamespace": "0|14",
+        "cmlimit": "max"
+    }
+    
+    articles = []
+    subcategories = []
+    while True:
+        response = http_get(session, API_URL, params=params, headers=API_HEADERS, fresh_for=CACHE_FRESH_FOR)
+        data = response.json()
+        for member in data['query']['categorymembers']:
+            if member['ns'] == 14:
+                subcategories.append(member['title'])
+            else:
+                articles.append((member['pageid'], member['title']))
+        
+        if 'continue' not in data:
+            break
+        params = {**params, **data['continue']}
+    
+    return articles, subcategories
+
+class CategoryCrawler:
+    """
+    Crawls categories through the API with several categories in flight at once.
+    Articles are deduplicated by page id while crawling and subcategories are
+    only visited once, so category cycles end the descent.
+    """
+    
+    def __init__(self, output_file, workers=4, depth=0, on_articles=None):
+        """
+        :param output_file: CSV the articles are appended to as each category finishes
+        :param workers: Number of categories crawled concurrently
+        :param depth: How many levels of subcategories to descend into, 0 for none
+        :param on_articles: Called with the new rows of every category once they are saved,
+                            may block to slow the crawl down
+        """
+        self.output_file = output_file
+        self.workers = workers
+        self.depth = depth
+        self.on_articles = on_articles
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.lock = threading.Lock()
+        self.seen_pages = set()
+        self.seen_categories = set()
+        self.total = 0
+        # the total grows as subcategories are found, so there is no ETA
+        self.progress = metrics.progress("categories")
+    
+    def crawl_category(self, category_url):
+        """
+        Crawl one category and save the articles not seen before.
+        :return: List of subcategory URLs
+        """
+        category_name = category_title_from_url(category_url)
+        try:
+            articles, subcategories = get_category_members(category_name, self.session)
+        except Exception as e:
+            print(f"Error processing {category_url}: {e}")
+            return []
+        
+        with self.lock:
+            rows = []
+            for pageid, title in articles:
+                if pageid not in self.seen_pages:
+                    self.seen_pages.add(pageid)
+                    rows.append((title, article_url_from_title(title), category_url, category_name))
+            
+            # Write batch to CSV to avoid losing data if script crashes
+            with open(self.output_file, 'a', newline='', encoding='utf-8') as f:
+                writer = csv.writer(f)
+                for row in rows:
+                    writer.writerow(row)
+            self.total += len(rows)
+        
+        print(f"Saved {len(rows)} new articles from {category_url} ({len(articles) - len(rows)} duplicates)")
+        metrics.count("articles_found", len(rows))
+        self.progress.update()
+        # outside the lock so a blocked consumer doesn't stop other categories from saving
+        if self.on_articles is not None and rows:
+            self.on_articles(rows)
+        return [article_url_from_title(title) for title in subcategories]
+    
+    def crawl(self, category_urls):
+        """
+        Crawl the categories level by level down to the configured depth.
+        :return: Number of distinct articles saved
+        """
+        level = list(dict.fromkeys(category_urls))
+        self.seen_categories.update(category_title_from_url(url) for url in level)
+        
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for current_depth in range(self.depth + 1):
+                next_level = []
+                for subcategories in executor.map(self.crawl_category, level):
+                    if current_depth == self.depth:
+                        continue
+                    for url in subcategories:
+                        title = category_title_from_url(url)
+                        if title not in self.seen_categories:
+                            self.seen_categories.add(title)
+                            next_level.append(url)
+                
+                if not next_level:
+                    break
+                print(f"Descending into {len(next_level)} subcategories")
+                level = next_level
+        
+        return self.total
+
+def process_categories_from_csv(workers=4, depth=0):
     """
     Process all category URLs from a CSV file and save results to a new CSV.
+    :param workers: Number of categories crawled concurrently
+    :param depth: Levels of subcategories to descend into
     """
     input_file = "./articles/categories.csv"
     output_file = "./articles/category_articles.csv"
@@ -120,27 +276,19 @@ def process_categories_from_csv():
             writer = csv.writer(f)
             writer.writerow(['article_title', 'article_url', 'category_url', 'category_name'])
         
-        # Process each category URL
-        all_articles = []
-        for url in category_urls:
-            # Add a delay between requests to avoid being blocked
-            time.sleep(2)
-            articles = extract_articles_from_category(url)
-            all_articles.extend(articles)
-            
-            # Write batch to CSV to avoid losing data if script crashes
-            with open(output_file, 'a', newline='', encoding='utf-8') as f:
-                writer = csv.writer(f)
-                for article in articles:
-                    writer.writerow(article)
-            
-            print(f"Saved {len(articles)} articles from {url}")
+        # Crawl through the API, articles are deduplicated by page id as they are found
+        crawler = CategoryCrawler(output_file, workers, depth)
+        total = crawler.crawl(category_urls)
         
-        print(f"Total articles saved: {len(all_articles)}")
+        print(f"Total articles saved: {total}")
         print(f"Results saved to {output_file}")
         
     except Exception as e:
         print(f"Error processing categories: {e}")
 
 if __name__ == "__main__":
-    process_categories_from_csv()
\ No newline at end of file
+    # optional arguments: number of concurrent categories and subcategory depth
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    depth = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    with metrics.stage("1"):
+        process_categories_from_csv(workers, depth)
@@ -2,9 +2,27 @@ import requests
 import urllib.parse
 import pandas as pd
 import os
-from datetime import datetime
+from datetime import datetime, timezone
 import sys
-import time
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from history_store import HistoryWriter, compact_histories, count_revisions, history_path, newest_revision
+from http_cache import http_get
+
+# Wikipedia API endpoint
+API_URL = "https://en.wikipedia.org/w/api.php"
+
+# append-only record of finished articles, a restarted run resumes from it
+MANIFEST_FILE = "article_processing_manifest.jsonl"
+manifest_lock = threading.Lock()
+
+# Add user agent to avoid being blocked
+HEADERS = {
+    'User-Agent': 'WikipediaRevisionHistoryFetcher/1.0 (Research project; contact@example.com)'
+}
 
 def extract_title_from_url(url):
     """
@@ -23,117 +41,363 @@ def extract_title_from_url(url):
     title = parsed_url.path.split('/wiki/')[1]
     return urllib.parse.unquote(title)
 
-def get_wikipedia_article_history(url, limit=250):
+def revision_to_row(rev, url):
+    """
+    Convert one revision from the API into a row of the history CSV.
+    """
+    return {
+        'url': url,
+        'rev_id': rev.get('revid', 'N/A'),
+        'timestamp': rev.get('timestamp', 'N/A'),
+        'user': rev.get('user', 'N/A'),
+        'comment': rev.get('comment', 'No comment'),
+        'size': rev.get('size', 0),
+        'tags': ', '.join(rev.get('tags', [])) if rev.get('tags') else 'N/A',
+        # 'content': rev.get('*', 'Content not available')  # Use '*' to get content
+    }
+
+def history_filename(url):
+    """
+    Get the path an article's history is saved to, the partition file of
+    the history store when pyarrow is installed, otherwise a CSV.
+    """
+    article_title = extract_title_from_url(url)
+    
+    # Generate a safe filename
+    safe_title = ''.join(c if c.isalnum() or c in ['-', '_'] else '_' for c in article_title)
+    return history_path(url, safe_title)
+
+def get_wikipedia_article_history(url, limit=250, session=None):
     """
     Retrieve the revision history of a Wikipedia article from a URL.
+    Errors are raised to the caller so they end up in the manifest.
     :param url: Full Wikipedia page URL
     :param limit: Maximum number of revisions to retrieve (default 50)
-    :return: List of revision details
+    :param session: requests.Session to reuse connections, a plain request is made if None
+    :return: List of revision details, empty if the article has no revisions
     """
     # Extract article title from the URL
-    try:
-        article_title = extract_title_from_url(url)
-        
-        # Wikipedia API endpoint
-        base_url = "https://en.wikipedia.org/w/api.php"
-        
-        # Parameters for the API request
-        params = {
-            "action": "query",
-            "format": "json",
-            "prop": "revisions",
-            "titles": article_title,
-            # "rvprop": "ids|timestamp|user|comment|size|tags|content",
-            "rvprop": "ids|timestamp|user|comment|size|tags",
-            "rvlimit": limit
-        }
-        
-        # Add user agent to avoid being blocked
-        headers = {
-            'User-Agent': 'WikipediaRevisionHistoryFetcher/1.0 (Research project; contact@example.com)'
-        }
-        
-        # Send the API request
-        response = requests.get(base_url, params=params, headers=headers)
-        data = response.json()
-        
-        # Extract the page information
-        page = next(iter(data['query']['pages'].values()))
-        
-        # Check if revisions exist
-        if 'revisions' not in page:
-            print(f"No revision history found for {article_title}")
-            return []
-        
-        # Process and return revision details
-        revisions = page['revisions']
-        return [
-            {
-                'url': url,
-                'rev_id': rev.get('revid', 'N/A'),
-                'timestamp': rev.get('timestamp', 'N/A'),
-                'user': rev.get('user', 'N/A'),
-                'comment': rev.get('comment', 'No comment'),
-                'size': rev.get('size', 0),
-                'tags': ', '.join(rev.get('tags', [])) if rev.get('tags') else 'N/A',
-                # 'content': rev.get('*', 'Content not available')  # Use '*' to get content
-            }
-            for rev in revisions
-        ]
-    
-    except requests.RequestException as e:
-        print(f"Error fetching Wikipedia article history for {url}: {e}")
-        return []
-    except (KeyError, StopIteration) as e:
-        print(f"Error parsing Wikipedia API response for {url}: {e}")
-        return []
-    except ValueError as e:
-        print(f"Error with URL {url}: {e}")
-        return []
-    except Exception as e:
-        print(f"Unexpected error processing {url}: {e}")
+    article_title = extract_title_from_url(url)
+    
+    # Parameters for the API request
+    params = {
+        "action": "query",
+        "format": "json",
+        "prop": "revisions",
+        "titles": article_title,
+        # "rvprop": "ids|timestamp|user|comment|size|tags|content",
+        "rvprop": "ids|timestamp|user|comment|size|tags",
+        "rvlimit": limit
+    }
+    
+    # Send the API request
+    response = http_get(session, API_URL, params=params, headers=HEADERS)
+    data = response.json()
+    
+    # Extract the page information
+    page = next(iter(data['query']['pages'].values()))
+    
+    # Check if revisions exist
+    if 'revisions' not in page:
+        print(f"No revision history found for {article_title}")
         return []
+    
+    # Process and return revision details
+    revisions = page['revisions']
+    return [revision_to_row(rev, url) for rev in revisions]
 
 def save_history_to_csv(history, url):
     """
-    Save the article revision history to a CSV file using pandas.
+    Save the article revision history to its CSV or the history store.
+    Errors are raised to the caller so they end up in the manifest.
     :param history: List of revision details
     :param url: Original Wikipedia URL
-    :return: Filename or None on failure
+    :return: Filename or None if there is no history
     """
     if not history:
         print(f"No history to save for {url}.")
         return None
     
-    # Create a 'wikipedia_histories' directory if it doesn't exist
-    os.makedirs('wikipedia_histories', exist_ok=True)
-    
     # Extract article title from the URL for filename
+    filename = history_filename(url)
+    
+    # Save the revisions in one go
+    writer = HistoryWriter(filename, url)
     try:
-        article_title = extract_title_from_url(url)
-        
-        # Generate a safe filename
-        safe_title = ''.join(c if c.isalnum() or c in ['-', '_'] else '_' for c in article_title)
-        filename = f"wikipedia_histories/{safe_title}.csv"
+        writer.write(history)
+    except Exception:
+        writer.abort()
+        raise
+    writer.commit()
+    
+    print(f"Revision history saved to {filename}")
+    return filename
+
+def download_full_history(url, session=None):
+    """
+    Page through the complete revision history of an article and append each
+    page to its history file as it arrives, so memory use does not grow with the history.
+    The file is written under a temporary name and only replaces the old one
+    once every page has been fetched. Errors are raised to the caller so they
+    end up in the manifest.
+    :param url: Full Wikipedia page URL
+    :param session: requests.Session to reuse connections
+    :return: Tuple of (filename or None if the article has no revisions, number of revisions)
+    """
+    article_title = extract_title_from_url(url)
+    filename = history_filename(url)
+    
+    params = {
+        "action": "query",
+        "format": "json",
+        "prop": "revisions",
+        "titles": article_title,
+        "rvprop": "ids|timestamp|user|comment|size|tags",
+        "rvlimit": "max"
+    }
+    
+    writer = HistoryWriter(filename, url)
+    try:
+        while True:
+            response = http_get(session, API_URL, params=params, headers=HEADERS)
+            data = response.json()
+            page = next(iter(data['query']['pages'].values()))
+            writer.write([revision_to_row(rev, url) for rev in page.get('revisions', [])])
+            
+            # follow rvcontinue until the API stops returning a continuation
+            if 'continue' not in data:
+                break
+            params = {**params, **data['continue']}
+    except Exception:
+        writer.abort()
+        raise
+    
+    if not writer.commit():
+        print(f"No revision history found for {article_title}")
+        return None, 0
+    
+    print(f"Revision history saved to {filename} ({writer.count} revisions)")
+    return filename, writer.count
+
+def sync_history(url, session=None):
+    """
+    Fetch only the revisions newer than the ones already saved for an article
+    and add them to the front of its history (the file stays newest first).
+    Articles without a saved history get their full history. Errors are
+    raised to the caller so they end up in the manifest.
+    :param url: Full Wikipedia page URL
+    :param session: requests.Session to reuse connections
+    :return: Tuple of (filename or None if the article has no revisions, total revisions stored)
+    """
+    filename = history_filename(url)
+    newest = newest_revision(filename, url)
+    if newest is None:
+        return download_full_history(url, session)
+    
+    last_rev_id, last_timestamp = newest
+    params = {
+        "action": "query",
+        "format": "json",
+        "prop": "revisions",
+        "titles": extract_title_from_url(url),
+        "rvprop": "ids|timestamp|user|comment|size|tags",
+        "rvlimit": "max",
+        # oldest first starting at the newest stored timestamp (inclusive)
+        "rvdir": "newer",
+        "rvstart": last_timestamp
+    }
+    
+    new_rows = []
+    while True:
+        response = http_get(session, API_URL, params=params, headers=HEADERS)
+        data = response.json()
+        page = next(iter(data['query']['pages'].values()))
+        for rev in page.get('revisions', []):
+            if rev.get('revid', 0) > last_rev_id:
+                new_rows.append(revision_to_row(rev, url))
+        if 'continue' not in data:
+            break
+        params = {**params, **data['continue']}
+    
+    revision_count = count_revisions(filename, url)
+    if not new_rows:
+        print(f"No new revisions for {url}")
+        return filename, revision_count
+    
+    # new revisions go on top, the existing rows are copied without parsing
+    writer = HistoryWriter(filename, url)
+    try:
+        writer.write(new_rows[::-1])
+        writer.copy_from(filename)
+    except Exception:
+        writer.abort()
+        raise
+    writer.commit()
+    
+    print(f"Added {len(new_rows)} new revisions to {filename}")
+    return filename, revision_count + len(new_rows)
+
+def archive_manifest(path=MANIFEST_FILE):
+    # kept for reference, the next run starts fresh
+    if os.path.exists(path):
+        os.replace(path, f"{path}.{datetime.now().strftime('%Y%m%d%H%M%S%f')}")
+
+def load_manifest(run, path=MANIFEST_FILE):
+    """
+    Read the latest manifest entry of every article of an interrupted run.
+    The first line of the manifest records the input and arguments of its
+    run. A manifest left by a run with other ones is archived, not resumed.
+    A line cut short by a crash is ignored.
+    :param run: Input and arguments of this run, see open_manifest
+    :return: Dict of url to its last recorded result
+    """
+    entries = {}
+    if not os.path.exists(path):
+        return entries
+    header = None
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if header is None:
+                header = entry
+            elif 'url' in entry:
+                entries[entry['url']] = entry
+    if header is None or header.get('run') != run:
+        print(f"Archiving the manifest of an interrupted run with other arguments: {header and header.get('run')}")
+        archive_manifest(path)
+        return {}
+    return entries
+
+def open_manifest(run, path=MANIFEST_FILE):
+    """
+    Open the manifest for appending, starting it with the run header if it is new.
+    :param run: JSON serializable dict of the input and arguments of the run
+    :return: Open file
+    """
+    manifest = open(path, 'a', encoding='utf-8')
+    if manifest.tell() == 0:
+        manifest.write(json.dumps({'run': run}) + "\n")
+        manifest.flush()
+    return manifest
+
+def record_result(manifest, result):
+    # one line per finished article, flushed to disk before moving on
+    with manifest_lock:
+        manifest.write(json.dumps(result) + "\n")
+        manifest.flush()
+        os.fsync(manifest.fileno())
+
+def create_session(workers):
+    """
+    Create a session whose connection pool keeps one keep-alive connection per worker.
+    :param workers: Number of requests in flight
+    :return: requests.Session
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def process_article(url, limit, session=None, incremental=False, manifest=None, progress=None):
+    """
+    Download and save the history of one article.
+    :param manifest: Open manifest file the result is recorded to
+    :param progress: metrics.Progress updated once the article is done
+    :return: Result row for article_processing_results.csv
+    """
+    try:
+        if incremental:
+            # only revisions newer than the saved history
+            filename, revisions = sync_history(url, session)
+        elif limit is None:
+            # full history, streamed to the CSV page by page
+            filename, revisions = download_full_history(url, session)
+        else:
+            # Get article history
+            history = get_wikipedia_article_history(url, limit, session)
+            
+            # Save history to CSV
+            filename = save_history_to_csv(history, url)
+            revisions = len(history)
         
-        # Convert to DataFrame
-        df = pd.DataFrame(history)
+        newest = newest_revision(filename, url) if filename else None
         
-        # Save to CSV
-        df.to_csv(filename, index=False, encoding='utf-8')
+        # Record result
+        result = {
+            'url': url,
+            'status': 'Success' if filename else 'Failed',
+            'revisions': revisions,
+            'filename': filename,
+            'last_rev_id': newest[0] if newest else None,
+            'error': None if filename else 'NoHistory'
+        }
         
-        print(f"Revision history saved to {filename}")
-        return filename
-    
     except Exception as e:
-        print(f"Error saving CSV file for {url}: {e}")
-        return None
+        print(f"Error processing {url}: {e}")
+        result = {
+            'url': url,
+            'status': 'Error',
+            'revisions': 0,
+            'filename': None,
+            'last_rev_id': None,
+            'error': type(e).__name__
+        }
+    
+    if manifest is not None:
+        record_result(manifest, {**result, 'finished_at': datetime.now(timezone.utc).isoformat()})
+    metrics.count(f"articles_{result['status'].lower()}")
+    metrics.count("revisions_saved", result['revisions'])
+    if progress is not None:
+        progress.update()
+    return result
+
+def merge_staged_histories():
+    # histories staged by this or an interrupted run are merged into the store for the next stages
+    merged = compact_histories()
+    if merged:
+        print(f"Merged {merged} histories into the history store")
 
-def process_articles_from_csv(csv_file="articles.csv", limit=500):
+def save_results(article_urls, finished, done):
+    """
+    Write article_processing_results.csv and archive the manifest of the completed run.
+    :param article_urls: Every article of the run, in input order
+    :param finished: Results of the articles processed in this run
+    :param done: Manifest entries of articles finished before a restart
+    """
+    # results in input order, including articles finished before a restart
+    finished = {result['url']: result for result in finished}
+    results = []
+    for url in article_urls:
+        result = finished.get(url) or {k: v for k, v in done[url].items() if k != 'finished_at'}
+        results.append(result)
+    
+    # Save processing results to CSV
+    results_df = pd.DataFrame(results)
+    results_df.to_csv("article_processing_results.csv", index=False)
+    
+    # the run is complete, failures included, so the next run must not resume from it
+    archive_manifest()
+    print(f"\nProcessing complete. Results saved to article_processing_results.csv")
+
+def process_articles_from_csv(csv_file="articles.csv", limit=500, workers=1, incremental=False):
     """
     Process all Wikipedia article URLs from a CSV file and save their revision histories.
     :param csv_file: Path to CSV file containing article URLs
-    :param limit: Maximum number of revisions to fetch per article
+    :param limit: Maximum number of revisions to fetch per article, None for the full history
+    :param workers: Number of articles downloaded concurrently, 1 for one at a time
+    :param incremental: Only fetch revisions newer than the saved histories, new
+                        articles are downloaded in full and limit is ignored
+
+    Every finished article is appended to the manifest straight away. If a
+    run with the same input file and arguments was interrupted, the run
+    resumes: articles recorded as successful are skipped and only failed or
+    missing ones are processed. The manifest is archived at the end of every
+    completed run, whether or not every article succeeded, so the next run
+    starts fresh.
     """
     try:
         # Check if input file exists
@@ -152,44 +416,30 @@ def process_articles_from_csv(csv_file="articles.csv", limit=500):
         article_urls = df['article_url'].tolist()
         print(f"Found {len(article_urls)} articles to process.")
         
-        # Create results DataFrame to track progress
-        results = []
+        # resume from the manifest of an interrupted run with the same input and arguments
+        run = {'input': os.path.abspath(csv_file), 'limit': limit, 'incremental': incremental}
+        done = {url: entry for url, entry in load_manifest(run).items() if entry['status'] == 'Success'}
+        pending = [url for url in article_urls if url not in done]
+        if done:
+            print(f"Resuming: {len(article_urls) - len(pending)} articles already done, {len(pending)} left.")
         
-        # Process each article URL
-        for i, url in enumerate(article_urls):
-            print(f"\n[{i+1}/{len(article_urls)}] Processing: {url}")
-            
-            try:
-                # Get article history
-                history = get_wikipedia_article_history(url, limit)
-                
-                # Save history to CSV
-                filename = save_history_to_csv(history, url)
-                
-                # Record result
-                results.append({
-                    'url': url,
-                    'status': 'Success' if filename else 'Failed',
-                    'revisions': len(history),
-                    'filename': filename
-                })
-                
-                # Add a delay to be nice to Wikipedia servers
-                time.sleep(1)
-                
-            except Exception as e:
-                print(f"Error processing {url}: {e}")
-                results.append({
-                    'url': url,
-                    'status': 'Error',
-                    'revisions': 0,
-                    'filename': None
-                })
+        merge_staged_histories()
+        progress = metrics.progress("articles", len(pending))
+        with open_manifest(run) as manifest:
+            # requests are paced by the rate governor, which adapts to how fast Wikipedia lets us go
+            if workers > 1:
+                session = create_session(workers)
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    finished = list(executor.map(lambda url: process_article(url, limit, session, incremental, manifest, progress), pending))
+            else:
+                finished = []
+                # Process each article URL
+                for i, url in enumerate(pending):
+                    print(f"\n[{i+1}/{len(pending)}] Processing: {url}")
+                    finished.append(process_article(url, limit, incremental=incremental, manifest=manifest, progress=progress))
         
-        # Save processing results to CSV
-        results_df = pd.DataFrame(results)
-        results_df.to_csv("article_processing_results.csv", index=False)
-        print(f"\nProcessing complete. Results saved to article_processing_results.csv")
+        merge_staged_histories()
+        save_results(article_urls, finished, done)
         
     except Exception as e:
         print(f"Error processing articles from CSV: {e}")
@@ -199,8 +449,14 @@ if __name__ == "__main__":
     # If arguments are provided, use them as the CSV file name and limit
     if len(sys.argv) > 1:
         csv_file = sys.argv[1]
-        limit = int(sys.argv[2]) if len(sys.argv) > 2 else 250
-        process_articles_from_csv(csv_file, limit)
+        limit = sys.argv[2] if len(sys.argv) > 2 else "250"
+        # "all" downloads the full history of every article, "new" only what was added since the last run
+        incremental = limit == "new"
+        limit = None if limit in ("all", "new") else int(limit)
+        workers = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+        with metrics.stage("3"):
+            process_articles_from_csv(csv_file, limit, workers, incremental)
     else:
         # Use default values
-        process_articles_from_csv("./articles/articles.csv", 250)
\ No newline at end of file
+        with metrics.stage("3"):
+            process_articles_from_csv("./articles/articles.csv", 250)
\ No newline at end of file
@@ -1,205 +1,330 @@
-# script takes in two integer arguments for starting and ending files in the wikipedia_histories folder
+# script takes in two integer arguments for starting and ending files in the article history store,
+# or "all" to summarize every history, optionally followed by the number of worker processes
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
 import pandas as pd
 import os
-import re
 import numpy as np
-import whois
-import subprocess
+import ipaddress
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-# https://superuser.com/questions/202818/what-regular-expression-can-i-use-to-match-an-ip-address
-ipv4_match = re.compile("[0-9]{1,3}\\.[0-9]{1,3}\\.[0-9]{1,3}\\.[0-9]{1,3}")
-ipv6_match = re.compile("(([0-9a-fA-F]{1,4}:){7,7}[0-9a-fA-F]{1,4}|([0-9a-fA-F]{1,4}:){1,7}:|([0-9a-fA-F]{1,4}:){1,6}:[0-9a-fA-F]{1,4}|([0-9a-fA-F]{1,4}:){1,5}(:[0-9a-fA-F]{1,4}){1,2}|([0-9a-fA-F]{1,4}:){1,4}(:[0-9a-fA-F]{1,4}){1,3}|([0-9a-fA-F]{1,4}:){1,3}(:[0-9a-fA-F]{1,4}){1,4}|([0-9a-fA-F]{1,4}:){1,2}(:[0-9a-fA-F]{1,4}){1,5}|[0-9a-fA-F]{1,4}:((:[0-9a-fA-F]{1,4}){1,6})|:((:[0-9a-fA-F]{1,4}){1,7}|:)|fe80:(:[0-9a-fA-F]{0,4}){0,4}%[0-9a-zA-Z]{1,}|::(ffff(:0{1,4}){0,1}:){0,1}((25[0-5]|(2[0-4]|1{0,1}[0-9]){0,1}[0-9])\\.){3,3}(25[0-5]|(2[0-4]|1{0,1}[0-9]){0,1}[0-9])|([0-9a-fA-F]{1,4}:){1,4}:((25[0-5]|(2[0-4]|1{0,1}[0-9]){0,1}[0-9])\\.){3,3}(25[0-5]|(2[0-4]|1{0,1}[0-9]){0,1}[0-9]))")
+import metrics
+from history_store import history_name, list_history_files, read_history, write_table
 
-# run whois
-def run_whois(ip):
+# anonymous editors are shown by their IP address instead of a user name
+def is_ip(name):
     try:
-        # Run the whois command
-        result = subprocess.run(["whois", ip], capture_output=True, text=True, timeout=10)
-        output = result.stdout
-        
-        # Parse output into a dictionary
-        whois_data = {}
-        for line in output.splitlines():
-            if ":" in line:
-                key, value = line.split(":", 1)
-                key = str.lower(key.strip())
-                
-                if not (key in whois_data):
-                    whois_data[key] = value.strip()
-
-        country = None
-        if "country" in whois_data:
-            country = whois_data["country"]
-
-        org = None
-        if "org" in whois_data:
-            org = whois_data["org"]
-        elif "orgid" in whois_data:
-            org = whois_data["orgid"]
-        elif "netname" in whois_data:
-            org = whois_data["netname"]
-        elif "ownerid" in whois_data:
-            org = whois_data["ownerid"]
-    
-        inet = None
-        if "inetnum" in whois_data:
-            inet = whois_data["inetnum"]
-        elif "cidr" in whois_data:
-            inet = whois_data["cidr"]
-        elif "netrange" in whois_data:
-            inet = whois_data["netrange"]
-        elif "inet6num" in whois_data:
-            inet = whois_data["inet6num"]
-
-        return pd.Series([country, org, inet])
-
-    except subprocess.CalledProcessError as e:
-        print(f"Error running whois: {e}")
-        return pd.Series([None, None, None])
-    except subprocess.TimeoutExpired as e:
-        print(f"Error running whois: {e} {ip}")
-        return pd.Series([None, None, None])
-
-# generated by Claude
-def list_files(directory_path):
-    """
-    Get a list of all file names in a specified directory.
-    
-    :param directory_path: Path to the directory
-    :return: List of file names
+        ipaddress.ip_address(name)
+        return True
+    except ValueError:
+        return False
+
+# what ipaddress accepts as IPv4: four decimal octets up to 255, no leading zeros
+ipv4_octet = "(25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])"
+ipv4_full = f"{ipv4_octet}(\\.{ipv4_octet}){{3}}"
+# names that might be IPv6 addresses, checked with ipaddress
+ipv6_candidate = "[0-9A-Fa-f:.]*:.*"
+
+def classify_anon(users):
     """
-    try:
-        # Use os.listdir() to get all entries in the directory
-        files = [f for f in os.listdir(directory_path) if os.path.isfile(os.path.join(directory_path, f))]
-        return files
-    except FileNotFoundError:
-        print(f"Directory not found: {directory_path}")
-        return []
-    except PermissionError:
-        print(f"Permission denied to access directory: {directory_path}")
-        return []
+    Tell which users are anonymous, checking every distinct name only once.
+    Only complete IPv4 and IPv6 addresses count, so names such as 1.2.3.4abc
+    are not anonymous. IPv4 is matched over all names at once, only names
+    that could be IPv6 are parsed one by one.
+    :param users: Series of user names
+    :return: Boolean array, missing where the user is missing
+    """
+    codes, uniques = pd.factorize(users)
+    names = pd.Series(uniques, dtype=users.dtype)
+    flags = names.str.fullmatch(ipv4_full).to_numpy(dtype=bool, na_value=False)
+    for i in np.flatnonzero(names.str.fullmatch(ipv6_candidate).to_numpy(dtype=bool, na_value=False)):
+        flags[i] = is_ip(uniques[i])
 
-def process_and_save(file_path, df_per_page):
-    # rev_id,timestamp,user,comment,size,tags
-    print(f"Processing {file_path}")
-    try:
-        df = pd.read_csv(file_path, dtype={
-            "url": pd.StringDtype(),
-            "rev_id": pd.Int64Dtype(),
-            "timestamp": pd.StringDtype(),
-            "user": pd.StringDtype(),
-            "comment": pd.StringDtype(),
-            "size": pd.Int64Dtype(),
-            "tags": pd.StringDtype()
-        })
-
-        # diff stats
-        df["timestamp"] = pd.to_datetime(df["timestamp"])
-        df["size_diff"] = df["size"] - df["size"].shift(-1)
-        df["time_diff"] = df["timestamp"] - df["timestamp"].shift(-1)
-        
-        if df.shape[0] <= 1:
-            print(f"Not enough revisions in {file_path}")
-            return df_per_page
-            
-        df = df.iloc[:-1]
-
-        # match ip addresses
-        df["is_anon"] = df["user"].str.match(ipv4_match) | df["user"].str.match(ipv6_match)
-
-        # article summary stats
-        df_by_anon = df[["is_anon", "size_diff"]].copy()
-        df_by_anon["size_diff"] = np.abs(df_by_anon["size_diff"])
-        df_by_anon["amount"] = 1
-        df_by_anon = df_by_anon.groupby(["is_anon"]).sum()
-
-        # Initialize with default values
-        anon_num = 0
-        named_num = 0
-        anon_contrib = 0
-        named_contrib = 0
-        anon_diff_avg = 0
-        named_diff_avg = 0
-
-        # Check if True exists in index before accessing
-        if True in df_by_anon.index:
-            anon_num = df_by_anon.loc[True, "amount"]
-            anon_contrib = df_by_anon.loc[True, "size_diff"]
-            anon_diff_avg = anon_contrib / anon_num if anon_num > 0 else 0
-
-        # Check if False exists in index before accessing
-        if False in df_by_anon.index:
-            named_num = df_by_anon.loc[False, "amount"]
-            named_contrib = df_by_anon.loc[False, "size_diff"]
-            named_diff_avg = named_contrib / named_num if named_num > 0 else 0
-
-        per_page_summary = {
-            "url": df.iloc[0]["url"] if not df.empty else "",
-            "num_contrib": df.shape[0],
-            "time_diff_avg": df["time_diff"].mean() if not df.empty else pd.Timedelta(0),
-            "anon_num": anon_num,
-            "named_num": named_num,
-            "anon_contrib": anon_contrib,
-            "named_contrib": named_contrib,
-            "anon_diff_avg": anon_diff_avg,
-            "named_diff_avg": named_diff_avg,
-        }
-
-        anon_df = df[df["is_anon"] == True].copy()
-        if anon_df.shape[0] > 0:
-            # deduplicate to reduce number of whois calls
-            unique_ips = anon_df[["user"]].drop_duplicates()
-            # Run whois on unique IPs
-            unique_ips[["country", "org", "inet"]] = unique_ips["user"].apply(lambda ip: run_whois(ip))
-            
-            # Merge the whois data back to the original dataframe
-            anon_df = anon_df.merge(unique_ips, on="user", how="left")
-            
-            # Create a directory for whois results if it doesn't exist
-            os.makedirs("whois_results", exist_ok=True)
-            
-            # Save the whois results to a file with a name based on the input file
-            output_file = os.path.join("whois_results", os.path.basename(file_path))
-            anon_df.to_csv(output_file, index=False)
-            print(f"Saved whois results to {output_file}")
+    # the extra False at the end is picked by the -1 code of missing users
+    flags = np.append(flags, False)
+    return pd.arrays.BooleanArray(flags[codes], codes < 0)
+
+# anonymous edits are saved per history for 4b_whois_enrich.py, which looks them up in whois
+ANON_EDITS_DIR = "anon_edits"
+
+# anonymous edits of a history are saved under its CSV file name, or the title of its url in the store
+def anon_edits_base(file_path, url=None):
+    return os.path.join(ANON_EDITS_DIR, history_name(file_path, url))
+
+# history files summarized together, and the most bytes of them on disk,
+# bounds the memory of the combined revisions
+BATCH_SIZE = 1000
+BATCH_BYTES = 256 * 1024 ** 2
+
+def load_histories(file_paths, urls=None):
+    """
+    Read many history files into one frame with a "page" column numbering
+    the articles. A CSV holds one article, a partition file of the store
+    many, each article's rows together. Unreadable files are skipped.
+    :param urls: Dict filled with the urls of the articles of every file read, by path
+    :return: Tuple of (DataFrame of all revisions, each article newest first,
+             list of (file path, url) of every page)
+    """
+    frames = []
+    codes = []
+    sources = []
+    for file_path in file_paths:
+        print(f"Processing {file_path}")
+        try:
+            # typed columns with parsed timestamps, from the Parquet store or a CSV
+            frame = read_history(file_path)
+        except Exception as e:
+            print(f"Error processing {file_path}: {e}")
+            continue
+        if file_path.endswith(".parquet"):
+            frame_codes, article_urls = pd.factorize(frame["url"], use_na_sentinel=False)
+            article_urls = [None if pd.isna(url) else url for url in article_urls]
         else:
-            print(f"No anonymous edits in {per_page_summary['url']}")
+            frame_codes = np.zeros(frame.shape[0], dtype=np.int64)
+            article_urls = [] if frame.empty else [None if pd.isna(frame["url"].iloc[0]) else frame["url"].iloc[0]]
+        frames.append(frame)
+        codes.append(frame_codes + len(sources))
+        sources.extend((file_path, url) for url in article_urls)
+        if urls is not None:
+            urls[file_path] = [url for url in article_urls if url is not None]
+
+    if not frames:
+        return pd.DataFrame({"page": pd.Series([], dtype=np.int64)}), sources
+    df = pd.concat(frames, ignore_index=True)
+    df["page"] = np.concatenate(codes).astype(np.int64)
+    return df, sources
+
+def annotate_revisions(df):
+    """
+    Add size_diff, time_diff and is_anon to the revisions of all pages at once.
+    The oldest revision of every page has nothing to diff against and is
+    dropped, so pages with a single revision disappear.
+    """
+    # a diff is only kept when the next (older) row belongs to the same page
+    same_page = df["page"].shift(-1) == df["page"]
+
+    # diff stats
+    df["size_diff"] = df["size"] - df["size"].shift(-1)
+    df["time_diff"] = df["timestamp"] - df["timestamp"].shift(-1)
+    df = df[same_page].copy()
+
+    # users whose name is an ip address
+    df["is_anon"] = classify_anon(df["user"])
+    return df
+
+def summarize_revisions(df):
+    """
+    Per-page summary of annotated revisions in one grouped pass.
+    :return: DataFrame with the columns of empty_summary, one row per page in page order
+    """
+    # unknown users count towards num_contrib but neither anon nor named, like the groupby on is_anon
+    anon = (df["is_anon"] == True).fillna(False).to_numpy(dtype=bool)
+    named = (df["is_anon"] == False).fillna(False).to_numpy(dtype=bool)
+    size_diff = np.abs(df["size_diff"])
+
+    grouped = pd.DataFrame({
+        "page": df["page"].to_numpy(),
+        "anon_num": anon.astype(np.int64),
+        "named_num": named.astype(np.int64),
+        "anon_contrib": size_diff.where(anon).to_numpy(),
+        "named_contrib": size_diff.where(named).to_numpy(),
+    }).astype({"anon_contrib": pd.Int64Dtype(), "named_contrib": pd.Int64Dtype()}).groupby("page").sum()
+
+    pages = df.groupby("page")
+    anon_num = grouped["anon_num"]
+    named_num = grouped["named_num"]
+    summary = pd.DataFrame({
+        # first row of the page, not the first non-missing url
+        "url": df.drop_duplicates("page").set_index("page")["url"],
+        "num_contrib": pages.size(),
+        "time_diff_avg": pages["time_diff"].mean(),
+        "anon_num": anon_num,
+        "named_num": named_num,
+        "anon_contrib": grouped["anon_contrib"],
+        "named_contrib": grouped["named_contrib"],
+        "anon_diff_avg": (grouped["anon_contrib"] / anon_num.where(anon_num > 0)).fillna(0),
+        "named_diff_avg": (grouped["named_contrib"] / named_num.where(named_num > 0)).fillna(0),
+    })
+    return pd.concat([empty_summary(), summary.reset_index(drop=True)], ignore_index=True)
+
+def save_anon_edits(df, sources, urls=None):
+    """
+    Save the anonymous edits of annotated revisions, one table per page.
+    :param sources: (file path, url) of each page number
+    :param urls: Dict of path to urls, files with an article whose edits could not be saved are removed from it
+    """
+    # Create a directory for anonymous edits if it doesn't exist
+    os.makedirs(ANON_EDITS_DIR, exist_ok=True)
+
+    anon_df = df[df["is_anon"] == True]
+    anon_pages = anon_df.groupby("page")
+    for page, page_df in df.groupby("page"):
+        if page not in anon_pages.groups:
+            print(f"No anonymous edits in {page_df['url'].iloc[0]}")
+            continue
+        try:
+            page_anon = anon_pages.get_group(page).drop(columns="page").reset_index(drop=True)
+            output_file = write_table(page_anon, anon_edits_base(*sources[page]))
+            print(f"Saved anonymous edits to {output_file}")
+        except Exception as e:
+            print(f"Error processing {sources[page][1] or sources[page][0]}: {e}")
+            if urls is not None:
+                urls.pop(sources[page][0], None)
+
+def make_batches(file_paths):
+    # consecutive files, at most BATCH_SIZE of them or BATCH_BYTES on disk, but at least one
+    batch = []
+    size = 0
+    for path in file_paths:
+        if batch and (len(batch) >= BATCH_SIZE or size >= BATCH_BYTES):
+            yield batch
+            batch = []
+            size = 0
+        batch.append(path)
+        size += os.path.getsize(path) if os.path.exists(path) else 0
+    if batch:
+        yield batch
+
+def summarize_histories(file_paths, progress=None, urls=None):
+    """
+    Summarize histories and save their anonymous edits, a batch of files at a time.
+    :param progress: metrics.Progress updated after every batch
+    :param urls: Dict filled with the urls of the articles of every file summarized,
+                 by path, the files that failed are left out
+    :return: Summary DataFrame, one row per article with more than one revision
+    """
+    summaries = [empty_summary()]
+    for batch in make_batches(file_paths):
+        df, sources = load_histories(batch, urls)
+        if progress is not None:
+            progress.update(len(batch))
+        if df.shape[0] == 0:
+            continue
+        metrics.count("revisions_read", df.shape[0])
+
+        counts = df["page"].value_counts()
+        for page in counts.index[counts <= 1]:
+            print(f"Not enough revisions in {sources[page][1] or sources[page][0]}")
+
+        df = annotate_revisions(df)
+        summaries.append(summarize_revisions(df))
+        save_anon_edits(df, sources, urls)
 
-        # return pd.concat([df_per_page if not df.empty else None, pd.DataFrame([per_page_summary])])
+    return pd.concat(summaries, ignore_index=True)
 
-        return pd.concat([df_per_page, pd.DataFrame([per_page_summary])], ignore_index=True)
-        
+def process_and_save(file_path, df_per_page):
+    # summarize a single history and add it to df_per_page
+    try:
+        summary = summarize_histories([file_path])
+        return pd.concat([df_per_page, summary], ignore_index=True)
     except Exception as e:
         print(f"Error processing {file_path}: {e}")
         return df_per_page
 
-def main():
-    # Directory containing Wikipedia history CSV files
-    wiki_dir = "wikipedia_histories"
-    
-    # Check if directory exists
-    if not os.path.exists(wiki_dir):
-        print(f"Directory '{wiki_dir}' does not exist. Creating it...")
-        os.makedirs(wiki_dir)
-        print(f"Please place your CSV files in the '{wiki_dir}' directory and run the script again.")
-        return
-    
-    # Get all CSV files from the directory
-    csv_files = [f for f in list_files(wiki_dir) if f.lower().endswith('.csv')]
-    csv_files.sort()
-    
-    if not csv_files:
-        print(f"No CSV files found in '{wiki_dir}' directory.")
-        return
-    
-    print(f"Found {len(csv_files)} CSV files to process.")
-    
-    # Initialize the dataframe for per-page summaries
-    df_per_page = pd.DataFrame({
+# chunks per worker process, more chunks balance uneven article sizes better
+CHUNKS_PER_WORKER = 8
+
+def make_chunks(file_paths, workers):
+    """
+    Split histories into consecutive chunks of about the same size on disk,
+    so a few huge articles don't end up in a single worker's share.
+    :return: List of lists of paths, in file order
+    """
+    sizes = [os.path.getsize(path) for path in file_paths]
+    target = max(1, sum(sizes) // (workers * CHUNKS_PER_WORKER))
+
+    chunks = []
+    current = []
+    current_size = 0
+    for path, size in zip(file_paths, sizes):
+        current.append(path)
+        current_size += size
+        if current_size >= target or len(current) >= BATCH_SIZE:
+            chunks.append(current)
+            current = []
+            current_size = 0
+    if current:
+        chunks.append(current)
+    return chunks
+
+def summarize_chunk(file_paths):
+    # runs in a worker process
+    started = time.perf_counter()
+    urls = {}
+    summary = summarize_histories(file_paths, urls=urls)
+    return summary, urls, os.getpid(), time.perf_counter() - started
+
+def summarize_parallel(file_paths, workers, urls=None):
+    """
+    Summarize histories across worker processes. Chunks are queued largest
+    first and each worker takes the next one as soon as it is done, so a
+    worker stuck on a big article doesn't hold up the rest. Chunks whose
+    worker failed are retried one by one in this process. Results are
+    merged in file order, the same as summarize_histories.
+    :param workers: Number of processes
+    :param urls: Dict filled with the urls of the articles of every file summarized,
+                 by path, the files that failed are left out
+    :return: Summary DataFrame
+    """
+    chunks = make_chunks(file_paths, workers)
+    chunk_sizes = [sum(os.path.getsize(path) for path in chunk) for chunk in chunks]
+    order = sorted(range(len(chunks)), key=lambda i: chunk_sizes[i], reverse=True)
+    print(f"Summarizing {len(file_paths)} histories in {len(chunks)} chunks on {workers} processes")
+
+    # counted here, the worker processes have metrics of their own that are never reported
+    progress = metrics.progress("histories", len(file_paths))
+    results = [empty_summary()] * len(chunks)
+    urls = {} if urls is None else urls
+    failed_chunks = []
+    # histories, revisions and busy seconds per worker process
+    worker_stats = {}
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(summarize_chunk, chunks[i]): i for i in order}
+        for done, future in enumerate(as_completed(futures)):
+            i = futures[future]
+            try:
+                summary, chunk_urls, pid, seconds = future.result()
+            except Exception as e:
+                print(f"Error processing chunk starting at {chunks[i][0]}: {e}")
+                failed_chunks.append(i)
+                continue
+            results[i] = summary
+            urls.update(chunk_urls)
+            progress.update(len(chunks[i]))
+            stats = worker_stats.setdefault(pid, [0, 0, 0.0])
+            stats[0] += len(chunks[i])
+            stats[1] += int(summary["num_contrib"].sum())
+            stats[2] += seconds
+            print(f"Finished {done + 1}/{len(chunks)} chunks")
+
+    # e.g. a worker killed for running out of memory takes its chunk and the ones queued behind it down
+    if failed_chunks:
+        print(f"Retrying {len(failed_chunks)} failed chunks in this process")
+    for i in sorted(failed_chunks):
+        chunk_urls = {}
+        try:
+            results[i] = summarize_histories(chunks[i], urls=chunk_urls)
+        except Exception as e:
+            print(f"Error processing chunk starting at {chunks[i][0]} again: {e}")
+            continue
+        urls.update(chunk_urls)
+        progress.update(len(chunks[i]))
+
+    elapsed = time.perf_counter() - started
+    for pid, (histories, revisions, seconds) in sorted(worker_stats.items()):
+        print(f"Worker {pid}: {histories} histories, {revisions} revisions in {seconds:.1f}s "
+              f"({histories / max(seconds, 1e-9):.1f} histories/s, {revisions / max(seconds, 1e-9):.0f} revisions/s)")
+    print(f"Summarized {len(file_paths)} histories in {elapsed:.1f}s ({len(file_paths) / max(elapsed, 1e-9):.1f} histories/s)")
+
+    return pd.concat(results, ignore_index=True)
+
+def empty_summary():
+    # per-page summary frame with the column types of the saved summaries
+    return pd.DataFrame({
         "url": pd.Series([], dtype=pd.StringDtype()),
         "num_contrib": pd.Series([], dtype=pd.Int64Dtype()),
         "time_diff_avg": pd.Series([], dtype="timedelta64[s]"),
@@ -210,20 +335,47 @@ def main():
         "anon_diff_avg": pd.Series([], dtype=pd.Float64Dtype()),
         "named_diff_avg": pd.Series([], dtype=pd.Float64Dtype()),
     })
+
+def main():
+    # Get all article histories, sorted so start/end ranges stay stable
+    history_files = list_history_files()
+    
+    if not history_files:
+        print("No article histories found, run 3_download_article_history.py first.")
+        return
+    
+    print(f"Found {len(history_files)} history files to process.")
     
-    start = int(sys.argv[1])
-    end = int(sys.argv[2])
-
-    # Process each file and accumulate results
-    for i in range(start, end):
-        csv_file = csv_files[i]
-        file_path = os.path.join(wiki_dir, csv_file)
-        df_per_page = process_and_save(file_path, df_per_page)
+    if sys.argv[1] == "all":
+        # one summary of every history, so it doesn't depend on ranges that shift when files are added
+        start, end = 0, len(history_files)
+        summary_base = "./summaries/wikipedia_summary_all"
+        workers = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+    else:
+        start = int(sys.argv[1])
+        end = int(sys.argv[2])
+        summary_base = f"./summaries/wikipedia_summary_{start}_{end}"
+        workers = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+
+    urls = {}
+    if workers > 1:
+        df_per_page = summarize_parallel(history_files[start:end], workers, urls)
+    else:
+        # all files of the range are summarized together, in batches
+        df_per_page = summarize_histories(history_files[start:end], metrics.progress("histories", len(history_files[start:end])), urls)
+    metrics.count("summary_rows", df_per_page.shape[0])
     
     # Save the final summary dataframe
-    summary_file = f"./summaries/wikipedia_summary_{start}_{end}.csv"
-    df_per_page.to_csv(summary_file, index=False)
+    summary_file = write_table(df_per_page, summary_base)
     print(f"Summary saved to {summary_file}")
 
+    # the summary is kept, but a runner must not take the stage as done
+    failed = [path for path in history_files[start:end] if path not in urls]
+    if failed:
+        metrics.count("histories_failed", len(failed))
+        print(f"{len(failed)} history files could not be summarized, e.g. {failed[0]}")
+        sys.exit(1)
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    with metrics.stage("4"):
+        main()
\ No newline at end of file
@@ -0,0 +1,225 @@
+# looks up the anonymous edits saved by 4_summany_whois.py in whois and writes whois_results
+# IPs are deduplicated over all articles, so every IP is looked up once per run at most
+# optional argument "all" redoes every article, by default only articles whose
+# anonymous edits were saved after their whois results
+# articles with an IP whose lookup failed get no whois results, so the next run retries them
+import warnings
+warnings.simplefilter(action='ignore', category=FutureWarning)
+
+import pandas as pd
+import os
+import subprocess
+import sys
+
+import metrics
+from history_store import write_table
+from whois_cache import WhoisCache
+from whois_client import WhoisClient, parse_whois
+from whois_pool import WhoisPool, ip_block, query_with_retries
+
+ANON_EDITS_DIR = "anon_edits"
+WHOIS_RESULTS_DIR = "whois_results"
+
+# IPs looked up between progress messages
+LOOKUP_BATCH = 1000
+
+# whois results are cached across runs
+WHOIS_CACHE_PATH = "whois_cache.sqlite"
+WHOIS_CACHE_TTL = 90 * 24 * 3600
+WHOIS_CACHE_MAX_ENTRIES = 2_000_000
+
+# concurrent whois queries, set WHOIS_WORKERS to 1 for the old one-at-a-time path
+WHOIS_WORKERS = 16
+WHOIS_PER_REGISTRY = 4
+WHOIS_RATE = 2.0
+
+# both paths retry errors and throttled or empty answers, waiting WHOIS_BACKOFF seconds, then twice that
+WHOIS_TIMEOUT = 10
+WHOIS_RETRIES = 2
+WHOIS_BACKOFF = 2.0
+
+# whois is spoken directly over port 43, set USE_WHOIS_BINARY to fork the whois command instead
+USE_WHOIS_BINARY = False
+whois_client = WhoisClient()
+
+# run a whois query and return its raw output
+def query_whois(ip, timeout=10):
+    metrics.count("whois_calls")
+    with metrics.timer("whois_query"):
+        if not USE_WHOIS_BINARY:
+            return whois_client.query(ip, timeout)
+        result = subprocess.run(["whois", ip], capture_output=True, text=True, timeout=timeout)
+        return result.stdout
+
+# parse and cache a whois answer, None is a failed lookup that is added to the failed set and not cached
+def whois_values(ip, output, whois_cache=None, failed=None):
+    if output is None:
+        if failed is not None:
+            failed.add(ip)
+        return [None, None, None]
+    values = parse_whois(output)
+    if whois_cache is not None:
+        whois_cache.put(ip, *values)
+    return values
+
+# run whois, IPs whose lookup failed are added to the failed set
+def run_whois(ip, whois_cache=None, failed=None):
+    if whois_cache is not None:
+        cached = whois_cache.get(ip)
+        metrics.count("whois_cache_hits" if cached is not None else "whois_cache_misses")
+        if cached is not None:
+            return pd.Series(cached)
+
+    output = query_with_retries(query_whois, ip, WHOIS_TIMEOUT, WHOIS_RETRIES, WHOIS_BACKOFF)
+    return pd.Series(whois_values(ip, output, whois_cache, failed))
+
+# whois for a batch of unique IPs, concurrently when a pool is given
+def lookup_whois(ips, whois_cache=None, whois_pool=None, failed=None):
+    if whois_pool is None:
+        return ips.apply(lambda ip: run_whois(ip, whois_cache, failed))
+
+    # the cache is only touched from this thread, workers just run queries
+    results = {}
+    pending = []
+    for ip in ips:
+        cached = whois_cache.get(ip) if whois_cache is not None else None
+        if whois_cache is not None:
+            metrics.count("whois_cache_hits" if cached is not None else "whois_cache_misses")
+        if cached is not None:
+            results[ip] = cached
+        else:
+            pending.append(ip)
+
+    # IPs of one /16 often share a whois block, so one of them is queried at a time
+    # and the others are answered from the block it records when they can be
+    while pending:
+        wave = {}
+        for ip in pending:
+            wave.setdefault(ip_block(ip) if whois_cache is not None else ip, ip)
+        for ip, output in whois_pool.resolve(wave.values()).items():
+            results[ip] = whois_values(ip, output, whois_cache, failed)
+
+        remaining = []
+        for ip in pending:
+            if ip in results:
+                continue
+            cached = whois_cache.get_again(ip)
+            if cached is not None:
+                metrics.count("whois_block_hits")
+                results[ip] = cached
+            else:
+                remaining.append(ip)
+        pending = remaining
+
+    return pd.DataFrame([results[ip] for ip in ips], index=ips.index)
+
+def open_whois():
+    """
+    Open the whois cache and, unless WHOIS_WORKERS is 1, the query pool.
+    :return: Tuple of (WhoisCache, WhoisPool or None)
+    """
+    whois_cache = WhoisCache(WHOIS_CACHE_PATH, WHOIS_CACHE_TTL, WHOIS_CACHE_MAX_ENTRIES)
+    whois_pool = None
+    if WHOIS_WORKERS > 1:
+        whois_pool = WhoisPool(query_whois, WHOIS_WORKERS, WHOIS_PER_REGISTRY, WHOIS_RATE,
+                               WHOIS_TIMEOUT, WHOIS_RETRIES, WHOIS_BACKOFF)
+    return whois_cache, whois_pool
+
+# whois results of an article are saved under the name of its anonymous edits table
+def whois_result_base(anon_path):
+    return os.path.join(WHOIS_RESULTS_DIR, os.path.splitext(os.path.basename(anon_path))[0])
+
+def read_anon_edits(path, columns=None):
+    if path.endswith(".parquet"):
+        return pd.read_parquet(path, columns=columns)
+    # kept as text so the values are written back exactly as stage 4 wrote them
+    return pd.read_csv(path, usecols=columns, dtype=str, keep_default_na=False)
+
+def list_stale(redo_all=False):
+    """
+    List the anonymous edits tables whose whois results are missing or older.
+    :param redo_all: List every table
+    :return: Sorted list of paths
+    """
+    if not os.path.exists(ANON_EDITS_DIR):
+        return []
+    paths = sorted(os.path.join(ANON_EDITS_DIR, f) for f in os.listdir(ANON_EDITS_DIR) if f.endswith(('.csv', '.parquet')))
+    if redo_all:
+        return paths
+
+    stale = []
+    for path in paths:
+        base = whois_result_base(path)
+        results = [base + ext for ext in (".parquet", ".csv") if os.path.exists(base + ext)]
+        if not results or max(os.path.getmtime(r) for r in results) < os.path.getmtime(path):
+            stale.append(path)
+    return stale
+
+def lookup_all(anon_paths, whois_cache=None, whois_pool=None, failed=None):
+    """
+    Look up every distinct IP of the given anonymous edits tables.
+    :param failed: Set the IPs whose lookup failed are added to
+    :return: DataFrame of user, country, org and inet, one row per IP
+    """
+    users = pd.concat([read_anon_edits(path, ["user"]) for path in anon_paths], ignore_index=True)
+    unique_ips = users.drop_duplicates(ignore_index=True)
+    print(f"{unique_ips.shape[0]} distinct IPs in {len(anon_paths)} articles")
+
+    progress = metrics.progress("ips", unique_ips.shape[0])
+    results = []
+    for start in range(0, unique_ips.shape[0], LOOKUP_BATCH):
+        batch = unique_ips.iloc[start:start + LOOKUP_BATCH].copy()
+        # Run whois on unique IPs
+        batch[["country", "org", "inet"]] = lookup_whois(batch["user"], whois_cache, whois_pool, failed)
+        results.append(batch)
+        progress.update(batch.shape[0])
+        print(f"Looked up {start + batch.shape[0]}/{unique_ips.shape[0]} IPs")
+    return pd.concat(results, ignore_index=True)
+
+def main():
+    anon_paths = list_stale(len(sys.argv) > 1 and sys.argv[1] == "all")
+    if not anon_paths:
+        print("No new anonymous edits, run 4_summany_whois.py first.")
+        return
+
+    whois_cache, whois_pool = open_whois()
+    failed = set()
+    try:
+        unique_ips = lookup_all(anon_paths, whois_cache, whois_pool, failed)
+        print(whois_cache.summary())
+    finally:
+        whois_cache.close()
+        if whois_pool is not None:
+            whois_pool.close()
+
+    # Create a directory for whois results if it doesn't exist
+    os.makedirs(WHOIS_RESULTS_DIR, exist_ok=True)
+    incomplete = 0
+    for path in anon_paths:
+        try:
+            # Merge the whois data back to the anonymous edits
+            anon_df = read_anon_edits(path)
+            if failed and anon_df["user"].isin(failed).any():
+                # no results at all, so list_stale picks the article up again,
+                # the IPs that were found are in the cache by then
+                incomplete += 1
+                for ext in (".parquet", ".csv"):
+                    if os.path.exists(whois_result_base(path) + ext):
+                        os.remove(whois_result_base(path) + ext)
+                print(f"Not saving whois results of {path}, some of its IPs could not be looked up")
+                continue
+            anon_df = anon_df.merge(unique_ips, on="user", how="left")
+            output_file = write_table(anon_df, whois_result_base(path))
+            metrics.count("rows_written", anon_df.shape[0])
+            print(f"Saved whois results to {output_file}")
+        except Exception as e:
+            print(f"Error processing {path}: {e}")
+
+    if failed:
+        metrics.count("whois_failed", len(failed))
+        print(f"{len(failed)} IPs could not be looked up, {incomplete} articles are retried on the next run")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    with metrics.stage("4b"):
+        main()
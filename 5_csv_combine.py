@@ -1,18 +1,124 @@
+# combines the per-article whois results and the stage 4 summaries into one table each
+# optional argument "csv" or "parquet" picks the output format, Parquet by default when pyarrow is installed
 import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
 import pandas as pd
 
-def append_csv_files(folder_path, output_file):
-    csv_files = [f for f in os.listdir(folder_path) if f.endswith('.csv')]
-    
-    if not csv_files:
+import metrics
+from history_store import SUMMARY_DTYPES, USE_PARQUET, WHOIS_RESULT_DTYPES, apply_schema, read_with_schema
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# files read at the same time
+READ_WORKERS = 8
+# rows collected before they are written out, bounds the memory use
+CHUNK_ROWS = 200_000
+
+class ChunkWriter:
+    """
+    Writes a table chunk by chunk to a temporary file that replaces the
+    output once everything is written. Every chunk has the declared schema,
+    so the Parquet row groups and CSV columns always agree.
+    """
+
+    def __init__(self, output_base, dtypes, file_format):
+        """
+        :param output_base: Output path without extension
+        :param dtypes: Declared columns and dtypes
+        :param file_format: "csv" or "parquet"
+        """
+        self.path = f"{output_base}.{file_format}"
+        self.other_path = f"{output_base}.{'csv' if file_format == 'parquet' else 'parquet'}"
+        self.part_path = self.path + ".part"
+        self.rows = 0
+        self.writer = None
+        self.file = None
+        if file_format == "parquet":
+            schema = pa.Schema.from_pandas(apply_schema(pd.DataFrame(), dtypes), preserve_index=False)
+            self.writer = pq.ParquetWriter(self.part_path, schema)
+        else:
+            self.file = open(self.part_path, 'w', newline='', encoding='utf-8')
+            pd.DataFrame(columns=list(dtypes)).to_csv(self.file, index=False)
+
+    def write(self, frames):
+        df = pd.concat(frames, ignore_index=True)
+        if self.writer is not None:
+            self.writer.write_table(pa.Table.from_pandas(df, schema=self.writer.schema, preserve_index=False))
+        else:
+            df.to_csv(self.file, header=False, index=False)
+        self.rows += df.shape[0]
+        metrics.count("rows_written", df.shape[0])
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        else:
+            self.file.close()
+        os.replace(self.part_path, self.path)
+        # a table left in the other format would be read instead of this one
+        if os.path.exists(self.other_path):
+            os.remove(self.other_path)
+
+    def abort(self):
+        if self.writer is not None:
+            self.writer.close()
+        else:
+            self.file.close()
+        os.remove(self.part_path)
+
+def append_csv_files(folder_path, output_base, dtypes, file_format=None):
+    """
+    Combine every CSV or Parquet table in a folder into one table, streaming.
+    Files are read in parallel with the declared dtypes and written in chunks
+    of about CHUNK_ROWS rows, so memory doesn't grow with the number of files.
+    :param output_base: Output path without extension
+    :param dtypes: Declared columns and dtypes of the tables
+    :param file_format: "csv" or "parquet", Parquet when pyarrow is installed if not given
+    :return: Path written, None if there was nothing to combine
+    """
+    files = sorted(f for f in os.listdir(folder_path) if f.endswith('.csv') or f.endswith('.parquet'))
+
+    if not files:
         print("No CSV files found in the folder.")
-        return
-    
-    df_list = [pd.read_csv(os.path.join(folder_path, file)) for file in csv_files]
-    combined_df = pd.concat(df_list, ignore_index=True)
-    
-    combined_df.to_csv(output_file, index=False)
-    print(f"Combined CSV saved to {output_file}")
-
-append_csv_files("./whois_results", "./whois_results.csv")
-append_csv_files("./summaries", "./summary.csv")
\ No newline at end of file
+        return None
+
+    file_format = file_format or ("parquet" if USE_PARQUET else "csv")
+    writer = ChunkWriter(output_base, dtypes, file_format)
+    try:
+        frames = []
+        buffered = 0
+        progress = metrics.progress(f"files_{os.path.basename(output_base)}", len(files))
+        with ThreadPoolExecutor(max_workers=READ_WORKERS) as executor:
+            # a window of files at a time, so reading doesn't run ahead of writing
+            window = READ_WORKERS * 2
+            for start in range(0, len(files), window):
+                paths = [os.path.join(folder_path, f) for f in files[start:start + window]]
+                for df in executor.map(lambda path: read_with_schema(path, dtypes), paths):
+                    frames.append(df)
+                    buffered += df.shape[0]
+                    progress.update()
+                    if buffered >= CHUNK_ROWS:
+                        writer.write(frames)
+                        frames = []
+                        buffered = 0
+        if frames:
+            writer.write(frames)
+    except Exception:
+        writer.abort()
+        raise
+    writer.close()
+
+    print(f"Combined {len(files)} files ({writer.rows} rows) into {writer.path}")
+    return writer.path
+
+if __name__ == "__main__":
+    file_format = sys.argv[1] if len(sys.argv) > 1 else None
+    with metrics.stage("5"):
+        append_csv_files("./whois_results", "./whois_results", WHOIS_RESULT_DTYPES, file_format)
+        append_csv_files("./summaries", "./summary", SUMMARY_DTYPES, file_format)
@@ -2,13 +2,16 @@ import subprocess
 import pandas as pd
 import re
 import sys
-import os
-import ipaddress
+
+import metrics
+from cidr_index import load_or_build_temporal_index, resolve_countries
+from history_store import read_table, write_table
 
 # git all commits of the country-ip-blocks repo into a dataframe with timestamps
 # generated by ChatGPT
 def get_all_commits(repo_path):
     try:
+        metrics.count("git_operations")
         result = subprocess.run(
             ["git", "log", "--pretty=format:%H %s"],
             cwd=repo_path,
@@ -39,94 +42,49 @@ def get_all_commits(repo_path):
         print(f"An error occurred: {e}")
         return None
 
-# run git command to reroll git repo to a specified commit
-def reroll(commit, repo_path):
-    _ = subprocess.run(
-        ["git", "checkout", commit, "--", "."],
-        cwd=repo_path,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        text=True
-    )
-
-# find the country of an IP address in country-ip-blocks
-# generated by ChatGPT
-def find_ip_in_cidr_files(ip, base_folder):
-    try:
-        target_ip = ipaddress.ip_address(ip)
-        folder_type = "ipv4" if target_ip.version == 4 else "ipv6"
-        folder_path = os.path.join(base_folder, folder_type)
-
-        if not os.path.exists(folder_path):
-            print(f"Error: Folder '{folder_path}' does not exist.")
-            return None
-
-        for file in os.listdir(folder_path):
-            if file.endswith(".cidr"):
-                file_path = os.path.join(folder_path, file)
-                with open(file_path, "r") as f:
-                    for line in f:
-                        cidr = line.strip()
-                        if cidr:
-                            try:
-                                if target_ip in ipaddress.ip_network(cidr, strict=False):
-                                    # print(f"IP {ip} found in {file}")
-                                    return file
-                            except ValueError:
-                                print(f"Skipping invalid CIDR: {cidr} in {file}")
-
-        print(f"IP {ip} not found in any CIDR file.")
-        return None
-
-    except ValueError:
-        print(f"Error: '{ip}' is not a valid IP address.")
-        return None
-
-# get the latest commit before a timestamp
-def get_previous_commit(df, timestamp):
-    timestamp = pd.to_datetime(timestamp)
-    previous_commit = df[df["timestamp"] < timestamp].iloc[0]
-    return previous_commit["commit"]
-
-# path to the country-ip-blocks git repo, putting it in a temp fs is recommended
-repo_path = "./mnt/country-ip-blocks"
-ip_df = get_all_commits(repo_path)
-
-df = pd.read_csv("./whois_results.csv", dtype={
-    "url": pd.StringDtype(),
-    "rev_id": pd.Int64Dtype(),
-    "timestamp": pd.StringDtype(),
-    "user": pd.StringDtype(),
-    "comment": pd.StringDtype(),
-    "size": pd.Int64Dtype(),
-    "tags": pd.StringDtype(),
-    "size_diff": pd.Int16Dtype(),
-    "time_diff": pd.StringDtype(),
-    "is_anon": pd.BooleanDtype(),
-    "country": pd.StringDtype(),
-    "org": pd.StringDtype(),
-    "inet": pd.StringDtype(),
-    "desc": pd.StringDtype(),
-})
-
-counter = 0
-
-def query(row):
-    global counter
-    counter += 1
-    if counter % 100 == 0:
-        print(counter)
-
-    ip = row["user"]
-    time = row["timestamp"]
-    # print(time, ip)
-    get_previous_commit(ip_df, time)
-    reroll(time, repo_path)
-    return str(find_ip_in_cidr_files(ip, repo_path))
-
-df = df[pd.to_datetime(df["timestamp"]) >= "2020-03-01"]
-
-df = df.sort_values(by="timestamp")
-
-df["file"] = df.apply(query, axis=1)
-df.to_csv("second.csv")
\ No newline at end of file
+def main():
+    # path to the country-ip-blocks git repo, putting it in a temp fs is recommended
+    repo_path = "./mnt/country-ip-blocks"
+    ip_df = get_all_commits(repo_path)
+    if ip_df is None:
+        print(f"Could not read the commits of {repo_path}, check repo_path in 6_country_ip_blocks_query.py.")
+        sys.exit(1)
+
+    # every snapshot is read from git objects once and saved, later runs only add new commits
+    index_path = "./country_ip_blocks_index.json.gz"
+    with metrics.timer("load_index"):
+        ip_index = load_or_build_temporal_index(index_path, repo_path, ip_df)
+
+    with metrics.timer("read_whois_results"):
+        df = read_table("./whois_results", dtype={
+            "url": pd.StringDtype(),
+            "rev_id": pd.Int64Dtype(),
+            "timestamp": pd.StringDtype(),
+            "user": pd.StringDtype(),
+            "comment": pd.StringDtype(),
+            "size": pd.Int64Dtype(),
+            "tags": pd.StringDtype(),
+            "size_diff": pd.Int64Dtype(),
+            "time_diff": pd.StringDtype(),
+            "is_anon": pd.BooleanDtype(),
+            "country": pd.StringDtype(),
+            "org": pd.StringDtype(),
+            "inet": pd.StringDtype(),
+            "desc": pd.StringDtype(),
+        })
+
+    df = df[pd.to_datetime(df["timestamp"]) >= "2020-03-01"]
+
+    df = df.sort_values(by="timestamp")
+
+    # resolve every row in one batch, str() keeps misses as "None" like the row-wise query did
+    with metrics.timer("resolve_countries"):
+        files = resolve_countries(ip_index, df["user"], df["timestamp"])
+    df["file"] = [str(file) for file in files]
+    metrics.count("rows_resolved", df.shape[0])
+    print(f"Resolved {df.shape[0]} rows")
+    write_table(df, "second", index=True)
+
+if __name__ == "__main__":
+    with metrics.stage("6"):
+        main()
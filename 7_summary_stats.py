@@ -1,8 +1,9 @@
-import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 
-df = pd.read_csv("summary.csv")
+from history_store import read_table
+
+df = read_table("summary")
 total = np.sum(df["num_contrib"])
 
 named_count = np.sum(df["named_num"])
@@ -3,24 +3,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 import os
 
-df = pd.read_csv("./second.csv", dtype={
-    "url": pd.StringDtype(),
-    "rev_id": pd.Int64Dtype(),
-    "timestamp": pd.StringDtype(),
-    "user": pd.StringDtype(),
-    "comment": pd.StringDtype(),
-    "size": pd.Int64Dtype(),
-    "tags": pd.StringDtype(),
-    "size_diff": pd.Int16Dtype(),
-    "time_diff": pd.StringDtype(),
-    "is_anon": pd.BooleanDtype(),
-    "country": pd.StringDtype(),
-    "org": pd.StringDtype(),
-    "inet": pd.StringDtype(),
-    "desc": pd.StringDtype(),
-    "file": pd.StringDtype(),
-})
-
+from history_store import read_table
 
 def extract_country_code(filename):
     if pd.isna(filename):
@@ -28,14 +11,8 @@ def extract_country_code(filename):
     else:
         return str.split(filename, ".")[0].upper()
 
-# make file names have same format as whois
-df["file"] = df["file"].apply(extract_country_code)
-df["country"] = df["country"].str.upper()
-df[df["file"] == "CN"].to_csv("cn_file.csv")
-
-print("agree", df[df["file"] == df["country"]].shape[0] / df.shape[0])
-
-def countries_by_diff_file(df):
+# bytes changed and edit count per country file, with their share of the total
+def contributions_by_file(df):
     df_contrib_by_county = df[["file", "size_diff"]].copy()
     df_contrib_by_county["count"] = 1
     df_contrib_by_county["size_diff"] = np.abs(df_contrib_by_county["size_diff"])
@@ -45,7 +22,10 @@ def countries_by_diff_file(df):
     count_sum = np.sum(df_contrib_by_county["count"])
     df_contrib_by_county["diff_percent"] = df_contrib_by_county["size_diff"] / diff_sum * 100
     df_contrib_by_county["count_percent"] = df_contrib_by_county["count"] / count_sum * 100
+    return df_contrib_by_county
 
+def countries_by_diff_file(df):
+    df_contrib_by_county = contributions_by_file(df)
     df_contrib_by_county = df_contrib_by_county.sort_values(by=["size_diff"], ascending=False)
 
     df_top_diff = df_contrib_by_county.head(12)
@@ -60,16 +40,7 @@ def countries_by_diff_file(df):
     plt.close()
 
 def countries_by_count_file(df):
-    df_contrib_by_county = df[["file", "size_diff"]].copy()
-    df_contrib_by_county["count"] = 1
-    df_contrib_by_county["size_diff"] = np.abs(df_contrib_by_county["size_diff"])
-    df_contrib_by_county = df_contrib_by_county.groupby("file").sum()
-
-    diff_sum = np.sum(df_contrib_by_county["size_diff"])
-    count_sum = np.sum(df_contrib_by_county["count"])
-    df_contrib_by_county["diff_percent"] = df_contrib_by_county["size_diff"] / diff_sum * 100
-    df_contrib_by_county["count_percent"] = df_contrib_by_county["count"] / count_sum * 100
-
+    df_contrib_by_county = contributions_by_file(df)
     df_contrib_by_county = df_contrib_by_county.sort_values(by=["count"], ascending=False)
 
     df_top_diff = df_contrib_by_county.head(12)
@@ -83,5 +54,31 @@ def countries_by_count_file(df):
     plt.savefig("countries_by_count_file.png")
     plt.close()
 
-countries_by_diff_file(df)
-countries_by_count_file(df)
\ No newline at end of file
+if __name__ == "__main__":
+    df = read_table("./second", dtype={
+        "url": pd.StringDtype(),
+        "rev_id": pd.Int64Dtype(),
+        "timestamp": pd.StringDtype(),
+        "user": pd.StringDtype(),
+        "comment": pd.StringDtype(),
+        "size": pd.Int64Dtype(),
+        "tags": pd.StringDtype(),
+        "size_diff": pd.Int64Dtype(),
+        "time_diff": pd.StringDtype(),
+        "is_anon": pd.BooleanDtype(),
+        "country": pd.StringDtype(),
+        "org": pd.StringDtype(),
+        "inet": pd.StringDtype(),
+        "desc": pd.StringDtype(),
+        "file": pd.StringDtype(),
+    })
+
+    # make file names have same format as whois
+    df["file"] = df["file"].apply(extract_country_code)
+    df["country"] = df["country"].str.upper()
+    df[df["file"] == "CN"].to_csv("cn_file.csv")
+
+    print("agree", df[df["file"] == df["country"]].shape[0] / df.shape[0])
+
+    countries_by_diff_file(df)
+    countries_by_count_file(df)
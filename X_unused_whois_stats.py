@@ -2,7 +2,9 @@ import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 
-df = pd.read_csv("./whois_results.csv", dtype={
+from history_store import read_table
+
+df = read_table("./whois_results", dtype={
     "url": pd.StringDtype(),
     "rev_id": pd.Int64Dtype(),
     "timestamp": pd.StringDtype(),
@@ -10,7 +12,7 @@ df = pd.read_csv("./whois_results.csv", dtype={
     "comment": pd.StringDtype(),
     "size": pd.Int64Dtype(),
     "tags": pd.StringDtype(),
-    "size_diff": pd.Int16Dtype(),
+    "size_diff": pd.Int64Dtype(),
     "time_diff": pd.StringDtype(),
     "is_anon": pd.BooleanDtype(),
     "country": pd.StringDtype(),
@@ -0,0 +1,70 @@
+# compares the is_anon classifier of stage 4 with the regex matching it replaced
+# usage: python benchmarks/bench_is_anon.py [revisions] [distinct users]
+import importlib
+import os
+import random
+import re
+import sys
+import time
+
+import pandas as pd
+
+# the stage scripts are one folder up and start with a digit
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+stage4 = importlib.import_module("4_summany_whois")
+
+# the regexes stage 4 used before classify_anon
+# https://superuser.com/questions/202818/what-regular-expression-can-i-use-to-match-an-ip-address
+ipv4_match = re.compile("[0-9]{1,3}\\.[0-9]{1,3}\\.[0-9]{1,3}\\.[0-9]{1,3}")
+ipv6_match = re.compile("(([0-9a-fA-F]{1,4}:){7,7}[0-9a-fA-F]{1,4}|([0-9a-fA-F]{1,4}:){1,7}:|([0-9a-fA-F]{1,4}:){1,6}:[0-9a-fA-F]{1,4}|([0-9a-fA-F]{1,4}:){1,5}(:[0-9a-fA-F]{1,4}){1,2}|([0-9a-fA-F]{1,4}:){1,4}(:[0-9a-fA-F]{1,4}){1,3}|([0-9a-fA-F]{1,4}:){1,3}(:[0-9a-fA-F]{1,4}){1,4}|([0-9a-fA-F]{1,4}:){1,2}(:[0-9a-fA-F]{1,4}){1,5}|[0-9a-fA-F]{1,4}:((:[0-9a-fA-F]{1,4}){1,6})|:((:[0-9a-fA-F]{1,4}){1,7}|:)|fe80:(:[0-9a-fA-F]{0,4}){0,4}%[0-9a-zA-Z]{1,}|::(ffff(:0{1,4}){0,1}:){0,1}((25[0-5]|(2[0-4]|1{0,1}[0-9]){0,1}[0-9])\\.){3,3}(25[0-5]|(2[0-4]|1{0,1}[0-9]){0,1}[0-9])|([0-9a-fA-F]{1,4}:){1,4}:((25[0-5]|(2[0-4]|1{0,1}[0-9]){0,1}[0-9])\\.){3,3}(25[0-5]|(2[0-4]|1{0,1}[0-9]){0,1}[0-9]))")
+
+def regex_is_anon(users):
+    return users.str.match(ipv4_match) | users.str.match(ipv6_match)
+
+def make_users(revisions, distinct, seed=0):
+    """
+    User names the way they show up in histories, a few users make most of the edits.
+    :return: Series of user names with StringDtype
+    """
+    rng = random.Random(seed)
+    names = []
+    for i in range(distinct):
+        kind = rng.random()
+        if kind < 0.3:
+            names.append(".".join(str(rng.randint(0, 255)) for _ in range(4)))
+        elif kind < 0.4:
+            names.append(":".join(f"{rng.randint(0, 65535):X}" for _ in range(8)))
+        elif kind < 0.42:
+            # look like addresses but aren't
+            names.append(f"{rng.randint(1, 999)}.{rng.randint(1, 999)}.{rng.randint(1, 999)}.{rng.randint(1, 999)}bot")
+        else:
+            names.append(f"User{i}")
+    weights = [1 / (rank + 1) for rank in range(distinct)]
+    return pd.Series(rng.choices(names, weights, k=revisions), dtype=pd.StringDtype())
+
+def best_time(function, users, repeat=3):
+    # fastest of a few runs, in seconds
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function(users)
+        times.append(time.perf_counter() - started)
+    return min(times), result
+
+def main():
+    revisions = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    distinct = int(sys.argv[2]) if len(sys.argv) > 2 else 50_000
+    users = make_users(revisions, distinct)
+    print(f"{revisions} revisions, {users.nunique()} distinct users")
+
+    regex_seconds, regex_result = best_time(regex_is_anon, users)
+    classify_seconds, classify_result = best_time(stage4.classify_anon, users)
+    print(f"regex:         {regex_seconds:.3f}s ({revisions / regex_seconds:,.0f} rows/s)")
+    print(f"classify_anon: {classify_seconds:.3f}s ({revisions / classify_seconds:,.0f} rows/s)")
+    print(f"speedup:       {regex_seconds / classify_seconds:.1f}x")
+
+    differ = users[pd.Series(regex_result).to_numpy() != pd.Series(classify_result).to_numpy()].unique()
+    print(f"{len(differ)} distinct users classified differently, e.g. {list(differ[:5])}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,349 @@
+# local stand-ins for the MediaWiki API and whois servers, for load tests without touching production
+# run directly to start both and point the stages at the printed addresses
+import html
+import json
+import random
+import socketserver
+import threading
+import time
+import urllib.parse
+import zlib
+from collections import Counter, deque
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import fixtures
+
+# the API's limit for "max"
+MAX_LIMIT = 500
+
+class Faults:
+    """
+    Latency and error injection shared by both servers.
+    """
+
+    def __init__(self, latency=0.02, jitter=0.01, throttle_rate=0.0, error_rate=0.0, maxlag_rate=0.0,
+                 rate_limit=None, retry_after=1, seed=0):
+        """
+        :param latency: Seconds added to every answer
+        :param jitter: Extra random seconds, up to this much
+        :param throttle_rate: Share of requests answered with a throttle (HTTP 429 / whois "access denied")
+        :param error_rate: Share of requests answered with a server error (HTTP 503 / dropped connection)
+        :param maxlag_rate: Share of API requests with a maxlag parameter answered with a maxlag error
+        :param rate_limit: Requests per second above which everything is throttled, None for no limit
+        :param retry_after: Seconds sent in Retry-After headers
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.maxlag_rate = maxlag_rate
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.recent = deque()
+
+    def delay(self):
+        with self.lock:
+            extra = self.rng.random() * self.jitter
+        time.sleep(self.latency + extra)
+
+    def over_limit(self):
+        # requests in the last second, counted whether they were served or not
+        if self.rate_limit is None:
+            return False
+        now = time.monotonic()
+        with self.lock:
+            self.recent.append(now)
+            while self.recent and self.recent[0] < now - 1:
+                self.recent.popleft()
+            return len(self.recent) > self.rate_limit
+
+    def roll(self, rate):
+        with self.lock:
+            return self.rng.random() < rate
+
+class Stats:
+    """
+    Thread-safe counts of answered requests by kind and outcome.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = Counter()
+
+    def add(self, kind, outcome):
+        with self.lock:
+            self.counts[(kind, outcome)] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {f"{kind} {outcome}": count for (kind, outcome), count in sorted(self.counts.items())}
+
+def article_title(i):
+    return f"Load test article {i}"
+
+def category_members(title, members, subcategories):
+    """
+    Members of a fake category, the same every time for the same title.
+    :return: List of API member dicts, articles first then subcategories
+    """
+    rng = random.Random(title)
+    start = zlib.crc32(title.encode()) % 100_000
+    result = [{"pageid": start + i, "ns": 0, "title": article_title(start + i)} for i in range(members)]
+    for i in range(subcategories):
+        result.append({"pageid": 900_000 + rng.randint(0, 99_999), "ns": 14,
+                       "title": f"Category:{title.split(':', 1)[-1]} sub {i}"})
+    return result
+
+def article_revisions(title, mean_revisions):
+    """
+    Revisions of a fake article newest first, article sizes are skewed like real ones.
+    """
+    rng = random.Random(title)
+    count = max(1, int(rng.paretovariate(1.2) * mean_revisions / 6))
+    timestamp = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    size = rng.randint(1000, 40000)
+    networks = fixtures.make_networks(0, 4)
+    revisions = []
+    for i in range(count):
+        if rng.random() < 0.25:
+            user = fixtures.random_address(rng, networks)
+            revision = {"anon": ""}
+        else:
+            user = f"User{rng.randint(0, 5000)}"
+            revision = {}
+        revision.update({
+            "revid": 50_000_000 + (zlib.crc32(title.encode()) % 10_000) * 1000 + count - i,
+            "parentid": 0,
+            "user": user,
+            "timestamp": timestamp.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "size": size,
+            "comment": "load test edit",
+            "tags": ["mobile edit"] if rng.random() < 0.2 else [],
+        })
+        revisions.append(revision)
+        timestamp -= timedelta(seconds=rng.randint(60, 5 * 86400))
+        size = max(0, size - int(rng.gauss(0, 300)))
+    return revisions
+
+def page_limit(value):
+    if value in (None, "max"):
+        return MAX_LIMIT
+    return min(int(value), MAX_LIMIT)
+
+class FakeMediaWiki:
+    """
+    Serves category pages (HTML), list=categorymembers and prop=revisions
+    like en.wikipedia.org, with continuation, 429s with Retry-After, maxlag
+    errors and 503s injected according to the faults. Answers carry an ETag
+    and If-None-Match is answered with 304 when nothing changed.
+    """
+
+    def __init__(self, faults=None, members=50, subcategories=2, mean_revisions=200, port=0):
+        """
+        :param members: Articles per category
+        :param subcategories: Subcategories per category
+        :param mean_revisions: Rough average revisions per article
+        :param port: Port to listen on, 0 picks a free one
+        """
+        self.faults = faults or Faults()
+        self.members = members
+        self.subcategories = subcategories
+        self.mean_revisions = mean_revisions
+        self.stats = Stats()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                server.handle(self)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    @property
+    def api_url(self):
+        return self.base_url + "/w/api.php"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def send(self, handler, status, body, content_type="application/json", headers=None):
+        data = body.encode("utf-8")
+        handler.send_response(status)
+        handler.send_header("Content-Type", content_type)
+        handler.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            handler.send_header(key, value)
+        handler.end_headers()
+        handler.wfile.write(data)
+
+    def send_validated(self, handler, kind, body, content_type="application/json"):
+        # the same fake data always gives the same body, so its checksum is a stable ETag
+        etag = f'"{zlib.crc32(body.encode("utf-8")):08x}"'
+        if handler.headers.get("If-None-Match") == etag:
+            self.stats.add(kind, "304")
+            handler.send_response(304)
+            handler.send_header("ETag", etag)
+            handler.send_header("Content-Length", "0")
+            handler.end_headers()
+            return
+        self.stats.add(kind, "200")
+        self.send(handler, 200, body, content_type, {"ETag": etag})
+
+    def handle(self, handler):
+        url = urllib.parse.urlparse(handler.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        if url.path.startswith("/wiki/"):
+            kind = "category_html"
+        elif params.get("list") == "categorymembers":
+            kind = "categorymembers"
+        elif params.get("prop") == "revisions":
+            kind = "revisions"
+        else:
+            kind = "other"
+
+        self.faults.delay()
+        if self.faults.over_limit() or self.faults.roll(self.faults.throttle_rate):
+            self.stats.add(kind, "429")
+            self.send(handler, 429, "Too many requests", "text/plain", {"Retry-After": str(self.faults.retry_after)})
+            return
+        if self.faults.roll(self.faults.error_rate):
+            self.stats.add(kind, "503")
+            self.send(handler, 503, "Service unavailable", "text/plain")
+            return
+        if "maxlag" in params and self.faults.roll(self.faults.maxlag_rate):
+            # the API answers maxlag with HTTP 200 and an error object
+            self.stats.add(kind, "maxlag")
+            lag = self.faults.retry_after
+            body = {"error": {"code": "maxlag", "info": f"Waiting for a database server: {lag} seconds lagged", "lag": lag}}
+            self.send(handler, 200, json.dumps(body), headers={"Retry-After": str(lag), "X-Database-Lag": str(lag)})
+            return
+
+        if kind == "category_html":
+            body = self.category_html(urllib.parse.unquote(url.path.split("/wiki/", 1)[1]).replace("_", " "))
+            self.send_validated(handler, kind, body, "text/html; charset=utf-8")
+        elif kind == "categorymembers":
+            self.send_validated(handler, kind, json.dumps(self.categorymembers(params)))
+        elif kind == "revisions":
+            self.send_validated(handler, kind, json.dumps(self.revisions(params)))
+        else:
+            self.stats.add(kind, "400")
+            self.send(handler, 400, json.dumps({"error": {"code": "badrequest", "info": "Unsupported request"}}))
+
+    def category_html(self, title):
+        # one page of links, there is no "next page" link so the old scraper never leaves this server
+        links = "".join(
+            f'<li><a href="/wiki/{urllib.parse.quote(member["title"].replace(" ", "_"))}">{html.escape(member["title"])}</a></li>'
+            for member in category_members(title, self.members, 0)[:200]
+        )
+        return (
+            f'<html><body><h1 id="firstHeading">{html.escape(title)}</h1>'
+            f'<div id="mw-pages"><div class="mw-category-group"><ul>{links}</ul></div></div></body></html>'
+        )
+
+    def categorymembers(self, params):
+        members = category_members(params.get("cmtitle", ""), self.members, self.subcategories)
+        offset = int(params.get("cmcontinue", 0))
+        limit = page_limit(params.get("cmlimit"))
+        data = {"batchcomplete": "", "query": {"categorymembers": members[offset:offset + limit]}}
+        if offset + limit < len(members):
+            data["continue"] = {"cmcontinue": str(offset + limit), "continue": "-||"}
+        return data
+
+    def revisions(self, params):
+        title = params.get("titles", "")
+        revisions = article_revisions(title, self.mean_revisions)
+        if params.get("rvdir") == "newer":
+            revisions = revisions[::-1]
+            if "rvstart" in params:
+                revisions = [rev for rev in revisions if rev["timestamp"] >= params["rvstart"]]
+        offset = int(params.get("rvcontinue", 0))
+        limit = page_limit(params.get("rvlimit"))
+        page = {"pageid": zlib.crc32(title.encode()) % 1_000_000, "ns": 0, "title": title,
+                "revisions": revisions[offset:offset + limit]}
+        data = {"query": {"pages": {str(page["pageid"]): page}}}
+        if offset + limit < len(revisions):
+            data["continue"] = {"rvcontinue": str(offset + limit), "continue": "||"}
+        return data
+
+class FakeWhois:
+    """
+    Answers port 43 queries with canned RIPE-style records. Throttled answers
+    and dropped connections are injected according to the faults.
+    """
+
+    def __init__(self, faults=None, port=0):
+        self.faults = faults or Faults()
+        self.stats = Stats()
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                server.handle(self)
+
+        self.tcp = socketserver.ThreadingTCPServer(("127.0.0.1", port), Handler)
+        self.tcp.daemon_threads = True
+        self.thread = threading.Thread(target=self.tcp.serve_forever, daemon=True)
+
+    @property
+    def address(self):
+        return f"127.0.0.1:{self.tcp.server_address[1]}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.tcp.shutdown()
+        self.tcp.server_close()
+
+    def handle(self, handler):
+        query = handler.rfile.readline().decode("utf-8", errors="replace").strip()
+        # ARIN style queries carry a prefix, the address is the last word
+        ip = query.split()[-1] if query else ""
+        self.faults.delay()
+        if self.faults.over_limit() or self.faults.roll(self.faults.throttle_rate):
+            self.stats.add("whois", "throttled")
+            handler.wfile.write(b"%ERROR:201: access denied\r\n% Query limit exceeded\r\n")
+            return
+        if self.faults.roll(self.faults.error_rate):
+            # close without an answer
+            self.stats.add("whois", "dropped")
+            return
+        try:
+            answer = fixtures.canned_whois(ip)
+        except ValueError:
+            self.stats.add("whois", "invalid")
+            handler.wfile.write(b"%ERROR:101: no entries found\r\n")
+            return
+        self.stats.add("whois", "ok")
+        handler.wfile.write(answer.replace("\n", "\r\n").encode("utf-8"))
+
+if __name__ == "__main__":
+    wiki = FakeMediaWiki().start()
+    whois_server = FakeWhois().start()
+    print(f"MediaWiki API: {wiki.api_url}")
+    print(f"Category pages: {wiki.base_url}/wiki/Category:Load_test_0")
+    print(f"whois: {whois_server.address}")
+    try:
+        while True:
+            time.sleep(10)
+            print(wiki.stats.snapshot(), whois_server.stats.snapshot())
+    except KeyboardInterrupt:
+        wiki.stop()
+        whois_server.stop()
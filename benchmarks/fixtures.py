@@ -0,0 +1,152 @@
+# seeded synthetic inputs for the benchmarks, nothing here touches the network
+import ipaddress
+import os
+import random
+import subprocess
+from datetime import datetime, timedelta, timezone
+
+from history_store import HistoryWriter, compact_histories, history_path
+
+COUNTRIES = ["us", "de", "gb", "fr", "cn", "in", "br", "jp", "ru", "ca", "au", "it", "es", "nl", "kr", "mx"]
+
+def make_networks(seed=0, per_country=40):
+    """
+    Random IPv4 and IPv6 networks for every country, the same for the same seed.
+    :return: Dict of country to (list of IPv4 networks, list of IPv6 networks)
+    """
+    rng = random.Random(seed)
+    networks = {}
+    used = set()
+    for country in COUNTRIES:
+        ipv4 = []
+        while len(ipv4) < per_country:
+            prefix = rng.choice([16, 18, 20, 22, 24])
+            base = rng.randint(1, 223) << 24 | rng.getrandbits(24)
+            network = ipaddress.ip_network((base >> (32 - prefix) << (32 - prefix), prefix))
+            if network.network_address.packed[:2] not in used:
+                used.add(network.network_address.packed[:2])
+                ipv4.append(network)
+        ipv6 = []
+        for _ in range(per_country // 4):
+            prefix = rng.choice([32, 36, 48])
+            base = (0x2000 << 112) | rng.getrandbits(109) << 3
+            ipv6.append(ipaddress.ip_network((base >> (128 - prefix) << (128 - prefix), prefix)))
+        networks[country] = (ipv4, ipv6)
+    return networks
+
+def random_address(rng, networks):
+    # an address inside one of the networks most of the time, otherwise anywhere
+    country = rng.choice(COUNTRIES)
+    ipv4, ipv6 = networks[country]
+    if rng.random() < 0.1:
+        return str(ipaddress.ip_address(rng.randint(1 << 24, (224 << 24) - 1)))
+    network = rng.choice(ipv6) if rng.random() < 0.2 else rng.choice(ipv4)
+    return str(network[rng.randrange(network.num_addresses)])
+
+def make_histories(count, seed=0, networks=None, anon_share=0.25, max_revisions=5000):
+    """
+    Write synthetic article histories where stage 3 would save them.
+    Article sizes follow a Pareto distribution, so a few articles have most
+    of the revisions. Editors are a mix of named users, who repeat a lot,
+    and IPv4/IPv6 addresses.
+    :return: Number of revisions written
+    """
+    rng = random.Random(seed)
+    networks = networks or make_networks(seed)
+    named = [f"User{i}" for i in range(max(10, count * 5))]
+    named_weights = [1 / (rank + 1) for rank in range(len(named))]
+    addresses = [random_address(rng, networks) for _ in range(max(10, count * 3))]
+
+    total = 0
+    for article in range(count):
+        url = f"https://en.wikipedia.org/wiki/Synthetic_article_{article}"
+        revisions = min(max_revisions, int(rng.paretovariate(1.1) * 8))
+        timestamp = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        size = rng.randint(500, 50000)
+        rows = []
+        for i in range(revisions):
+            if rng.random() < anon_share:
+                user = rng.choice(addresses)
+            else:
+                user = rng.choices(named, named_weights)[0]
+            rows.append({
+                "url": url,
+                "rev_id": 10_000_000 - article * 10_000 - i,
+                "timestamp": timestamp.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "user": user,
+                "comment": rng.choice(["copyedit", "/* History */ expanded", "Reverted edits", ""]),
+                "size": size,
+                "tags": rng.choice(["N/A", "mobile edit, mobile web edit", "visualeditor"]),
+            })
+            # histories are newest first, so going back in time
+            timestamp -= timedelta(seconds=int(rng.expovariate(1 / 86400)) + 1)
+            size = max(0, size - int(rng.gauss(0, 400)))
+        writer = HistoryWriter(history_path(url, f"Synthetic_article_{article}"), url)
+        writer.write(rows)
+        writer.commit()
+        total += revisions
+    # staged histories are merged into the store like at the end of a stage 3 run
+    compact_histories()
+    return total
+
+def canned_whois(ip, timeout=10):
+    """
+    Whois answer in RIPE format for an IP, the same every time, used instead of a whois server.
+    """
+    rng = random.Random(ip)
+    country = rng.choice(COUNTRIES).upper()
+    target_ip = ipaddress.ip_address(ip)
+    if target_ip.version == 4:
+        network = ipaddress.ip_network(f"{ip}/24", strict=False)
+        inet = f"inetnum:        {network[0]} - {network[-1]}"
+    else:
+        inet = f"inet6num:       {ipaddress.ip_network(f'{ip}/48', strict=False)}"
+    return (
+        "% This is the RIPE Database query service.\n"
+        "% The objects are in RPSL format.\n\n"
+        f"{inet}\n"
+        f"netname:        NET-{country}-{rng.randint(1, 9999)}\n"
+        f"country:        {country}\n"
+        f"org:            ORG-{rng.randint(1, 99999)}-RIPE\n"
+        "status:         ASSIGNED PA\n"
+        "source:         RIPE\n"
+    )
+
+def git(repo_path, *args, env=None):
+    subprocess.run(["git", *args], cwd=repo_path, check=True, stdout=subprocess.DEVNULL, env=env)
+
+def make_country_repo(repo_path, snapshots=6, seed=0, networks=None):
+    """
+    Create a git repo shaped like country-ip-blocks, one commit per snapshot
+    with "Update <timestamp>" messages. Every snapshot moves some networks
+    between countries.
+    :return: The networks of the last snapshot
+    """
+    rng = random.Random(seed)
+    networks = {country: (list(v4), list(v6)) for country, (v4, v6) in (networks or make_networks(seed)).items()}
+    os.makedirs(os.path.join(repo_path, "ipv4"), exist_ok=True)
+    os.makedirs(os.path.join(repo_path, "ipv6"), exist_ok=True)
+    git(repo_path, "init", "-q")
+
+    timestamp = datetime(2019, 6, 1, tzinfo=timezone.utc)
+    for snapshot in range(snapshots):
+        if snapshot:
+            # reassign a few networks to another country
+            for _ in range(5):
+                source, target = rng.sample(COUNTRIES, 2)
+                if networks[source][0]:
+                    networks[target][0].append(networks[source][0].pop(rng.randrange(len(networks[source][0]))))
+        for country, (ipv4, ipv6) in networks.items():
+            with open(os.path.join(repo_path, "ipv4", f"{country}.cidr"), "w") as f:
+                f.write("".join(f"{network}\n" for network in ipv4))
+            with open(os.path.join(repo_path, "ipv6", f"{country}.cidr"), "w") as f:
+                f.write("".join(f"{network}\n" for network in ipv6))
+
+        stamp = timestamp.strftime("%Y-%m-%dT%H:%M:%S+00:00")
+        env = {**os.environ, "GIT_AUTHOR_DATE": stamp, "GIT_COMMITTER_DATE": stamp,
+               "GIT_AUTHOR_NAME": "bench", "GIT_AUTHOR_EMAIL": "bench@example.com",
+               "GIT_COMMITTER_NAME": "bench", "GIT_COMMITTER_EMAIL": "bench@example.com"}
+        git(repo_path, "add", "-A", env=env)
+        git(repo_path, "commit", "-q", "-m", f"Update {stamp}", env=env)
+        timestamp += timedelta(days=rng.randint(60, 200))
+    return networks
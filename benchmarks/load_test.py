@@ -0,0 +1,175 @@
+# load test of the network stages against the local fake MediaWiki API and whois servers
+# usage: python benchmarks/load_test.py [operations] [concurrency] [fault rate] [latency ms] [output json]
+#   operations   calls of every stage function (default 200)
+#   concurrency  calls in flight at once (default 8)
+#   fault rate   share of requests answered with a fault, half throttled and half server errors (default 0.05)
+#   latency ms   delay the servers add to every answer (default 20)
+# nothing here touches Wikipedia or a real whois server, results are written as JSON to benchmarks/results/
+import contextlib
+import importlib
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+# the stage scripts are one folder up and start with a digit
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, REPO_DIR)
+
+import numpy as np
+
+import fixtures
+from fake_servers import Faults, FakeMediaWiki, FakeWhois
+from run_benchmarks import RESULTS_DIR, git_commit
+from whois_client import WhoisClient
+
+stage1 = importlib.import_module("1_extract_arcticle_category")
+stage3 = importlib.import_module("3_download_article_history")
+stage4b = importlib.import_module("4b_whois_enrich")
+
+PERCENTILES = [50, 90, 99]
+
+def call(function, check):
+    """
+    Time one call of a stage function.
+    :param check: Function of the return value, False when the call failed
+    :return: Tuple of (seconds, ok)
+    """
+    started = time.perf_counter()
+    try:
+        ok = bool(check(function()))
+    except Exception:
+        # some stage functions raise on a bad answer instead of returning nothing
+        ok = False
+    return time.perf_counter() - started, ok
+
+def run_stage(name, function, check, arguments, concurrency, stats):
+    """
+    Call a stage function once for every argument with a thread pool and
+    summarize the calls and the requests the server saw while they ran.
+    :param stats: Stats of the server the stage talks to
+    :return: Result dict
+    """
+    before = stats.snapshot()
+    started = time.perf_counter()
+    # the stages print a line per call and per error, keep the report readable
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            calls = list(executor.map(lambda argument: call(lambda: function(argument), check), arguments))
+    seconds = time.perf_counter() - started
+
+    after = stats.snapshot()
+    outcomes = {key: after[key] - before.get(key, 0) for key in after if after[key] != before.get(key, 0)}
+    requests = sum(outcomes.values())
+    latencies = np.array([latency for latency, _ in calls])
+    errors = sum(not ok for _, ok in calls)
+
+    result = {
+        "name": name,
+        "operations": len(calls),
+        "seconds": seconds,
+        "operations_per_second": len(calls) / seconds,
+        "requests": requests,
+        "requests_per_second": requests / seconds,
+        "latency_seconds": {f"p{p}": float(np.percentile(latencies, p)) for p in PERCENTILES},
+        "error_rate": errors / len(calls),
+        "server_outcomes": outcomes,
+    }
+    print(f"{name:<30} {result['operations_per_second']:8.1f} ops/s {result['requests_per_second']:8.1f} req/s "
+          + " ".join(f"p{p} {result['latency_seconds'][f'p{p}'] * 1000:7.1f}ms" for p in PERCENTILES)
+          + f"  errors {result['error_rate']:6.1%}")
+    return result
+
+def run_load_test(operations=200, concurrency=8, fault_rate=0.05, latency=0.02, seed=0):
+    """
+    Start both fake servers, point the stages at them and load every network stage in turn.
+    :return: List of result dicts
+    """
+    faults = dict(latency=latency, jitter=latency / 2, throttle_rate=fault_rate / 2, error_rate=fault_rate / 2,
+                  maxlag_rate=fault_rate, seed=seed)
+    wiki = FakeMediaWiki(Faults(**faults)).start()
+    whois_server = FakeWhois(Faults(**faults)).start()
+    print(f"Fake MediaWiki at {wiki.api_url}, fake whois at {whois_server.address}")
+
+    stage1.API_URL = wiki.api_url
+    stage3.API_URL = wiki.api_url
+    stage4b.USE_WHOIS_BINARY = False
+    # the fake server answers without a referral, so it is the root and the registry
+    stage4b.whois_client = WhoisClient(whois_server.address, timeout=5)
+
+    categories = [f"Category:Load test {i}" for i in range(operations)]
+    # article URLs stay on en.wikipedia.org, only API_URL decides where requests go
+    articles = [stage1.article_url_from_title(f"Load test article {i}") for i in range(operations)]
+    rng = random.Random(seed)
+    networks = fixtures.make_networks(seed, 4)
+    ips = [fixtures.random_address(rng, networks) for _ in range(operations)]
+
+    results = []
+    workdir = os.getcwd()
+    with tempfile.TemporaryDirectory() as folder:
+        # full histories are written to the history store
+        os.chdir(folder)
+        session = stage3.create_session(concurrency)
+        try:
+            results.append(run_stage(
+                "extract_articles_from_category",
+                lambda category: stage1.extract_articles_from_category(f"{wiki.base_url}/wiki/{category.replace(' ', '_')}"),
+                len, categories, concurrency, wiki.stats))
+            results.append(run_stage(
+                "get_category_members",
+                lambda category: stage1.get_category_members(category, session),
+                lambda members: members[0], categories, concurrency, wiki.stats))
+            results.append(run_stage(
+                "get_wikipedia_article_history",
+                lambda url: stage3.get_wikipedia_article_history(url, 250, session),
+                len, articles, concurrency, wiki.stats))
+            results.append(run_stage(
+                "download_full_history",
+                lambda url: stage3.download_full_history(url, session),
+                lambda saved: saved[1], articles, concurrency, wiki.stats))
+            results.append(run_stage(
+                "run_whois",
+                stage4b.run_whois,
+                lambda values: values.iloc[0] is not None, ips, concurrency, whois_server.stats))
+        finally:
+            session.close()
+            os.chdir(workdir)
+            wiki.stop()
+            whois_server.stop()
+    return results
+
+def main():
+    operations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    fault_rate = float(sys.argv[3]) if len(sys.argv) > 3 else 0.05
+    latency = float(sys.argv[4]) / 1000 if len(sys.argv) > 4 else 0.02
+    output = sys.argv[5] if len(sys.argv) > 5 else None
+
+    started_at = datetime.now(timezone.utc)
+    stages = run_load_test(operations, concurrency, fault_rate, latency)
+    report = {
+        "commit": git_commit(),
+        "started_at": started_at.isoformat(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "operations": operations,
+        "concurrency": concurrency,
+        "fault_rate": fault_rate,
+        "latency_seconds": latency,
+        "stages": stages,
+    }
+
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"load_{started_at.strftime('%Y%m%d%H%M%S')}_{(report['commit'] or 'unknown')[:8]}.json")
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results saved to {output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+# offline benchmarks of the pipeline stages on seeded synthetic data
+# usage: python benchmarks/run_benchmarks.py [articles] [repeats] [output json]
+#        python benchmarks/run_benchmarks.py compare old.json new.json
+# results are written as JSON to benchmarks/results/ unless an output path is given
+import importlib
+import ipaddress
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+# the stage scripts are one folder up and start with a digit
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, REPO_DIR)
+
+import pandas as pd
+
+import fixtures
+import history_store
+from bench_is_anon import make_users
+from cidr_index import build_cidr_index, build_temporal_index, resolve_countries
+
+stage4 = importlib.import_module("4_summany_whois")
+stage4b = importlib.import_module("4b_whois_enrich")
+stage5 = importlib.import_module("5_csv_combine")
+stage6 = importlib.import_module("6_country_ip_blocks_query")
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+# benchmarks slower than this factor of the old run are flagged by compare
+REGRESSION_FACTOR = 1.1
+
+def measure(name, function, items, repeats, setup=None, **params):
+    """
+    Time a benchmark a few times.
+    :param function: Called without arguments, its return value is ignored
+    :param items: Number of things processed per call, for the throughput
+    :param setup: Called before every run, not timed
+    :param params: Extra values saved with the result
+    :return: Result dict
+    """
+    times = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        started = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - started)
+
+    result = {
+        "name": name,
+        "repeats": repeats,
+        "seconds_min": min(times),
+        "seconds_median": statistics.median(times),
+        "items": items,
+        "items_per_second": items / min(times) if min(times) > 0 else None,
+        "params": params,
+    }
+    print(f"{name:<32} {min(times):9.4f}s min {statistics.median(times):9.4f}s median {items:>9} items")
+    return result
+
+# the linear scan over the .cidr files stage 6 used before cidr_index.py, kept as the baseline,
+# in sorted file order so it finds the same files as the index
+def find_ip_in_cidr_files(ip, base_folder):
+    try:
+        target_ip = ipaddress.ip_address(ip)
+        folder_type = "ipv4" if target_ip.version == 4 else "ipv6"
+        folder_path = os.path.join(base_folder, folder_type)
+
+        if not os.path.exists(folder_path):
+            print(f"Error: Folder '{folder_path}' does not exist.")
+            return None
+
+        for file in sorted(os.listdir(folder_path)):
+            if file.endswith(".cidr"):
+                file_path = os.path.join(folder_path, file)
+                with open(file_path, "r") as f:
+                    for line in f:
+                        cidr = line.strip()
+                        if cidr:
+                            try:
+                                if target_ip in ipaddress.ip_network(cidr, strict=False):
+                                    # print(f"IP {ip} found in {file}")
+                                    return file
+                            except ValueError:
+                                print(f"Skipping invalid CIDR: {cidr} in {file}")
+
+        print(f"IP {ip} not found in any CIDR file.")
+        return None
+
+    except ValueError:
+        print(f"Error: '{ip}' is not a valid IP address.")
+        return None
+
+def process_and_save_all(history_files):
+    # one file at a time, the summary so far passed along like stage 4's main() used to
+    df_per_page = stage4.empty_summary()
+    for path in history_files:
+        df_per_page = stage4.process_and_save(path, df_per_page)
+    return df_per_page
+
+def quiet(function):
+    # the stages print a line per file, keep the benchmark output readable
+    def run():
+        with open(os.devnull, "w") as devnull:
+            stdout = sys.stdout
+            sys.stdout = devnull
+            try:
+                return function()
+            finally:
+                sys.stdout = stdout
+    return run
+
+def git_commit():
+    result = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True)
+    return result.stdout.strip() or None
+
+def run_benchmarks(articles=500, repeats=3, seed=0):
+    """
+    Generate the fixtures in a temporary folder and run every benchmark there.
+    :return: List of result dicts
+    """
+    results = []
+    workdir = os.getcwd()
+    with tempfile.TemporaryDirectory() as folder:
+        os.chdir(folder)
+        try:
+            networks = fixtures.make_networks(seed)
+            revisions = fixtures.make_histories(articles, seed, networks)
+            history_files = history_store.list_history_files()
+            print(f"{articles} synthetic histories in {len(history_files)} files with {revisions} revisions in {folder}")
+
+            users = make_users(1_000_000, 50_000, seed)
+            results.append(measure("classify_anon", lambda: stage4.classify_anon(users), len(users), repeats))
+
+            results.append(measure("process_and_save", quiet(lambda: process_and_save_all(history_files)),
+                                   articles, repeats, revisions=revisions))
+            results.append(measure("summarize_histories", quiet(lambda: stage4.summarize_histories(history_files)),
+                                   articles, repeats, revisions=revisions))
+            if history_store.USE_PARQUET:
+                # the same histories as one CSV per article, to compare the store with the old layout
+                os.makedirs("csv_layout")
+                os.chdir("csv_layout")
+                history_store.USE_PARQUET = False
+                try:
+                    fixtures.make_histories(articles, seed, networks)
+                    csv_files = [os.path.abspath(path) for path in history_store.list_history_files()]
+                finally:
+                    history_store.USE_PARQUET = True
+                    os.chdir(folder)
+                results.append(measure("summarize_histories_csv", quiet(lambda: stage4.summarize_histories(csv_files)),
+                                       articles, repeats, revisions=revisions))
+
+            # whois from canned answers, the cache starts empty every run
+            stage4b.query_whois = fixtures.canned_whois
+            stage4b.WHOIS_WORKERS = 1
+            def reset_whois_cache():
+                for suffix in ("", "-wal", "-shm"):
+                    if os.path.exists(stage4b.WHOIS_CACHE_PATH + suffix):
+                        os.remove(stage4b.WHOIS_CACHE_PATH + suffix)
+            sys.argv = ["4b_whois_enrich.py", "all"]
+            anon_tables = len(os.listdir(stage4b.ANON_EDITS_DIR))
+            results.append(measure("whois_enrich", quiet(stage4b.main), anon_tables, repeats, setup=reset_whois_cache))
+
+            for file_format in (["csv", "parquet"] if history_store.USE_PARQUET else ["csv"]):
+                results.append(measure(f"append_csv_files_{file_format}", quiet(lambda: stage5.append_csv_files(
+                    "./whois_results", "./whois_results", history_store.WHOIS_RESULT_DTYPES, file_format)),
+                    anon_tables, repeats))
+            whois_df = history_store.read_table("./whois_results", dtype=history_store.WHOIS_RESULT_DTYPES)
+
+            fixtures.make_country_repo("country-ip-blocks", 6, seed, networks)
+            ips = whois_df["user"].drop_duplicates().head(200).tolist()
+            results.append(measure("find_ip_in_cidr_files", quiet(lambda: [find_ip_in_cidr_files(ip, "country-ip-blocks") for ip in ips]),
+                                   len(ips), repeats))
+            def cidr_index_lookups():
+                index = build_cidr_index("country-ip-blocks")
+                return [index.lookup(ip) for ip in ips]
+            results.append(measure("cidr_index_build_and_lookup", cidr_index_lookups, len(ips), repeats))
+
+            commits = stage6.get_all_commits("country-ip-blocks")
+            index = build_temporal_index("country-ip-blocks", commits)
+            results.append(measure("resolve_countries", lambda: resolve_countries(index, whois_df["user"], whois_df["timestamp"]),
+                                   whois_df.shape[0], repeats))
+
+            # stage 8 aggregations over the resolved rows
+            second = whois_df.copy()
+            second["file"] = [str(file) for file in resolve_countries(index, second["user"], second["timestamp"])]
+            try:
+                stage8 = importlib.import_module("8_second_stats")
+            except ImportError as e:
+                print(f"Skipping stage 8 benchmarks: {e}")
+            else:
+                results.append(measure("stage8_extract_country_code", lambda: second["file"].apply(stage8.extract_country_code),
+                                       second.shape[0], repeats))
+                second["file"] = second["file"].apply(stage8.extract_country_code)
+                results.append(measure("stage8_contributions_by_file", lambda: stage8.contributions_by_file(second),
+                                       second.shape[0], repeats))
+        finally:
+            os.chdir(workdir)
+    return results
+
+def compare(old_path, new_path):
+    """
+    Print the change of every benchmark between two result files.
+    :return: Names of the benchmarks that got slower than REGRESSION_FACTOR
+    """
+    with open(old_path) as f:
+        old = {result["name"]: result for result in json.load(f)["benchmarks"]}
+    with open(new_path) as f:
+        new = {result["name"]: result for result in json.load(f)["benchmarks"]}
+
+    regressions = []
+    for name, result in new.items():
+        if name not in old:
+            print(f"{name:<32} new")
+            continue
+        ratio = result["seconds_min"] / old[name]["seconds_min"]
+        flag = ""
+        if ratio > REGRESSION_FACTOR:
+            flag = " REGRESSION"
+            regressions.append(name)
+        print(f"{name:<32} {old[name]['seconds_min']:9.4f}s -> {result['seconds_min']:9.4f}s ({ratio:.2f}x){flag}")
+    return regressions
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "compare":
+        regressions = compare(sys.argv[2], sys.argv[3])
+        sys.exit(1 if regressions else 0)
+
+    articles = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    output = sys.argv[3] if len(sys.argv) > 3 else None
+    seed = 0
+
+    started_at = datetime.now(timezone.utc)
+    benchmarks = run_benchmarks(articles, repeats, seed)
+    report = {
+        "commit": git_commit(),
+        "started_at": started_at.isoformat(),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "parquet": history_store.USE_PARQUET,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "articles": articles,
+        "seed": seed,
+        "benchmarks": benchmarks,
+    }
+
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"bench_{started_at.strftime('%Y%m%d%H%M%S')}_{(report['commit'] or 'unknown')[:8]}.json")
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results saved to {output}")
+
+if __name__ == "__main__":
+    main()
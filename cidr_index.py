@@ -0,0 +1,490 @@
+import bisect
+import gzip
+import heapq
+import ipaddress
+import json
+import os
+import subprocess
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+import metrics
+
+
+def cidr_to_range(cidr):
+    """
+    Convert a CIDR string into an inclusive (version, start, end) integer range.
+    :param cidr: CIDR block such as "1.0.1.0/24"
+    :return: Tuple of (ip version, first address, last address)
+    """
+    network = ipaddress.ip_network(cidr, strict=False)
+    return network.version, int(network.network_address), int(network.broadcast_address)
+
+
+def flatten_intervals(intervals):
+    """
+    Turn possibly overlapping intervals into sorted, disjoint ones.
+    Where intervals overlap the one with the lowest priority wins, which is how
+    a first-match scan over the files behaves.
+    :param intervals: List of (start, end, priority, value) with inclusive ends
+    :return: Tuple of (starts, ends, values) lists sorted by start
+    """
+    events = {}
+    for i, (start, end, _, _) in enumerate(intervals):
+        events.setdefault(start, []).append(i)
+        events.setdefault(end + 1, [])
+
+    starts, ends, values = [], [], []
+    active = []
+    points = sorted(events)
+    for point, next_point in zip(points, points[1:]):
+        for i in events[point]:
+            heapq.heappush(active, (intervals[i][2], i))
+        # drop intervals that ended before this segment
+        while active and intervals[active[0][1]][1] < point:
+            heapq.heappop(active)
+        if not active:
+            continue
+
+        value = intervals[active[0][1]][3]
+        if ends and values[-1] == value and ends[-1] + 1 == point:
+            ends[-1] = next_point - 1
+        else:
+            starts.append(point)
+            ends.append(next_point - 1)
+            values.append(value)
+
+    return starts, ends, values
+
+
+class CidrIndex:
+    """
+    Sorted interval index over one snapshot of the country-ip-blocks repo.
+    IPv4 and IPv6 are kept in separate start/end arrays (IPv6 as 128-bit ints)
+    with a parallel array of the .cidr file each range came from.
+    """
+
+    def __init__(self, intervals_v4=(), intervals_v6=()):
+        self.tables = {
+            4: flatten_intervals(list(intervals_v4)),
+            6: flatten_intervals(list(intervals_v6)),
+        }
+        # IPv4 bounds as numpy arrays for lookup_many, built once per snapshot
+        self.v4_starts = np.array(self.tables[4][0], dtype=np.int64)
+        self.v4_ends = np.array(self.tables[4][1], dtype=np.int64)
+
+    def __len__(self):
+        return len(self.tables[4][0]) + len(self.tables[6][0])
+
+    def lookup_int(self, version, value):
+        """
+        Find the file for an IP already converted to an integer.
+        :param version: 4 or 6
+        :param value: Integer value of the address
+        :return: File name such as "cn.cidr" or None
+        """
+        starts, ends, values = self.tables[version]
+        i = bisect.bisect_right(starts, value) - 1
+        if i >= 0 and value <= ends[i]:
+            return values[i]
+        return None
+
+    def lookup_many(self, versions, values):
+        """
+        Find the files for many IPs at once. IPv4 goes through numpy.searchsorted,
+        IPv6 values do not fit numpy integers so they are bisected one by one.
+        :param versions: Sequence of 4 or 6
+        :param values: Sequence of integer addresses
+        :return: List of file names or None
+        """
+        versions = np.asarray(versions)
+        results = [None] * len(versions)
+
+        files = self.tables[4][2]
+        is_v4 = np.flatnonzero(versions == 4)
+        if len(is_v4) and len(self.v4_starts):
+            v4_values = np.array([values[i] for i in is_v4], dtype=np.int64)
+            found = np.searchsorted(self.v4_starts, v4_values, side="right") - 1
+            hit = (found >= 0) & (v4_values <= self.v4_ends[np.maximum(found, 0)])
+            for i, position, matched in zip(is_v4, found, hit):
+                if matched:
+                    results[i] = files[position]
+
+        for i in np.flatnonzero(versions == 6):
+            results[i] = self.lookup_int(6, values[i])
+        return results
+
+    def lookup(self, ip):
+        """
+        Find the .cidr file whose blocks contain an IP address.
+        :param ip: IP address string
+        :return: File name such as "cn.cidr" or None if not found or invalid
+        """
+        try:
+            target_ip = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        return self.lookup_int(target_ip.version, int(target_ip))
+
+
+def read_cidr_lines(lines, file, version, priority, intervals):
+    # parse the lines of one .cidr file into intervals, same skipping rules as the linear scan
+    for line in lines:
+        cidr = line.strip()
+        if cidr:
+            try:
+                cidr_version, start, end = cidr_to_range(cidr)
+            except ValueError:
+                print(f"Skipping invalid CIDR: {cidr} in {file}")
+                continue
+            if cidr_version == version:
+                intervals.append((start, end, priority, file))
+
+
+def build_cidr_index(base_folder):
+    """
+    Load a checked out country-ip-blocks snapshot into a CidrIndex.
+    Where blocks of several files overlap, the file first in sorted name
+    order wins, the same as in the snapshots of TemporalCidrIndex.
+    :param base_folder: Path containing the ipv4 and ipv6 folders
+    :return: CidrIndex
+    """
+    intervals = {4: [], 6: []}
+    for version in (4, 6):
+        folder_path = os.path.join(base_folder, f"ipv{version}")
+        if not os.path.exists(folder_path):
+            print(f"Error: Folder '{folder_path}' does not exist.")
+            continue
+
+        # sorted, listdir order depends on the file system
+        for priority, file in enumerate(sorted(os.listdir(folder_path))):
+            if file.endswith(".cidr"):
+                with open(os.path.join(folder_path, file), "r") as f:
+                    read_cidr_lines(f, file, version, priority, intervals[version])
+
+    return CidrIndex(intervals[4], intervals[6])
+
+
+def to_epoch(timestamp):
+    """
+    Convert a timestamp into epoch seconds, naive times are taken as UTC.
+    :param timestamp: ISO 8601 string or datetime (pandas Timestamps work too)
+    :return: Seconds since the epoch with their fraction, None for a missing timestamp
+    """
+    if timestamp is None or (not isinstance(timestamp, str) and pd.isna(timestamp)):
+        return None
+    if isinstance(timestamp, str):
+        timestamp = datetime.fromisoformat(timestamp)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp.timestamp()
+
+
+def encode_ranges(starts, ends):
+    # delta encode sorted ranges as [gap from previous end, length] pairs
+    encoded = []
+    previous = 0
+    for start, end in zip(starts, ends):
+        encoded.append([start - previous, end - start])
+        previous = end
+    return encoded
+
+
+def decode_ranges(encoded):
+    starts, ends = [], []
+    previous = 0
+    for gap, length in encoded:
+        start = previous + gap
+        starts.append(start)
+        ends.append(start + length)
+        previous = start + length
+    return starts, ends
+
+
+def parse_cidr_blob(text, file, version):
+    """
+    Parse the content of one .cidr file into sorted, merged ranges.
+    :return: Tuple of (starts, ends)
+    """
+    intervals = []
+    read_cidr_lines(text.splitlines(), file, version, 0, intervals)
+    starts, ends, _ = flatten_intervals(intervals)
+    return starts, ends
+
+
+class GitBlobReader:
+    """
+    Reads blobs straight out of the git object store with a single long running
+    `git cat-file --batch` process, so no checkout is ever needed.
+    """
+
+    def __init__(self, repo_path):
+        self.repo_path = repo_path
+        self.process = subprocess.Popen(
+            ["git", "cat-file", "--batch"],
+            cwd=repo_path,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+
+    def read(self, sha):
+        metrics.count("git_operations")
+        metrics.count("git_blobs_read")
+        self.process.stdin.write(sha.encode() + b"\n")
+        self.process.stdin.flush()
+        header = self.process.stdout.readline().decode().split()
+        if len(header) != 3:
+            raise ValueError(f"Could not read blob {sha}: {' '.join(header)}")
+        content = self.process.stdout.read(int(header[2]))
+        self.process.stdout.read(1)
+        return content.decode("utf-8", errors="replace")
+
+    def list_cidr_files(self, commit):
+        """
+        List the .cidr files of a commit without checking it out.
+        :return: Dict of path such as "ipv4/cn.cidr" to blob sha
+        """
+        metrics.count("git_operations")
+        result = subprocess.run(
+            ["git", "ls-tree", "-r", "--full-tree", commit, "--", "ipv4", "ipv6"],
+            cwd=self.repo_path,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            check=True,
+        )
+        files = {}
+        for line in result.stdout.splitlines():
+            info, path = line.split("\t", 1)
+            _, kind, sha = info.split()
+            folder, _, file = path.partition("/")
+            # only files directly inside ipv4/ and ipv6/, like the folder scan
+            if kind == "blob" and file.endswith(".cidr") and "/" not in file:
+                files[path] = sha
+        return files
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+
+class TemporalCidrIndex:
+    """
+    Geo-IP index over every snapshot of the country-ip-blocks repo.
+    Snapshots are stored as per-file deltas between commits and each distinct
+    .cidr blob is parsed once. lookup(ip, timestamp) picks the latest commit
+    strictly before the timestamp and bisects into
+    that snapshot's CidrIndex, which is built on first use and kept in an LRU.
+    """
+
+    def __init__(self, cache_size=8):
+        self.times = []
+        self.commits = []
+        self.snapshots = []
+        self.blobs = {}
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    def add_commit(self, epoch, commit, files):
+        # files maps path -> blob sha, commits have to be added oldest first
+        if self.times and epoch < self.times[-1]:
+            raise ValueError(f"Commit {commit} is older than the last indexed commit")
+        self.times.append(epoch)
+        self.commits.append(commit)
+        self.snapshots.append(tuple(sorted(files.items())))
+
+    def snapshot_at(self, timestamp):
+        """
+        Find the snapshot used for a timestamp.
+        :return: Snapshot position or -1 if there is no earlier commit or no timestamp
+        """
+        epoch = to_epoch(timestamp)
+        if epoch is None:
+            return -1
+        return bisect.bisect_left(self.times, epoch) - 1
+
+    def snapshot_index(self, position):
+        """
+        Get the CidrIndex of a snapshot, building it from the parsed blobs if needed.
+        Where blocks of several files overlap, the file first in sorted name
+        order wins, the same as in build_cidr_index.
+        """
+        if position in self.cache:
+            self.cache.move_to_end(position)
+            return self.cache[position]
+
+        intervals = {4: [], 6: []}
+        # snapshots are sorted by path, so within ipv4/ and ipv6/ by file name
+        for priority, (path, sha) in enumerate(self.snapshots[position]):
+            version = 4 if path.startswith("ipv4/") else 6
+            file = path.split("/", 1)[1]
+            starts, ends = self.blobs[sha]
+            intervals[version].extend(
+                (start, end, priority, file) for start, end in zip(starts, ends)
+            )
+        index = CidrIndex(intervals[4], intervals[6])
+
+        self.cache[position] = index
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return index
+
+    def lookup(self, ip, timestamp):
+        """
+        Find the .cidr file containing an IP at a point in time.
+        :param ip: IP address string
+        :param timestamp: Time of the edit
+        :return: File name such as "cn.cidr" or None
+        """
+        position = self.snapshot_at(timestamp)
+        if position < 0:
+            return None
+        return self.snapshot_index(position).lookup(ip)
+
+    def save(self, path):
+        """
+        Write the index as gzipped JSON: blobs as delta encoded ranges and each
+        commit as the files changed (or removed) since the previous commit.
+        """
+        commits = []
+        previous = {}
+        for epoch, commit, snapshot in zip(self.times, self.commits, self.snapshots):
+            current = dict(snapshot)
+            changed = {p: s for p, s in current.items() if previous.get(p) != s}
+            removed = [p for p in previous if p not in current]
+            commits.append([epoch, commit, changed, removed])
+            previous = current
+
+        data = {
+            "version": 1,
+            "commits": commits,
+            "blobs": {sha: encode_ranges(*ranges) for sha, ranges in self.blobs.items()},
+        }
+        tmp_path = path + ".tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            json.dump(data, f, separators=(",", ":"))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, cache_size=8):
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            data = json.load(f)
+
+        index = cls(cache_size)
+        index.blobs = {sha: decode_ranges(ranges) for sha, ranges in data["blobs"].items()}
+        files = {}
+        for epoch, commit, changed, removed in data["commits"]:
+            files.update(changed)
+            for p in removed:
+                del files[p]
+            index.add_commit(epoch, commit, files)
+        return index
+
+
+def build_temporal_index(repo_path, commits_df, existing=None):
+    """
+    Build a TemporalCidrIndex by reading .cidr blobs from git objects.
+    :param repo_path: Path to the country-ip-blocks git repo
+    :param commits_df: DataFrame from get_all_commits with timestamp and commit columns
+    :param existing: Previously built index to extend with newer commits only
+    :return: TemporalCidrIndex
+    """
+    index = existing if existing is not None else TemporalCidrIndex()
+    known = set(index.commits)
+    commits = sorted(
+        (to_epoch(timestamp), commit)
+        for timestamp, commit in zip(commits_df["timestamp"], commits_df["commit"])
+        if commit not in known
+    )
+    if index.times:
+        commits = [(epoch, commit) for epoch, commit in commits if epoch >= index.times[-1]]
+
+    reader = GitBlobReader(repo_path)
+    progress = metrics.progress("commits_indexed", len(commits))
+    try:
+        for i, (epoch, commit) in enumerate(commits):
+            files = reader.list_cidr_files(commit)
+            for path, sha in files.items():
+                if sha not in index.blobs:
+                    version = 4 if path.startswith("ipv4/") else 6
+                    text = reader.read(sha)
+                    index.blobs[sha] = parse_cidr_blob(text, path.split("/", 1)[1], version)
+            index.add_commit(epoch, commit, files)
+            progress.update()
+
+            if (i + 1) % 100 == 0:
+                print(f"Indexed {i + 1}/{len(commits)} commits, {len(index.blobs)} distinct blobs")
+    finally:
+        reader.close()
+
+    return index
+
+
+def load_or_build_temporal_index(index_path, repo_path, commits_df):
+    """
+    Load the saved temporal index, extend it with any new commits and save it back.
+    """
+    existing = None
+    if os.path.exists(index_path):
+        existing = TemporalCidrIndex.load(index_path)
+    known = len(existing.commits) if existing is not None else 0
+
+    index = build_temporal_index(repo_path, commits_df, existing)
+    if len(index.commits) != known:
+        index.save(index_path)
+        print(f"Saved index of {len(index.commits)} commits to {index_path}")
+    return index
+
+
+def parse_ip(ip):
+    # (version, integer value) of an address, (0, 0) if it is not one
+    try:
+        target_ip = ipaddress.ip_address(ip)
+    except ValueError:
+        return 0, 0
+    return target_ip.version, int(target_ip)
+
+
+def resolve_countries(index, ips, timestamps):
+    """
+    Resolve the .cidr file of many (ip, timestamp) pairs in one batch.
+    All timestamps are matched to snapshots with one as-of search over the
+    commit times, (ip, snapshot) pairs are deduplicated and each snapshot's
+    distinct IPs are looked up together.
+    :param index: TemporalCidrIndex
+    :param ips: Sequence of IP address strings
+    :param timestamps: Sequence of edit timestamps
+    :return: numpy object array of file names, None where nothing matched
+    """
+    times = pd.to_datetime(pd.Series(timestamps), utc=True)
+    # fractional seconds like to_epoch, so both pick the same snapshot for an edit in the second of a commit
+    epochs = ((times - pd.Timestamp(0, tz="UTC")) / pd.Timedelta(seconds=1)).to_numpy(dtype=np.float64, na_value=np.nan)
+    positions = np.searchsorted(np.array(index.times, dtype=np.float64), epochs, side="left") - 1
+    # missing timestamps have no snapshot
+    positions[np.isnan(epochs)] = -1
+
+    ip_codes, unique_ips = pd.factorize(pd.Series(ips))
+    # missing IPs get their own code past the real ones and never match
+    ip_codes[ip_codes < 0] = len(unique_ips)
+    keys = positions.astype(np.int64) * (len(unique_ips) + 1) + ip_codes
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    key_positions = unique_keys // (len(unique_ips) + 1)
+    key_ips = unique_keys % (len(unique_ips) + 1)
+    parsed = [parse_ip(ip) for ip in unique_ips]
+
+    resolved = np.full(len(unique_keys), None, dtype=object)
+    # unique keys are sorted by snapshot, so each snapshot is one contiguous block
+    bounds = np.flatnonzero(np.diff(key_positions)) + 1
+    for block in np.split(np.arange(len(unique_keys)), bounds):
+        if not len(block) or key_positions[block[0]] < 0:
+            continue
+        snapshot = index.snapshot_index(int(key_positions[block[0]]))
+        block = block[key_ips[block] < len(unique_ips)]
+        versions = [parsed[key_ips[i]][0] for i in block]
+        values = [parsed[key_ips[i]][1] for i in block]
+        resolved[block] = snapshot.lookup_many(versions, values)
+
+    return resolved[inverse]
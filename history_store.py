@@ -0,0 +1,550 @@
+import hashlib
+import os
+import threading
+import urllib.parse
+import zlib
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# the columnar store is used when pyarrow is installed, otherwise everything stays CSV
+USE_PARQUET = pa is not None
+
+CSV_DIR = "wikipedia_histories"
+# a Parquet dataset partitioned on a hash bucket of the article url, every
+# partition is one file part=NN/histories.parquet holding many articles
+STORE_DIR = "wikipedia_histories_store"
+# histories are spread over this many partitions by a hash of the article url
+PARTITIONS = 64
+HISTORY_FILE = "histories.parquet"
+# histories written by stage 3 wait here until compact_histories merges them into
+# their partitions, the leading underscore keeps them out of dataset scans
+STAGING_DIR = os.path.join(STORE_DIR, "_staging")
+# rows per row group of a partition file, articles are sorted by url
+ROW_GROUP_SIZE = 64 * 1024
+
+HISTORY_COLUMNS = ["url", "rev_id", "timestamp", "user", "comment", "size", "tags"]
+
+HISTORY_DTYPES = {
+    "url": pd.StringDtype(),
+    "rev_id": pd.Int64Dtype(),
+    "timestamp": pd.StringDtype(),
+    "user": pd.StringDtype(),
+    "comment": pd.StringDtype(),
+    "size": pd.Int64Dtype(),
+    "tags": pd.StringDtype()
+}
+
+# strings read_csv turns into missing values, the store keeps them missing too
+# so both formats give the same frames (e.g. the 'N/A' placeholders of stage 3)
+CSV_NA_VALUES = [
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN",
+    "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null"
+]
+
+# whois results as stages 5, 6 and 8 read them, timestamps and time diffs are kept
+# as text so CSV and Parquet inputs give the same values
+WHOIS_RESULT_DTYPES = {
+    "url": pd.StringDtype(),
+    "rev_id": pd.Int64Dtype(),
+    "timestamp": pd.StringDtype(),
+    "user": pd.StringDtype(),
+    "comment": pd.StringDtype(),
+    "size": pd.Int64Dtype(),
+    "tags": pd.StringDtype(),
+    "size_diff": pd.Int64Dtype(),
+    "time_diff": pd.StringDtype(),
+    "is_anon": pd.BooleanDtype(),
+    "country": pd.StringDtype(),
+    "org": pd.StringDtype(),
+    "inet": pd.StringDtype()
+}
+
+# per-article summaries of stage 4
+SUMMARY_DTYPES = {
+    "url": pd.StringDtype(),
+    "num_contrib": pd.Int64Dtype(),
+    "time_diff_avg": "timedelta64[us]",
+    "anon_num": pd.Int64Dtype(),
+    "named_num": pd.Int64Dtype(),
+    "anon_contrib": pd.Int64Dtype(),
+    "named_contrib": pd.Int64Dtype(),
+    "anon_diff_avg": pd.Float64Dtype(),
+    "named_diff_avg": pd.Float64Dtype()
+}
+
+# parsed timestamps get the same dtype whichever format they were read from
+TIMESTAMP_DTYPE = pd.to_datetime(pd.Series(["1970-01-01T00:00:00Z"])).dtype
+
+if pa is not None:
+    # url, user and tags repeat a lot so they are dictionary encoded,
+    # timestamps are stored as int64 seconds since the epoch
+    HISTORY_SCHEMA = pa.schema([
+        ("url", pa.dictionary(pa.int32(), pa.string())),
+        ("rev_id", pa.int64()),
+        ("timestamp", pa.int64()),
+        ("user", pa.dictionary(pa.int32(), pa.string())),
+        ("comment", pa.string()),
+        ("size", pa.int64()),
+        ("tags", pa.dictionary(pa.int32(), pa.string())),
+    ])
+
+
+def safe_title(url):
+    # file name safe title of an article url, the same as stage 3 names its CSVs
+    title = urllib.parse.unquote(urllib.parse.urlparse(url).path.split("/wiki/", 1)[-1])
+    return ''.join(c if c.isalnum() or c in ['-', '_'] else '_' for c in title)
+
+
+def partition_of(url):
+    return zlib.crc32(url.encode("utf-8")) % PARTITIONS
+
+
+def partition_path(partition):
+    return os.path.join(STORE_DIR, f"part={partition:02d}", HISTORY_FILE)
+
+
+def history_path(url, safe_title):
+    """
+    Get the path an article's history is stored at.
+    :param url: Article url, hashed to pick the partition
+    :param safe_title: File name safe article title
+    :return: Path of the partition file (or the .csv without pyarrow)
+    """
+    if USE_PARQUET:
+        return partition_path(partition_of(url))
+    return f"{CSV_DIR}/{safe_title}.csv"
+
+
+def history_name(path, url=None):
+    """
+    Get the name one article's history goes by downstream, e.g. for its
+    anonymous edits: the CSV file name, or the safe title of the url for
+    an article in the store.
+    """
+    if path.endswith(".parquet"):
+        return safe_title(url)
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def staged_path(url, mode):
+    # "replace" swaps the stored history for the staged one, "prepend" puts it in front
+    digest = hashlib.sha1(url.encode("utf-8")).hexdigest()
+    return os.path.join(STAGING_DIR, f"part={partition_of(url):02d}", f"{digest}.{mode}.parquet")
+
+
+def staged_history(url):
+    # staged history of an article not merged yet, None if there is none
+    for mode in ("replace", "prepend"):
+        if os.path.exists(staged_path(url, mode)):
+            return staged_path(url, mode), mode
+    return None
+
+
+def history_dataset(partitions=None):
+    """
+    Open the partition files as a pyarrow dataset, the part column comes from their folders.
+    :param partitions: Partition numbers to include, None for all
+    :return: pyarrow.dataset.Dataset or None if there are no partition files
+    """
+    partitions = range(PARTITIONS) if partitions is None else partitions
+    paths = [partition_path(p) for p in partitions if os.path.exists(partition_path(p))]
+    if not paths:
+        return None
+    return ds.dataset(paths, format="parquet", partitioning="hive", partition_base_dir=STORE_DIR)
+
+
+def scan_partition(partition, columns=None):
+    """
+    Read one partition with a filtered dataset scan.
+    :return: pyarrow.Table with the history columns, None if the partition is empty
+    """
+    dataset = history_dataset([partition])
+    if dataset is None:
+        return None
+    table = dataset.to_table(columns=columns or HISTORY_COLUMNS, filter=ds.field("part") == partition)
+    return table.cast(pa.schema([HISTORY_SCHEMA.field(name) for name in table.column_names]))
+
+
+def partition_of_path(path):
+    # partition number of a part=NN/histories.parquet path
+    return int(os.path.basename(os.path.dirname(path)).split("=", 1)[1])
+
+
+def rows_to_table(rows):
+    # revision rows from stage 3 into an arrow table with the history schema
+    df = pd.DataFrame(rows, columns=HISTORY_COLUMNS)
+    timestamps = pd.to_datetime(df["timestamp"], utc=True, errors="coerce")
+    df["timestamp"] = ((timestamps - pd.Timestamp(0, tz="UTC")) // pd.Timedelta(seconds=1)).astype(pd.Int64Dtype())
+    df["rev_id"] = pd.to_numeric(df["rev_id"], errors="coerce").astype(pd.Int64Dtype())
+    df["size"] = pd.to_numeric(df["size"], errors="coerce").astype(pd.Int64Dtype())
+    for column in ["url", "user", "comment", "tags"]:
+        df[column] = df[column].astype(pd.StringDtype())
+        df.loc[df[column].isin(CSV_NA_VALUES), column] = pd.NA
+    return pa.Table.from_pandas(df, preserve_index=False).cast(HISTORY_SCHEMA)
+
+
+class HistoryWriter:
+    """
+    Writes one article's history page by page to a temporary file that only
+    replaces the real one on commit, so a failed download never leaves a
+    truncated history. CSV pages are appended to the article's file. For the
+    store, pages become row groups of a staged file, which compact_histories
+    merges into the article's partition.
+    """
+
+    def __init__(self, path, url=None):
+        """
+        :param path: From history_path
+        :param url: Article url, needed for the store
+        """
+        self.path = path
+        self.url = url
+        self.stored = path.endswith(".parquet")
+        # staged as a replacement unless copy_from keeps the stored rows
+        self.mode = "replace"
+        self.part_path = staged_path(url, "replace") + ".part" if self.stored else path + ".part"
+        self.count = 0
+        self.file = None
+        self.writer = None
+        os.makedirs(os.path.dirname(self.part_path), exist_ok=True)
+
+    def write(self, rows):
+        if not rows:
+            return
+        if self.path.endswith(".parquet"):
+            if self.writer is None:
+                self.writer = pq.ParquetWriter(self.part_path, HISTORY_SCHEMA)
+            self.writer.write_table(rows_to_table(rows))
+        else:
+            if self.file is None:
+                self.file = open(self.part_path, 'w', newline='', encoding='utf-8')
+            pd.DataFrame(rows).to_csv(self.file, header=self.count == 0, index=False)
+        self.count += len(rows)
+
+    def copy_from(self, path):
+        """
+        Append every row of an existing history without parsing it into rows.
+        In the store the stored rows stay where they are and the written ones
+        are merged in front of them.
+        """
+        if self.stored:
+            self.mode = "prepend"
+        else:
+            with open(path, newline='', encoding='utf-8') as f:
+                header = next(f)
+                if self.file is None:
+                    self.file = open(self.part_path, 'w', newline='', encoding='utf-8')
+                    self.file.write(header)
+                for line in f:
+                    self.file.write(line)
+                    self.count += 1
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def commit(self):
+        """
+        Move the written history into place.
+        :return: True if anything was written
+        """
+        self.close()
+        if self.count == 0:
+            self.abort()
+            return False
+        if not self.stored:
+            os.replace(self.part_path, self.path)
+            return True
+        # a leftover of the other mode would be merged too
+        for mode in ("replace", "prepend"):
+            if mode != self.mode and os.path.exists(staged_path(self.url, mode)):
+                os.remove(staged_path(self.url, mode))
+        os.replace(self.part_path, staged_path(self.url, self.mode))
+        return True
+
+    def abort(self):
+        self.close()
+        if os.path.exists(self.part_path):
+            os.remove(self.part_path)
+
+
+def read_history(path):
+    """
+    Read one history file with the dtypes stage 4 uses and parsed timestamps.
+    :param path: Partition file of the store, or a .csv with one article
+    :return: DataFrame, each article newest revision first
+    """
+    if path.endswith(".parquet"):
+        table = scan_partition(partition_of_path(path))
+        df = table.to_pandas() if table is not None else pd.DataFrame(columns=HISTORY_COLUMNS)
+        df["timestamp"] = pd.to_datetime(df["timestamp"], unit="s", utc=True).astype(TIMESTAMP_DTYPE)
+        return df.astype({k: v for k, v in HISTORY_DTYPES.items() if k != "timestamp"})
+
+    df = pd.read_csv(path, dtype=HISTORY_DTYPES)
+    df["timestamp"] = pd.to_datetime(df["timestamp"])
+    return df
+
+
+def format_revision(rev_id, timestamp):
+    # (rev_id, ISO timestamp) of a revision read from the store, None if either is missing
+    if rev_id is None or timestamp is None or pd.isna(rev_id) or pd.isna(timestamp):
+        return None
+    return int(rev_id), pd.Timestamp(int(timestamp), unit="s", tz="UTC").strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def first_revision(path):
+    # first row of a staged Parquet file, the newest revision
+    source = pq.ParquetFile(path)
+    if source.num_row_groups == 0:
+        return None
+    first = source.read_row_group(0, columns=["rev_id", "timestamp"]).slice(0, 1).to_pylist()
+    return format_revision(first[0]["rev_id"], first[0]["timestamp"]) if first else None
+
+
+# newest revision and revision count of the articles of a partition, read once per partition
+partition_summaries = {}
+partition_lock = threading.Lock()
+
+
+def partition_summary(partition):
+    """
+    :return: Dict of url to (newest revision or None, number of revisions) in the partition file
+    """
+    with partition_lock:
+        if partition not in partition_summaries:
+            summary = {}
+            table = scan_partition(partition, ["url", "rev_id", "timestamp"])
+            if table is not None and table.num_rows:
+                df = table.to_pandas()
+                df["url"] = df["url"].astype(str)
+                counts = df.groupby("url", sort=False).size()
+                # articles are stored newest first, so their first row is the newest
+                for row in df.drop_duplicates("url").itertuples(index=False):
+                    summary[row.url] = (format_revision(row.rev_id, row.timestamp), int(counts[row.url]))
+            partition_summaries[partition] = summary
+        return partition_summaries[partition]
+
+
+def newest_revision(path, url=None):
+    """
+    Get the newest stored revision of an article, histories are newest first.
+    A history staged for the store counts as stored.
+    :param url: Article url, needed for the store
+    :return: Tuple of (rev_id, ISO timestamp) or None
+    """
+    if path.endswith(".parquet"):
+        staged = staged_history(url)
+        if staged is not None:
+            return first_revision(staged[0])
+        return partition_summary(partition_of(url)).get(url, (None, 0))[0]
+
+    if not os.path.exists(path):
+        return None
+    df = pd.read_csv(path, nrows=1, dtype=HISTORY_DTYPES)
+    if df.empty or pd.isna(df["rev_id"].iloc[0]):
+        return None
+    return int(df["rev_id"].iloc[0]), df["timestamp"].iloc[0]
+
+
+def count_revisions(path, url=None):
+    if path.endswith(".parquet"):
+        stored = partition_summary(partition_of(url)).get(url, (None, 0))[1]
+        staged = staged_history(url)
+        if staged is None:
+            return stored
+        count = pq.ParquetFile(staged[0]).metadata.num_rows
+        return count + stored if staged[1] == "prepend" else count
+    return pd.read_csv(path, usecols=["rev_id"]).shape[0]
+
+
+def compact_histories():
+    """
+    Merge the staged histories into their partition files. Every touched
+    partition is rewritten once, sorted by url, under a temporary name that
+    replaces it when complete. The staged files are only deleted after that,
+    and merging them again gives the same result, so a crash loses nothing.
+    :return: Number of histories merged
+    """
+    if not os.path.exists(STAGING_DIR):
+        return 0
+    merged = 0
+    for folder in sorted(os.listdir(STAGING_DIR)):
+        staged = sorted(f for f in os.listdir(os.path.join(STAGING_DIR, folder)) if f.endswith(".parquet"))
+        if not staged:
+            continue
+        partition = int(folder.split("=", 1)[1])
+        staged_paths = [os.path.join(STAGING_DIR, folder, f) for f in staged]
+        tables = [pq.read_table(path).cast(HISTORY_SCHEMA) for path in staged_paths]
+
+        # replaced articles lose their stored rows, prepended ones only the revisions
+        # already merged by an earlier compaction that crashed before cleaning up
+        replaced = [t.column("url")[0].as_py() for f, t in zip(staged, tables) if f.endswith(".replace.parquet") and t.num_rows]
+        prepended = [t.column("rev_id") for f, t in zip(staged, tables) if f.endswith(".prepend.parquet")]
+        pieces = list(tables)
+        existing = scan_partition(partition)
+        if existing is not None:
+            keep = pc.invert(pc.is_in(existing.column("url").cast(pa.string()), value_set=pa.array(replaced, pa.string())))
+            if prepended:
+                rev_ids = pa.chunked_array(prepended).combine_chunks()
+                keep = pc.and_(keep, pc.invert(pc.is_in(existing.column("rev_id"), value_set=rev_ids)))
+            pieces.append(existing.filter(keep))
+
+        table = pa.concat_tables(pieces)
+        # stable, so every article keeps its rows newest first with the staged ones in front
+        table = table.take(pc.sort_indices(table.column("url").cast(pa.string())))
+        path = partition_path(partition)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if table.num_rows:
+            tmp_path = os.path.join(os.path.dirname(path), "_" + HISTORY_FILE + ".part")
+            pq.write_table(table.unify_dictionaries(), tmp_path, row_group_size=ROW_GROUP_SIZE)
+            os.replace(tmp_path, path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+        for staged_file in staged_paths:
+            os.remove(staged_file)
+        with partition_lock:
+            partition_summaries.pop(partition, None)
+        merged += len(staged_paths)
+    return merged
+
+
+def list_history_files():
+    """
+    List every history file, the partition files of the store or the
+    per-article CSVs sorted by file name, so start/end ranges in stage 4
+    stay stable.
+    :return: List of paths
+    """
+    if USE_PARQUET:
+        # one file per partition, in partition order
+        return [partition_path(p) for p in range(PARTITIONS) if os.path.exists(partition_path(p))]
+    else:
+        if not os.path.exists(CSV_DIR):
+            return []
+        paths = [os.path.join(CSV_DIR, f) for f in os.listdir(CSV_DIR) if f.lower().endswith(".csv")]
+    return sorted(paths, key=os.path.basename)
+
+
+def write_table(df, base, index=False):
+    """
+    Write an intermediate table (whois results, summaries, second) as Parquet
+    when available, otherwise CSV.
+    :param base: Path without extension
+    :return: Path written
+    """
+    if USE_PARQUET:
+        path = base + ".parquet"
+        df.to_parquet(path, index=index)
+    else:
+        path = base + ".csv"
+        df.to_csv(path, index=index)
+    return path
+
+
+def read_table(base, dtype=None):
+    """
+    Read a table written by write_table, preferring the Parquet copy.
+    :param base: Path without extension
+    :param dtype: Column dtypes, applied to the columns that exist
+    :return: DataFrame
+    """
+    if pa is not None and os.path.exists(base + ".parquet"):
+        df = pd.read_parquet(base + ".parquet")
+        if dtype:
+            df = df.astype({k: v for k, v in dtype.items() if k in df.columns})
+        return df
+    return pd.read_csv(base + ".csv", dtype=dtype)
+
+
+def apply_schema(df, dtypes):
+    """
+    Give a table exactly the declared columns, in order and with their dtypes.
+    Missing columns are added empty, undeclared ones dropped.
+    """
+    df = df.reindex(columns=list(dtypes))
+    for column, dtype in dtypes.items():
+        if pd.api.types.is_timedelta64_dtype(dtype):
+            df[column] = pd.to_timedelta(df[column]).astype(dtype)
+        else:
+            df[column] = df[column].astype(dtype)
+    return df
+
+
+def read_with_schema(path, dtypes):
+    """
+    Read one .csv or .parquet table with declared dtypes instead of inferred ones.
+    :param dtypes: Dict of column to dtype, e.g. WHOIS_RESULT_DTYPES
+    :return: DataFrame with exactly the declared columns
+    """
+    if path.endswith(".parquet"):
+        df = pd.read_parquet(path)
+    else:
+        # time deltas are parsed from their text by apply_schema
+        df = pd.read_csv(path, dtype={k: v for k, v in dtypes.items() if not pd.api.types.is_timedelta64_dtype(v)})
+    return apply_schema(df, dtypes)
+
+
+def convert_csv_histories():
+    """
+    Move the per-article CSVs of older runs, and the per-article Parquet
+    files of the first store layout, into the partitioned store.
+    """
+    if not USE_PARQUET:
+        print("pyarrow is not installed, histories stay as CSV.")
+        return
+
+    converted = 0
+    if os.path.exists(CSV_DIR):
+        files = [f for f in os.listdir(CSV_DIR) if f.lower().endswith(".csv")]
+        for i, file in enumerate(files):
+            df = pd.read_csv(os.path.join(CSV_DIR, file), dtype=HISTORY_DTYPES)
+            if df.empty:
+                continue
+            url = df["url"].iloc[0]
+            writer = HistoryWriter(history_path(url, file[:-len(".csv")]), url)
+            writer.write(df.to_dict("records"))
+            writer.commit()
+            converted += 1
+            # staged files are merged every so often, so they never pile up
+            if (i + 1) % 1000 == 0:
+                compact_histories()
+                print(f"Converted {i + 1}/{len(files)} histories")
+
+    # part=NN/<title>.parquet, one article each
+    if os.path.exists(STORE_DIR):
+        for folder in sorted(os.listdir(STORE_DIR)):
+            if not folder.startswith("part="):
+                continue
+            for file in os.listdir(os.path.join(STORE_DIR, folder)):
+                path = os.path.join(STORE_DIR, folder, file)
+                if not file.endswith(".parquet") or file == HISTORY_FILE:
+                    continue
+                table = pq.read_table(path)
+                if table.num_rows:
+                    url = table.column("url")[0].as_py()
+                    os.makedirs(os.path.dirname(staged_path(url, "replace")), exist_ok=True)
+                    os.replace(path, staged_path(url, "replace"))
+                    converted += 1
+                else:
+                    os.remove(path)
+
+    compact_histories()
+    print(f"Converted {converted} histories into {STORE_DIR}")
+
+
+# run directly to convert existing histories into the store
+if __name__ == "__main__":
+    convert_csv_histories()
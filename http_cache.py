@@ -0,0 +1,267 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+import metrics
+from rate_governor import governor_for, is_maxlag
+
+# set to False to always go to the network
+USE_HTTP_CACHE = True
+HTTP_CACHE_DIR = "http_cache"
+HTTP_CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+# headers kept with a cached body, enough to rebuild the response and revalidate it
+KEPT_HEADERS = ["Content-Type", "ETag", "Last-Modified", "Cache-Control"]
+
+
+def request_key(url, params=None):
+    # the full URL with its query string identifies a GET
+    prepared = requests.Request("GET", url, params=params).prepare()
+    return hashlib.sha256(prepared.url.encode("utf-8")).hexdigest(), prepared.url
+
+
+def max_age(headers):
+    # seconds the server says the response stays fresh, 0 if it says nothing or forbids caching
+    control = headers.get("Cache-Control", "").lower()
+    if "no-cache" in control or "no-store" in control:
+        return 0
+    match = re.search(r"max-age=(\d+)", control)
+    return int(match.group(1)) if match else 0
+
+
+def cacheable(response, fresh_for=0):
+    """
+    Tell if a response is worth storing: a real answer, not a throttled one
+    or an API error, which a retry may answer differently, and one that can
+    be used again, because it can be revalidated (ETag or Last-Modified) or
+    stays fresh for a while (max-age or the caller's fresh_for).
+    """
+    if response.status_code != 200 or "no-store" in response.headers.get("Cache-Control", "").lower():
+        return False
+    if response.content[:20].lstrip().startswith(b'{"error"') or is_maxlag(response):
+        return False
+    return ("ETag" in response.headers or "Last-Modified" in response.headers
+            or max_age(response.headers) > 0 or fresh_for > 0)
+
+
+class HttpCache:
+    """
+    On-disk cache of GET responses, shared across runs.
+    Bodies are compressed and stored once per content hash, so identical
+    answers to different requests take the space of one. An index in SQLite
+    maps every request URL to its body and validators (ETag, Last-Modified).
+    Stale entries are revalidated with a conditional request, a 304 answer
+    reuses the stored body. The least recently used entries are evicted
+    once the bodies take more than max_bytes.
+    """
+
+    def __init__(self, path=HTTP_CACHE_DIR, max_bytes=HTTP_CACHE_MAX_BYTES):
+        """
+        :param path: Folder of the index and the bodies, created if missing
+        :param max_bytes: Upper bound on the compressed size of the stored bodies, None for no bound
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(path, "bodies"), exist_ok=True)
+        # one connection shared by the download threads, every use is under the lock
+        self.conn = sqlite3.connect(os.path.join(path, "index.sqlite"), timeout=60, isolation_level=None,
+                                    check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, url TEXT NOT NULL, digest TEXT NOT NULL, headers TEXT NOT NULL, "
+            "encoding TEXT, fetched_at REAL NOT NULL, used_at REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_used_at ON responses (used_at)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_digest ON responses (digest)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS bodies (digest TEXT PRIMARY KEY, size INTEGER NOT NULL)")
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM bodies").fetchone()[0]
+
+    def body_path(self, digest):
+        # two levels of folders keep directories small
+        return os.path.join(self.path, "bodies", digest[:2], digest)
+
+    def lookup(self, key):
+        """
+        :return: Tuple of (headers, encoding, digest, fetched_at) or None
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT headers, encoding, digest, fetched_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1], row[2], row[3]
+
+    def read_body(self, digest):
+        try:
+            with open(self.body_path(digest), "rb") as f:
+                return zlib.decompress(f.read())
+        except (OSError, zlib.error):
+            # evicted by another process or cut short, the caller refetches
+            return None
+
+    def store(self, key, url, response):
+        """
+        Save a response body and its validators.
+        """
+        body = response.content
+        digest = hashlib.sha256(body).hexdigest()
+        headers = {name: response.headers[name] for name in KEPT_HEADERS if name in response.headers}
+        now = time.time()
+
+        path = self.body_path(digest)
+        with self.lock:
+            known = self.conn.execute("SELECT 1 FROM bodies WHERE digest = ?", (digest,)).fetchone()
+        if not known or not os.path.exists(path):
+            compressed = zlib.compress(body, 6)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # written aside and renamed, so a crash never leaves half a body behind
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(compressed)
+            os.replace(tmp_path, path)
+            with self.lock:
+                if not self.conn.execute("SELECT 1 FROM bodies WHERE digest = ?", (digest,)).fetchone():
+                    self.conn.execute("INSERT INTO bodies (digest, size) VALUES (?, ?)", (digest, len(compressed)))
+                    self.total_bytes += len(compressed)
+
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, url, digest, headers, encoding, fetched_at, used_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, url, digest, json.dumps(headers), response.encoding, now, now),
+            )
+        if self.max_bytes is not None and self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def touch(self, key, revalidated=False):
+        now = time.time()
+        with self.lock:
+            if revalidated:
+                self.conn.execute("UPDATE responses SET used_at = ?, fetched_at = ? WHERE key = ?", (now, now, key))
+            else:
+                self.conn.execute("UPDATE responses SET used_at = ? WHERE key = ?", (now, key))
+
+    def evict(self):
+        """
+        Drop the least recently used responses until the bodies fit in 90% of max_bytes,
+        then delete the bodies no response points to any more.
+        """
+        target = self.max_bytes * 0.9
+        with self.lock:
+            while self.total_bytes > target:
+                keys = [row[0] for row in self.conn.execute("SELECT key FROM responses ORDER BY used_at LIMIT 50")]
+                if not keys:
+                    break
+                self.conn.executemany("DELETE FROM responses WHERE key = ?", [(key,) for key in keys])
+                orphans = self.conn.execute(
+                    "SELECT digest, size FROM bodies WHERE digest NOT IN (SELECT digest FROM responses)"
+                ).fetchall()
+                for digest, size in orphans:
+                    self.conn.execute("DELETE FROM bodies WHERE digest = ?", (digest,))
+                    self.total_bytes -= size
+                    try:
+                        os.remove(self.body_path(digest))
+                    except OSError:
+                        pass
+                metrics.count("http_cache_evicted", len(keys))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def cached_response(url, headers, encoding, body):
+    # a requests.Response the callers can't tell from one off the network
+    response = requests.Response()
+    response.status_code = 200
+    response.url = url
+    response.headers = CaseInsensitiveDict(headers)
+    response.encoding = encoding
+    response._content = body
+    return response
+
+
+def cached_get(cache, session, url, params=None, headers=None, fresh_for=0):
+    """
+    GET through the cache and the rate governor of the host.
+    A cached response younger than fresh_for (or the max-age the server
+    sent) is returned without a request. An older one is revalidated with
+    If-None-Match / If-Modified-Since and reused if the server answers 304.
+    :param cache: HttpCache, None to go straight to the network
+    :param session: requests.Session, or None for a plain request
+    :param fresh_for: Seconds a cached response is used without asking the server
+    :return: requests.Response
+    """
+    if cache is None:
+        return governor_for(url).get(session, url, params=params, headers=headers)
+
+    key, full_url = request_key(url, params)
+    entry = cache.lookup(key)
+    if entry is not None:
+        stored_headers, encoding, digest, fetched_at = entry
+        body = cache.read_body(digest)
+        if body is None:
+            entry = None
+        elif time.time() - fetched_at < max(fresh_for, max_age(stored_headers)):
+            cache.touch(key)
+            metrics.count("http_cache_hits")
+            return cached_response(full_url, stored_headers, encoding, body)
+
+    conditional = dict(headers or {})
+    if entry is not None:
+        if "ETag" in stored_headers:
+            conditional["If-None-Match"] = stored_headers["ETag"]
+        if "Last-Modified" in stored_headers:
+            conditional["If-Modified-Since"] = stored_headers["Last-Modified"]
+
+    response = governor_for(url).get(session, url, params=params, headers=conditional)
+    if entry is not None and response.status_code == 304:
+        cache.touch(key, revalidated=True)
+        metrics.count("http_cache_revalidated")
+        metrics.count("http_cache_bytes_saved", len(body))
+        return cached_response(full_url, stored_headers, encoding, body)
+
+    metrics.count("http_cache_misses")
+    if cacheable(response, fresh_for):
+        try:
+            cache.store(key, full_url, response)
+        except (OSError, sqlite3.Error) as e:
+            print(f"Error caching {full_url}: {e}")
+    return response
+
+
+# one cache per process, opened on first use
+default_cache = None
+default_cache_lock = threading.Lock()
+
+
+def open_http_cache():
+    """
+    Get the process wide cache, None when USE_HTTP_CACHE is off.
+    """
+    global default_cache
+    if not USE_HTTP_CACHE:
+        return None
+    with default_cache_lock:
+        if default_cache is None:
+            default_cache = HttpCache()
+        return default_cache
+
+
+def http_get(session, url, params=None, headers=None, fresh_for=0):
+    """
+    GET through the process wide cache and the rate governor, see cached_get.
+    """
+    return cached_get(open_http_cache(), session, url, params, headers, fresh_for)
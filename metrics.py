@@ -0,0 +1,265 @@
+# counters, timers and progress shared by the pipeline scripts
+# every run appends JSON lines to metrics/pipeline.jsonl and keeps metrics/<stage>.prom up to date
+# in the Prometheus text format (e.g. for the node_exporter textfile collector)
+# set PIPELINE_PROFILE=1 to save a cProfile of each stage to metrics/<stage>.prof
+import cProfile
+import json
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+METRICS_DIR = os.environ.get("PIPELINE_METRICS_DIR", "metrics")
+LOG_FILE = "pipeline.jsonl"
+PROFILE = os.environ.get("PIPELINE_PROFILE", "") not in ("", "0")
+
+# seconds between progress lines and Prometheus file updates
+REPORT_INTERVAL = 10
+# seconds of progress the rolling throughput is computed over
+RATE_WINDOW = 60
+# functions listed in the text summary next to a profile
+PROFILE_TOP = 30
+
+
+def metric_name(name):
+    # Prometheus names only allow letters, digits and underscores
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return "?"
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds}s"
+
+
+class Metrics:
+    """
+    Thread-safe counters and timers of one script run. Counters are plain
+    totals (requests, bytes, rows), timers add up seconds and calls.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = Counter()
+        self.timers = {}
+        self.progress = {}
+        self.stage = os.path.splitext(os.path.basename(sys.argv[0]))[0] or "interactive"
+        self.started = time.time()
+        self.last_report = time.monotonic()
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            timer = self.timers.setdefault(name, [0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+
+    @contextmanager
+    def timer(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - started)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "counters": dict(self.counters),
+                "timers": {name: {"count": count, "seconds": seconds} for name, (count, seconds) in self.timers.items()},
+                "progress": {name: progress.state() for name, progress in self.progress.items()},
+            }
+
+    def log(self, event, **fields):
+        """
+        Append one JSON line to the metrics log.
+        """
+        line = {"time": datetime.now(timezone.utc).isoformat(), "stage": self.stage, "pid": os.getpid(), "event": event, **fields}
+        try:
+            os.makedirs(METRICS_DIR, exist_ok=True)
+            with self.lock, open(os.path.join(METRICS_DIR, LOG_FILE), "a", encoding="utf-8") as f:
+                f.write(json.dumps(line, default=str) + "\n")
+        except OSError as e:
+            print(f"Error writing metrics log: {e}")
+
+    def write_prometheus(self):
+        """
+        Rewrite metrics/<stage>.prom with the current values.
+        """
+        snapshot = self.snapshot()
+        label = f'{{stage="{self.stage}"}}'
+        lines = [f"pipeline_stage_seconds{label} {time.time() - self.started:.3f}"]
+        for name, value in sorted(snapshot["counters"].items()):
+            lines.append(f"# TYPE pipeline_{metric_name(name)}_total counter")
+            lines.append(f"pipeline_{metric_name(name)}_total{label} {value}")
+        for name, timer in sorted(snapshot["timers"].items()):
+            lines.append(f"pipeline_{metric_name(name)}_seconds_total{label} {timer['seconds']:.6f}")
+            lines.append(f"pipeline_{metric_name(name)}_calls_total{label} {timer['count']}")
+        for name, state in sorted(snapshot["progress"].items()):
+            lines.append(f"pipeline_{metric_name(name)}_done{label} {state['done']}")
+            if state["total"] is not None:
+                lines.append(f"pipeline_{metric_name(name)}_expected{label} {state['total']}")
+            lines.append(f"pipeline_{metric_name(name)}_per_second{label} {state['rate']:.3f}")
+
+        path = os.path.join(METRICS_DIR, f"{metric_name(self.stage)}.prom")
+        try:
+            os.makedirs(METRICS_DIR, exist_ok=True)
+            # written aside and renamed, so a scrape never sees half a file
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            print(f"Error writing Prometheus metrics: {e}")
+
+    def report_due(self):
+        # at most one report per REPORT_INTERVAL across all threads
+        now = time.monotonic()
+        with self.lock:
+            if now - self.last_report < REPORT_INTERVAL:
+                return False
+            self.last_report = now
+            return True
+
+
+class Progress:
+    """
+    Rolling throughput and ETA of one kind of work, e.g. articles downloaded.
+    A line is printed and logged every REPORT_INTERVAL seconds.
+    """
+
+    def __init__(self, metrics, name, total=None):
+        """
+        :param name: What is counted, also the counter name
+        :param total: Expected amount of work, None if unknown
+        """
+        self.metrics = metrics
+        self.name = name
+        self.total = total
+        self.done = 0
+        self.started = time.monotonic()
+        self.samples = deque([(self.started, 0)])
+        self.lock = threading.Lock()
+        with metrics.lock:
+            metrics.progress[name] = self
+
+    def rate(self):
+        # over the last RATE_WINDOW seconds, so it follows the current speed rather than the average
+        with self.lock:
+            (first_time, first_done), (last_time, last_done) = self.samples[0], self.samples[-1]
+        if last_time - first_time <= 0:
+            return 0.0
+        return (last_done - first_done) / (last_time - first_time)
+
+    def eta(self):
+        rate = self.rate()
+        if self.total is None or rate <= 0:
+            return None
+        return max(0, self.total - self.done) / rate
+
+    def state(self):
+        return {"done": self.done, "total": self.total, "rate": self.rate(), "eta_seconds": self.eta()}
+
+    def update(self, n=1):
+        self.metrics.count(self.name, n)
+        now = time.monotonic()
+        with self.lock:
+            self.done += n
+            self.samples.append((now, self.done))
+            while len(self.samples) > 2 and self.samples[0][0] < now - RATE_WINDOW:
+                self.samples.popleft()
+        if self.metrics.report_due():
+            self.report()
+
+    def report(self):
+        state = self.state()
+        total = f"/{self.total}" if self.total is not None else ""
+        print(f"{self.name}: {self.done}{total}, {state['rate']:.1f}/s, ETA {format_duration(state['eta_seconds'])}")
+        self.metrics.log("progress", name=self.name, **state)
+        self.metrics.write_prometheus()
+
+
+# one instance per process, like the whois client of stage 4b
+metrics = Metrics()
+
+
+def count(name, n=1):
+    metrics.count(name, n)
+
+
+def add_time(name, seconds):
+    metrics.add_time(name, seconds)
+
+
+def timer(name):
+    return metrics.timer(name)
+
+
+def log(event, **fields):
+    metrics.log(event, **fields)
+
+
+def progress(name, total=None):
+    return Progress(metrics, name, total)
+
+
+def record_response(response):
+    """
+    Count an HTTP response: requests, status codes, body bytes and time until the headers arrived.
+    """
+    metrics.count("http_requests")
+    metrics.count(f"http_status_{response.status_code}")
+    metrics.count("http_bytes", len(response.content))
+    metrics.add_time("http_request", response.elapsed.total_seconds())
+
+
+def save_profile(profiler, name):
+    path = os.path.join(METRICS_DIR, f"{metric_name(name)}.prof")
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    profiler.dump_stats(path)
+    # a readable summary next to it, the .prof opens in snakeviz or converts to a flame graph with flameprof
+    with open(path + ".txt", "w", encoding="utf-8") as f:
+        pstats.Stats(profiler, stream=f).sort_stats("cumulative").print_stats(PROFILE_TOP)
+    print(f"Profile saved to {path}")
+
+
+@contextmanager
+def stage(name):
+    """
+    Time a whole script run under a stage name. The start and end are
+    logged, the final counters are written to the Prometheus file and, with
+    PIPELINE_PROFILE set, the run is profiled. The previous name is restored
+    afterwards, for stages run inside run_pipeline.py.
+    """
+    previous = metrics.stage, metrics.started
+    metrics.stage = name
+    metrics.started = time.time()
+    metrics.log("stage_start", argv=sys.argv[1:])
+    profiler = cProfile.Profile() if PROFILE else None
+    if profiler is not None:
+        profiler.enable()
+    status = "failed"
+    try:
+        yield metrics
+        status = "finished"
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            save_profile(profiler, name)
+        seconds = time.time() - metrics.started
+        metrics.log("stage_end", status=status, seconds=seconds, **metrics.snapshot())
+        metrics.write_prometheus()
+        print(f"Stage {name} {status} in {format_duration(seconds)}")
+        metrics.stage, metrics.started = previous
@@ -0,0 +1,171 @@
+import email.utils
+import threading
+import time
+import urllib.parse
+
+import requests
+
+import metrics
+
+# requests per second a host starts at and the bounds the governor moves in,
+# the MediaWiki API etiquette asks for requests in series rather than in parallel,
+# so however well Wikipedia answers a host never gets more than a few per second
+START_RATE = 2.0
+MIN_RATE = 0.2
+MAX_RATE = 4.0
+
+# seconds of replication lag the API may have before it refuses our requests,
+# the value the MediaWiki API etiquette asks bots to send
+MAXLAG = 5
+
+
+def parse_retry_after(value):
+    """
+    Read a Retry-After header, either seconds or an HTTP date.
+    :return: Seconds to wait, None if missing or unreadable
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_maxlag(response):
+    # maxlag errors come back as HTTP 200 with an error object, only look when the body could be one
+    if response.status_code != 200 or b'"maxlag"' not in response.content[:500]:
+        return False
+    try:
+        return response.json().get("error", {}).get("code") == "maxlag"
+    except ValueError:
+        return False
+
+
+class RateGovernor:
+    """
+    Paces the requests to one host with a token bucket whose rate adapts
+    (AIMD). Until the server first pushes back the rate grows by half each
+    second (slow start), after that every healthy response raises it a
+    little, so it grows by about `increase` requests per second each
+    second. A 429, 503 or maxlag error cuts it by `decrease`, and when the
+    server sends Retry-After nothing is sent to the host until that time
+    has passed. Throttled requests and connection errors are retried.
+    """
+
+    def __init__(self, rate=START_RATE, min_rate=MIN_RATE, max_rate=MAX_RATE, increase=0.5, decrease=0.5,
+                 burst=1, retries=5, maxlag=MAXLAG):
+        """
+        :param rate: Requests per second to start at
+        :param min_rate: The rate never drops below this
+        :param max_rate: The rate never grows above this
+        :param increase: Requests per second added per second of healthy responses
+        :param decrease: Factor the rate is multiplied by when the server pushes back
+        :param burst: Requests that may go out back to back after an idle period
+        :param retries: Extra attempts for throttled requests and connection errors
+        :param maxlag: maxlag parameter added to API requests, None to leave it out
+        """
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.burst = burst
+        self.retries = retries
+        self.maxlag = maxlag
+        self.lock = threading.Lock()
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.last_decrease = 0
+        self.slow_start = True
+
+    def acquire(self):
+        # take a token, waiting for the bucket to refill and for any Retry-After pause
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                wait = self.paused_until - now
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def on_success(self):
+        with self.lock:
+            step = 0.5 if self.slow_start else self.increase / self.rate
+            self.rate = min(self.max_rate, self.rate + step)
+
+    def on_throttle(self, retry_after=None):
+        """
+        Slow down after the server pushed back.
+        :param retry_after: Seconds the server asked us to wait, None if it didn't say
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.slow_start = False
+            # requests already in flight come back throttled together, that is one decrease
+            if now - self.last_decrease > 1 / self.rate:
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+                self.last_decrease = now
+            # without Retry-After wait at least one request interval before trying again
+            pause = retry_after if retry_after is not None else 1 / self.rate
+            self.paused_until = max(self.paused_until, now + pause)
+            rate = self.rate
+        metrics.count("http_throttled")
+        metrics.log("rate_decrease", rate=rate, retry_after=retry_after)
+
+    def get(self, session, url, params=None, **kwargs):
+        """
+        GET through the governor, retrying throttled requests.
+        API requests (params with an "action") get the maxlag parameter.
+        :param session: requests.Session, or None for a plain request
+        :return: The response, the last throttled one if every attempt was throttled
+        :raises requests.RequestException: When the last attempt failed to connect
+        """
+        if params is not None and "action" in params and self.maxlag is not None:
+            params = {**params, "maxlag": self.maxlag}
+
+        for attempt in range(self.retries + 1):
+            if attempt:
+                metrics.count("http_retries")
+            self.acquire()
+            try:
+                response = (session or requests).get(url, params=params, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                self.on_throttle()
+                if attempt == self.retries:
+                    raise
+                continue
+            metrics.record_response(response)
+
+            if response.status_code in (429, 503) or is_maxlag(response):
+                self.on_throttle(parse_retry_after(response.headers.get("Retry-After")))
+                continue
+            self.on_success()
+            return response
+        return response
+
+
+# one governor per host, shared by every thread and stage in the process
+governors = {}
+governors_lock = threading.Lock()
+
+
+def governor_for(url):
+    """
+    Get the governor of the host a URL points to, creating it on first use.
+    """
+    host = urllib.parse.urlparse(url).netloc
+    with governors_lock:
+        if host not in governors:
+            governors[host] = RateGovernor()
+        return governors[host]
@@ -0,0 +1,292 @@
+# runs the numbered scripts in order, but only the stages whose inputs changed since the last run
+# usage: python run_pipeline.py [--hash] [--dry-run] [stage numbers to force...]
+#   --hash     compare inputs by content hash instead of size and modification time
+#   --dry-run  only print what would be rebuilt
+#   --profile  save a cProfile of every stage that runs to metrics/
+import hashlib
+import importlib
+import json
+import os
+import subprocess
+import sys
+import time
+
+import pandas as pd
+
+import history_store
+import metrics
+from history_store import list_history_files, read_table, write_table
+
+# fingerprints of the inputs every stage last ran with
+STATE_FILE = "pipeline_state.json"
+
+# stage 4 summary rows of every article, only the history files that changed are summarized again
+SUMMARY_BASE = "./summaries/wikipedia_summary_pipeline"
+
+# fewer changed histories than this are summarized in this process, starting worker processes costs more
+PARALLEL_MIN = 200
+
+def table_files(base):
+    # a table from write_table is either Parquet or CSV
+    return [base + ".parquet", base + ".csv"]
+
+def expand(paths):
+    """
+    List the files behind a list of files and directories.
+    :return: Sorted list of existing files, unfinished .part files are left out
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(os.path.join(root, name) for name in names if not name.endswith(".part"))
+        elif os.path.exists(path):
+            files.append(path)
+    return sorted(files)
+
+class Fingerprinter:
+    """
+    Fingerprints files by size and modification time, or by content hash.
+    Hashes are remembered with the size and time they were computed for, so a
+    file is only read again when it was touched, and a file rewritten with
+    the same content doesn't count as changed.
+    """
+
+    def __init__(self, known, use_hash=False):
+        """
+        :param known: Dict of path to [size, mtime_ns, sha1] from the last run, updated in place
+        :param use_hash: Compare content hashes instead of size and time
+        """
+        self.known = known
+        self.use_hash = use_hash
+
+    def __call__(self, path):
+        stat = os.stat(path)
+        if not self.use_hash:
+            return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+        entry = self.known.get(path)
+        if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            return entry[2]
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        self.known[path] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+        return digest.hexdigest()
+
+    def many(self, paths):
+        return {path: self(path) for path in expand(paths)}
+
+def git_head(repo):
+    # commit a git checkout is at, None when it is missing or not a git repository
+    if not os.path.isdir(repo):
+        return None
+    result = subprocess.run(["git", "rev-parse", "HEAD"], cwd=repo, capture_output=True, text=True)
+    return result.stdout.strip() if result.returncode == 0 else None
+
+class Stage:
+    """
+    One numbered script with the files it reads and writes.
+    The stage is rebuilt when the fingerprints of its inputs differ from the
+    last successful run or one of its outputs is missing.
+    """
+
+    def __init__(self, name, script, inputs, outputs, args=(), repos=(), always=False):
+        """
+        :param name: Stage number as a string
+        :param script: Script run in a separate python process
+        :param inputs: Files and directories the stage reads
+        :param outputs: Alternatives for each output, the output exists if any of them does
+        :param args: Command line arguments of the script
+        :param repos: Git checkouts the stage reads, fingerprinted by their HEAD commit
+        :param always: Run on every pipeline run, for stages that read data no file here records
+        """
+        self.name = name
+        self.script = script
+        self.inputs = inputs
+        self.outputs = outputs
+        self.args = list(args)
+        self.repos = list(repos)
+        self.always = always
+
+    def missing_outputs(self):
+        return [choices[0] for choices in self.outputs if not any(os.path.exists(path) for path in choices)]
+
+    def run(self, pipeline):
+        # scripts are next to this file, the data they read is relative to the working directory
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), self.script)
+        result = subprocess.run([sys.executable, script, *self.args])
+        return result.returncode == 0
+
+class SummaryStage(Stage):
+    """
+    Stage 4 split into one partition per history file, a CSV or a partition
+    file of the history store. Only files that are new or changed are
+    summarized, the summary rows of the others are kept from earlier runs.
+    Files that fail are not fingerprinted, so the next run tries them again.
+    """
+
+    def __init__(self, name, script, outputs):
+        super().__init__(name, script, [], outputs)
+
+    def run(self, pipeline):
+        # runs in this process, so it gets the metrics a script would set up for itself
+        with metrics.stage(self.name):
+            return self.summarize(pipeline)
+
+    def summarize(self, pipeline):
+        partitions = pipeline.state.setdefault("partitions", {})
+        current = {path: pipeline.fingerprint(path) for path in list_history_files()}
+        if self.name in pipeline.force:
+            changed = list(current)
+        else:
+            changed = [path for path in current if partitions.get(path, {}).get("fingerprint") != current[path]]
+        removed = [path for path in partitions if path not in current]
+        print(f"Stage {self.name}: {len(changed)} changed, {len(removed)} removed, "
+              f"{len(current) - len(changed)} unchanged history files")
+        if pipeline.dry_run or not (changed or removed):
+            return True
+
+        stage = importlib.import_module(os.path.splitext(self.script)[0])
+        summary = read_table(SUMMARY_BASE) if any(os.path.exists(p) for p in table_files(SUMMARY_BASE)) else stage.empty_summary()
+
+        # results of removed or changed histories are dropped before they are redone,
+        # stage 4b then only looks up the anonymous edits saved again
+        stale = {path: self.partition_urls(partitions[path]) for path in changed + removed if path in partitions}
+        summary = summary[~summary["url"].isin({url for urls in stale.values() for url in urls})]
+        for path, stale_urls in stale.items():
+            # a CSV is named after its file, the articles of a partition file after their urls
+            bases = [stage.anon_edits_base(path)] if path.endswith(".csv") else [stage.anon_edits_base(path, url) for url in stale_urls]
+            for base in bases:
+                name = os.path.basename(base)
+                for output in table_files(base) + table_files(os.path.join("whois_results", name)):
+                    if os.path.exists(output):
+                        os.remove(output)
+        for path in removed:
+            del partitions[path]
+
+        # the changed histories are summarized in batches like a stage 4 run, over all cores when there are many
+        urls = {}
+        workers = os.cpu_count() or 1
+        if workers > 1 and len(changed) >= PARALLEL_MIN:
+            rows = stage.summarize_parallel(changed, workers, urls)
+        else:
+            rows = stage.summarize_histories(changed, metrics.progress("histories", len(changed)), urls)
+
+        # rows of histories whose anonymous edits could not be saved are left out, they are redone with the rest
+        rows = rows[rows["url"].isin({url for path_urls in urls.values() for url in path_urls})]
+        failed = [path for path in changed if path not in urls]
+        for path in changed:
+            if path in urls:
+                partitions[path] = {"fingerprint": current[path], "urls": urls[path]}
+            else:
+                partitions.pop(path, None)
+        if failed:
+            metrics.count("histories_failed", len(failed))
+            print(f"Stage {self.name}: {len(failed)} history files failed and are retried on the next run, e.g. {failed[0]}")
+
+        self.save_summary(pd.concat([summary, rows], ignore_index=True), pipeline)
+        print(f"Stage {self.name}: {len(changed) - len(failed)}/{len(changed)} history files summarized")
+        return True
+
+    @staticmethod
+    def partition_urls(partition):
+        # state saved before histories were stored many to a file has a single "url"
+        if "urls" in partition:
+            return partition["urls"]
+        return [partition["url"]] if partition.get("url") else []
+
+    def save_summary(self, summary, pipeline):
+        # the summary and the partition fingerprints are saved together so they agree after a crash
+        os.makedirs(os.path.dirname(SUMMARY_BASE), exist_ok=True)
+        write_table(summary.sort_values("url", ignore_index=True), SUMMARY_BASE)
+        pipeline.save_state()
+
+class Pipeline:
+    """
+    Runs the stages in order, skipping the ones that are up to date.
+    """
+
+    def __init__(self, stages, use_hash=False, dry_run=False, force=()):
+        self.stages = stages
+        self.dry_run = dry_run
+        self.force = set(force)
+        self.state = {}
+        if os.path.exists(STATE_FILE):
+            with open(STATE_FILE, encoding='utf-8') as f:
+                self.state = json.load(f)
+        self.fingerprint = Fingerprinter(self.state.setdefault("hashes", {}), use_hash)
+
+    def save_state(self):
+        with open(STATE_FILE + ".tmp", 'w', encoding='utf-8') as f:
+            json.dump(self.state, f)
+        os.replace(STATE_FILE + ".tmp", STATE_FILE)
+
+    def run(self):
+        recorded = self.state.setdefault("stages", {})
+        for stage in self.stages:
+            inputs = self.fingerprint.many(stage.inputs)
+            inputs.update({f"git:{repo}": git_head(repo) for repo in stage.repos})
+            missing = stage.missing_outputs()
+            if isinstance(stage, SummaryStage):
+                # decides per history which partitions to redo
+                reason = "checking which histories changed"
+            elif stage.name in self.force:
+                reason = "forced"
+            elif stage.always:
+                reason = "runs every time"
+            elif missing:
+                reason = f"missing {', '.join(missing)}"
+            elif recorded.get(stage.name) != inputs:
+                reason = "inputs changed"
+            else:
+                print(f"Stage {stage.name} ({stage.script}) is up to date")
+                continue
+
+            print(f"Stage {stage.name} ({stage.script}): running, {reason}")
+            if isinstance(stage, SummaryStage) or not self.dry_run:
+                started = time.time()
+                ok = stage.run(self)
+                metrics.log("stage_run", name=stage.name, reason=reason, ok=ok, seconds=time.time() - started)
+                if not ok:
+                    print(f"Stage {stage.name} failed, stopping")
+                    return False
+            if not self.dry_run:
+                recorded[stage.name] = inputs
+                self.save_state()
+        return True
+
+def default_stages():
+    histories = history_store.STORE_DIR if history_store.USE_PARQUET else history_store.CSV_DIR
+    return [
+        Stage("1", "1_extract_arcticle_category.py", ["./articles/categories.csv"], [["./articles/category_articles.csv"]]),
+        Stage("2", "2_extract_articles.py", ["./articles/category_articles.csv"], [["./articles/articles.csv"]]),
+        # incremental sync: new articles are downloaded in full, the others only get new revisions,
+        # runs every time since articles get new revisions on Wikipedia without any file here changing
+        Stage("3", "3_download_article_history.py", ["./articles/articles.csv"], [[histories]], ["./articles/articles.csv", "new", "8"], always=True),
+        SummaryStage("4", "4_summany_whois.py", [table_files(SUMMARY_BASE)]),
+        # only looks up the articles whose anonymous edits were saved again
+        Stage("4b", "4b_whois_enrich.py", ["./anon_edits"], [["./whois_results"]]),
+        Stage("5", "5_csv_combine.py", ["./whois_results", "./summaries"], [table_files("./whois_results"), table_files("./summary")]),
+        # the country ip blocks checkout at repo_path in 6_country_ip_blocks_query.py, a new commit there
+        # changes the answers, its index is rebuilt from the commits so it needs no fingerprint of its own
+        Stage("6", "6_country_ip_blocks_query.py", table_files("./whois_results"), [table_files("./second")],
+              repos=["./mnt/country-ip-blocks"]),
+        Stage("7", "7_summary_stats.py", table_files("./summary"), []),
+        Stage("8", "8_second_stats.py", table_files("./second"), [["countries_by_count_file.png"]]),
+    ]
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if "--profile" in args:
+        # the scripts run as separate processes and read this when they import metrics
+        os.environ["PIPELINE_PROFILE"] = "1"
+        metrics.PROFILE = True
+    pipeline = Pipeline(
+        default_stages(),
+        use_hash="--hash" in args,
+        dry_run="--dry-run" in args,
+        force=[arg for arg in args if not arg.startswith("--")]
+    )
+    pipeline.run()
@@ -0,0 +1,164 @@
+# crawls the categories and downloads the article histories at the same time,
+# replaces running 1_extract_arcticle_category.py, 2_extract_articles.py and
+# 3_download_article_history.py one after the other
+import csv
+import importlib
+import os
+import queue
+import sys
+import threading
+
+import pandas as pd
+
+import metrics
+
+# the stage scripts start with a digit so they can't be imported by name
+category_stage = importlib.import_module("1_extract_arcticle_category")
+download_stage = importlib.import_module("3_download_article_history")
+
+# article URLs waiting for a download, the crawler waits once this many are queued
+QUEUE_SIZE = 1000
+
+class ArticleHandoff:
+    """
+    Passes article URLs from the crawler to the download workers.
+    URLs are deduplicated as they are found, which is what stage 2 does after
+    the crawl, and appended to the articles csv. The queue is bounded so a
+    crawl that is ahead of the downloads waits instead of buffering the
+    whole category tree.
+    """
+
+    def __init__(self, articles_file, skip=(), queue_size=QUEUE_SIZE):
+        """
+        :param articles_file: CSV the deduplicated article URLs are appended to
+        :param skip: URLs that are recorded but not downloaded, e.g. finished before a restart
+        :param queue_size: Maximum number of URLs waiting for a download
+        """
+        self.articles_file = articles_file
+        self.skip = set(skip)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.seen = set()
+        self.urls = []
+
+    def put(self, rows):
+        """
+        Queue the article URLs of crawled rows not seen before.
+        Blocks while the queue is full.
+        :param rows: Rows of (title, url, category_url, category_name) from the crawler
+        """
+        new_urls = []
+        with self.lock:
+            for row in rows:
+                url = row[1]
+                if url not in self.seen:
+                    self.seen.add(url)
+                    new_urls.append(url)
+            self.urls.extend(new_urls)
+
+            with open(self.articles_file, 'a', newline='', encoding='utf-8') as f:
+                writer = csv.writer(f)
+                for url in new_urls:
+                    writer.writerow([url])
+
+        for url in new_urls:
+            if url not in self.skip:
+                self.queue.put(url)
+
+    def close(self, workers):
+        # one stop marker per download worker
+        for _ in range(workers):
+            self.queue.put(None)
+
+def download_worker(handoff, limit, session, incremental, manifest, finished, progress=None):
+    # take URLs off the queue until the stop marker
+    while True:
+        url = handoff.queue.get()
+        if url is None:
+            break
+        finished.append(download_stage.process_article(url, limit, session, incremental, manifest, progress))
+        print(f"Downloaded {len(finished)} articles, {handoff.queue.qsize()} queued")
+
+def stream_categories_to_histories(crawl_workers=4, depth=0, download_workers=8, limit=250, incremental=False):
+    """
+    Crawl the categories of categories.csv and download the history of every
+    article as soon as it is found.
+    category_articles.csv, articles.csv, the manifest and
+    article_processing_results.csv are written the same as by stages 1 to 3,
+    an interrupted run with the same arguments resumes from the manifest like stage 3 does.
+    :param crawl_workers: Number of categories crawled concurrently
+    :param depth: Levels of subcategories to descend into
+    :param download_workers: Number of articles downloaded concurrently
+    :param limit: Maximum number of revisions per article, None for the full history
+    :param incremental: Only fetch revisions newer than the saved histories
+    """
+    input_file = "./articles/categories.csv"
+    category_file = "./articles/category_articles.csv"
+    articles_file = "./articles/articles.csv"
+
+    # Check if input file exists
+    if not os.path.exists(input_file):
+        print(f"Input file {input_file} not found.")
+        return
+
+    try:
+        df = pd.read_csv(input_file)
+        if 'url' not in df.columns:
+            print("CSV file must have a 'url' column.")
+            return
+        category_urls = df['url'].tolist()
+
+        # Create CSV files with headers
+        with open(category_file, 'w', newline='', encoding='utf-8') as f:
+            csv.writer(f).writerow(['article_title', 'article_url', 'category_url', 'category_name'])
+        with open(articles_file, 'w', newline='', encoding='utf-8') as f:
+            csv.writer(f).writerow(['article_url'])
+
+        # resume from the manifest of an interrupted run with the same input and arguments
+        run = {'input': os.path.abspath(input_file), 'depth': depth, 'limit': limit, 'incremental': incremental}
+        done = {url: entry for url, entry in download_stage.load_manifest(run).items() if entry['status'] == 'Success'}
+        if done:
+            print(f"Resuming: {len(done)} articles already done.")
+
+        download_stage.merge_staged_histories()
+        handoff = ArticleHandoff(articles_file, done)
+        crawler = category_stage.CategoryCrawler(category_file, crawl_workers, depth, handoff.put)
+        session = download_stage.create_session(download_workers)
+        finished = []
+        # the number of articles is only known once the crawl is done
+        progress = metrics.progress("articles")
+
+        with download_stage.open_manifest(run) as manifest:
+            threads = [
+                threading.Thread(target=download_worker, args=(handoff, limit, session, incremental, manifest, finished, progress))
+                for _ in range(download_workers)
+            ]
+            for thread in threads:
+                thread.start()
+
+            try:
+                total = crawler.crawl(category_urls)
+                print(f"Crawl finished with {total} articles, waiting for the downloads")
+            finally:
+                # let the workers finish what is queued, also when the crawl failed
+                handoff.close(download_workers)
+                for thread in threads:
+                    thread.join()
+
+        download_stage.merge_staged_histories()
+        download_stage.save_results(handoff.urls, finished, done)
+
+    except Exception as e:
+        print(f"Error streaming categories to histories: {e}")
+
+if __name__ == "__main__":
+    # optional arguments: categories crawled at once, subcategory depth,
+    # revision limit ("all" or "new" like stage 3) and concurrent downloads
+    crawl_workers = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    depth = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    limit = sys.argv[3] if len(sys.argv) > 3 else "250"
+    incremental = limit == "new"
+    limit = None if limit in ("all", "new") else int(limit)
+    download_workers = int(sys.argv[4]) if len(sys.argv) > 4 else 8
+    with metrics.stage("1-3"):
+        stream_categories_to_histories(crawl_workers, depth, download_workers, limit, incremental)
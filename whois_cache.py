@@ -0,0 +1,275 @@
+import bisect
+import ipaddress
+import os
+import sqlite3
+import time
+
+
+def parse_inet(inet):
+    """
+    Parse the inet field of a whois answer into address ranges.
+    Handles "a - b" ranges (inetnum/netrange) and comma separated CIDR lists.
+    :param inet: Value picked by parse_whois, e.g. "1.2.3.0 - 1.2.3.255"
+    :return: List of (version, start, end), unparseable parts are skipped
+    """
+    ranges = []
+    if not inet:
+        return ranges
+    for part in inet.split(","):
+        part = part.strip()
+        try:
+            if "/" in part:
+                network = ipaddress.ip_network(part, strict=False)
+                ranges.append((network.version, int(network.network_address), int(network.broadcast_address)))
+            elif "-" in part:
+                first, last = part.split("-", 1)
+                first = ipaddress.ip_address(first.strip())
+                last = ipaddress.ip_address(last.strip())
+                if first.version == last.version and first <= last:
+                    ranges.append((first.version, int(first), int(last)))
+        except ValueError:
+            # e.g. LACNIC abbreviates blocks as "200.1/16"
+            continue
+    return ranges
+
+
+class RangeMap:
+    """
+    Disjoint, sorted address segments each owned by the most specific range
+    inserted over it, so a lookup is a single bisect.
+    """
+
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+        self.sizes = []
+        self.values = []
+
+    def __len__(self):
+        return len(self.starts)
+
+    def insert(self, start, end, value):
+        size = end - start
+        i = bisect.bisect_right(self.starts, start) - 1
+        if i < 0 or self.ends[i] < start:
+            i += 1
+
+        # rebuild the overlapped segments, smaller ranges keep their part
+        pieces = []
+        cursor = start
+        j = i
+        while j < len(self.starts) and self.starts[j] <= end:
+            seg_start, seg_end = self.starts[j], self.ends[j]
+            seg_size, seg_value = self.sizes[j], self.values[j]
+            if seg_start < start:
+                pieces.append((seg_start, start - 1, seg_size, seg_value))
+            if cursor < seg_start:
+                pieces.append((cursor, seg_start - 1, size, value))
+
+            overlap_start, overlap_end = max(seg_start, start), min(seg_end, end)
+            if seg_size <= size:
+                pieces.append((overlap_start, overlap_end, seg_size, seg_value))
+            else:
+                pieces.append((overlap_start, overlap_end, size, value))
+            cursor = overlap_end + 1
+
+            if seg_end > end:
+                pieces.append((end + 1, seg_end, seg_size, seg_value))
+            j += 1
+        if cursor <= end:
+            pieces.append((cursor, end, size, value))
+
+        self.starts[i:j] = [p[0] for p in pieces]
+        self.ends[i:j] = [p[1] for p in pieces]
+        self.sizes[i:j] = [p[2] for p in pieces]
+        self.values[i:j] = [p[3] for p in pieces]
+
+    def get(self, value):
+        i = bisect.bisect_right(self.starts, value) - 1
+        if i >= 0 and value <= self.ends[i]:
+            return self.values[i]
+        return None
+
+
+class WhoisCache:
+    """
+    On-disk whois cache keyed by IP, shared across runs and shard processes.
+    Stores the parsed (country, org, inet) with the time it was fetched.
+    Entries older than ttl are refetched and the least recently used entries
+    are evicted once the cache holds more than max_entries.
+
+    The inetnum/cidr/netrange/inet6num block of every answer is recorded too,
+    so any other IP inside a known block is answered without a query.
+    """
+
+    # blocks of this many addresses or more (a /8 or a /16 of IPv6) are registry level
+    # (e.g. IANA-BLK) and say nothing about the IP
+    max_range_size = {4: 2 ** 24, 6: 2 ** 112}
+
+    def too_big(self, version, start, end):
+        # end is inclusive, a whole /8 is 2**24 addresses
+        return end - start + 1 >= self.max_range_size[version]
+
+    def __init__(self, path="whois_cache.sqlite", ttl=90 * 24 * 3600, max_entries=2_000_000, use_ranges=True):
+        """
+        :param path: SQLite file, created if missing
+        :param ttl: Seconds before an entry is considered stale, None to keep forever
+        :param max_entries: Upper bound on cached IPs, None for no bound
+        :param use_ranges: Answer IPs from previously seen whois blocks
+        """
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.use_ranges = use_ranges
+        self.hits = 0
+        self.range_hits = 0
+        self.misses = 0
+        self.puts = 0
+        self.ranges = {4: RangeMap(), 6: RangeMap()}
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # WAL lets the shard processes read while one of them writes,
+        # the busy timeout makes concurrent writers wait instead of failing
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS whois ("
+            "ip TEXT PRIMARY KEY, country TEXT, org TEXT, inet TEXT, "
+            "fetched_at REAL NOT NULL, used_at REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS whois_used_at ON whois (used_at)")
+        # 128-bit addresses do not fit SQLite integers, they are kept as fixed width hex
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS whois_ranges ("
+            "version INTEGER NOT NULL, start TEXT NOT NULL, end TEXT NOT NULL, "
+            "country TEXT, org TEXT, inet TEXT, fetched_at REAL NOT NULL, "
+            "PRIMARY KEY (version, start, end))"
+        )
+        if use_ranges:
+            self.load_ranges()
+
+    def load_ranges(self):
+        oldest = 0 if self.ttl is None else time.time() - self.ttl
+        rows = self.conn.execute(
+            "SELECT version, start, end, country, org, inet FROM whois_ranges "
+            "WHERE fetched_at >= ? ORDER BY fetched_at",
+            (oldest,),
+        )
+        for version, start, end, country, org, inet in rows:
+            start, end = int(start, 16), int(end, 16)
+            # stored before the size check counted the end address
+            if self.too_big(version, start, end):
+                continue
+            self.ranges[version].insert(start, end, [country, org, inet])
+
+    def get(self, ip):
+        """
+        Look up a cached whois result.
+        :param ip: IP address string
+        :return: [country, org, inet] or None if missing or expired
+        """
+        row = self.conn.execute(
+            "SELECT country, org, inet, fetched_at FROM whois WHERE ip = ?", (ip,)
+        ).fetchone()
+        now = time.time()
+        if row is None or (self.ttl is not None and now - row[3] > self.ttl):
+            cached = self.get_range(ip)
+            if cached is not None:
+                self.range_hits += 1
+                return cached
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.conn.execute("UPDATE whois SET used_at = ? WHERE ip = ?", (now, ip))
+        return [row[0], row[1], row[2]]
+
+    def get_range(self, ip):
+        """
+        Answer an IP from a recorded whois block that contains it.
+        :return: [country, org, inet] or None
+        """
+        if not self.use_ranges:
+            return None
+        try:
+            target_ip = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        return self.ranges[target_ip.version].get(int(target_ip))
+
+    def get_again(self, ip):
+        """
+        Look up an IP that just missed in the blocks recorded since, its
+        miss is then counted as a block hit instead.
+        :return: [country, org, inet] or None
+        """
+        cached = self.get_range(ip)
+        if cached is not None:
+            self.misses -= 1
+            self.range_hits += 1
+        return cached
+
+    def put(self, ip, country, org, inet):
+        now = time.time()
+        self.conn.execute(
+            "INSERT OR REPLACE INTO whois (ip, country, org, inet, fetched_at, used_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (ip, country, org, inet, now, now),
+        )
+        if self.use_ranges:
+            self.put_ranges(ip, country, org, inet, now)
+        self.puts += 1
+        if self.puts % 1000 == 0:
+            self.evict()
+
+    def put_ranges(self, ip, country, org, inet, now):
+        try:
+            target_ip = ipaddress.ip_address(ip)
+        except ValueError:
+            return
+        for version, start, end in parse_inet(inet):
+            # only trust blocks that actually contain the IP that was asked about
+            if version != target_ip.version or not start <= int(target_ip) <= end:
+                continue
+            if self.too_big(version, start, end):
+                continue
+            self.ranges[version].insert(start, end, [country, org, inet])
+            self.conn.execute(
+                "INSERT OR REPLACE INTO whois_ranges (version, start, end, country, org, inet, fetched_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (version, f"{start:032x}", f"{end:032x}", country, org, inet, now),
+            )
+
+    def summary(self):
+        """
+        Share of lookups answered by exact entries, by recorded blocks and by real queries.
+        """
+        total = self.hits + self.range_hits + self.misses
+        if total == 0:
+            return "Whois lookups: 0"
+        return (
+            f"Whois lookups: {total}, exact cache {self.hits / total:.1%}, "
+            f"ranges {self.range_hits / total:.1%}, queried {self.misses / total:.1%}"
+        )
+
+    def evict(self):
+        """
+        Drop the least recently used entries above max_entries.
+        """
+        if self.max_entries is None:
+            return
+        count = self.conn.execute("SELECT COUNT(*) FROM whois").fetchone()[0]
+        if count > self.max_entries:
+            self.conn.execute(
+                "DELETE FROM whois WHERE ip IN "
+                "(SELECT ip FROM whois ORDER BY used_at LIMIT ?)",
+                (count - self.max_entries,),
+            )
+        if self.ttl is not None:
+            self.conn.execute("DELETE FROM whois_ranges WHERE fetched_at < ?", (time.time() - self.ttl,))
+
+    def close(self):
+        self.evict()
+        self.conn.close()
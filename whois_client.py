@@ -0,0 +1,151 @@
+import ipaddress
+import socket
+
+IANA_SERVER = "whois.iana.org"
+
+# servers that need a query prefix to answer with network records
+QUERY_FORMATS = {
+    "whois.arin.net": "n + {ip}",
+}
+
+
+# parse whois output into country, org and inet
+def parse_whois(output):
+    # Parse output into a dictionary
+    whois_data = {}
+    for line in output.splitlines():
+        if ":" in line:
+            key, value = line.split(":", 1)
+            key = str.lower(key.strip())
+
+            if not (key in whois_data):
+                whois_data[key] = value.strip()
+
+    country = None
+    if "country" in whois_data:
+        country = whois_data["country"]
+
+    org = None
+    if "org" in whois_data:
+        org = whois_data["org"]
+    elif "orgid" in whois_data:
+        org = whois_data["orgid"]
+    elif "netname" in whois_data:
+        org = whois_data["netname"]
+    elif "ownerid" in whois_data:
+        org = whois_data["ownerid"]
+
+    inet = None
+    if "inetnum" in whois_data:
+        inet = whois_data["inetnum"]
+    elif "cidr" in whois_data:
+        inet = whois_data["cidr"]
+    elif "netrange" in whois_data:
+        inet = whois_data["netrange"]
+    elif "inet6num" in whois_data:
+        inet = whois_data["inet6num"]
+
+    return [country, org, inet]
+
+
+def split_server(server, default_port=43):
+    """
+    Split "host", "host:port" or "whois://host:port" into (host, port).
+    :return: Tuple of (host, port) or None for other schemes such as rwhois://
+    """
+    if "://" in server:
+        scheme, server = server.split("://", 1)
+        if scheme.lower() != "whois":
+            return None
+    server = server.strip().rstrip("/")
+    if server.count(":") == 1:
+        host, port = server.split(":")
+        return host, int(port)
+    return server, default_port
+
+
+def find_referral(output):
+    # the server an answer points to, IANA uses "refer:", ARIN "ReferralServer:"
+    for line in output.splitlines():
+        if ":" in line:
+            key, value = line.split(":", 1)
+            if key.strip().lower() in ("refer", "referralserver"):
+                return value.strip()
+    return None
+
+
+class WhoisClient:
+    """
+    Minimal port 43 whois client. An IP is first sent to the IANA server to
+    find its registry (remembered per /8 or IPv6 /16), then referrals are
+    followed until a server answers without one.
+    """
+
+    def __init__(self, root_server=IANA_SERVER, port=43, timeout=10, max_referrals=3):
+        """
+        :param root_server: Server asked first, "host" or "host:port"
+        :param port: Port used when a server has none
+        :param timeout: Socket timeout in seconds for each query
+        :param max_referrals: Referrals followed before giving up on more specific answers
+        """
+        self.root = split_server(root_server, port)
+        self.port = port
+        self.timeout = timeout
+        self.max_referrals = max_referrals
+        self.registry_servers = {}
+
+    def send(self, server, text, timeout=None):
+        """
+        Send one query and read the answer until the server closes the connection.
+        :param server: Tuple of (host, port)
+        :param text: Query text without the line ending
+        :return: Answer text
+        """
+        chunks = []
+        with socket.create_connection(server, timeout=timeout or self.timeout) as sock:
+            sock.sendall(text.encode() + b"\r\n")
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        return b"".join(chunks).decode("utf-8", errors="replace")
+
+    def format_query(self, server, ip):
+        return QUERY_FORMATS.get(server[0], "{ip}").format(ip=ip)
+
+    def query(self, ip, timeout=None):
+        """
+        Look up an IP and return the most specific whois answer.
+        :param ip: IP address string
+        :param timeout: Overrides the client timeout for this lookup
+        :return: Raw answer text, same shape as the whois command's output
+        """
+        target_ip = ipaddress.ip_address(ip)
+        shift = 24 if target_ip.version == 4 else 112
+        prefix = (target_ip.version, int(target_ip) >> shift)
+
+        server = self.registry_servers.get(prefix)
+        output = None
+        if server is None:
+            root_output = self.send(self.root, self.format_query(self.root, ip), timeout)
+            referral = find_referral(root_output)
+            server = split_server(referral, self.port) if referral else None
+            if server is None:
+                # the root answered itself, its answer is used instead of asking it again
+                server = self.root
+                output = root_output
+            self.registry_servers[prefix] = server
+
+        if output is None:
+            output = self.send(server, self.format_query(server, ip), timeout)
+        for _ in range(self.max_referrals):
+            referral = find_referral(output)
+            next_server = split_server(referral, self.port) if referral else None
+            if next_server is None or next_server == server:
+                break
+            answer = self.send(next_server, self.format_query(next_server, ip), timeout)
+            if not answer.strip():
+                break
+            server, output = next_server, answer
+        return output
@@ -0,0 +1,173 @@
+import contextlib
+import ipaddress
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# markers used to tell which registry answered a query
+REGISTRY_MARKERS = [
+    ("afrinic", "afrinic"),
+    ("lacnic", "lacnic"),
+    ("apnic", "apnic"),
+    ("arin", "whois.arin.net"),
+    ("arin", "arin whois"),
+    ("ripe", "ripe"),
+]
+
+# answers that mean we are being throttled rather than a real result
+THROTTLE_MARKERS = ["limit exceeded", "access denied", "too many", "rate limit"]
+
+
+def detect_registry(output):
+    """
+    Guess which regional registry produced a whois answer.
+    :param output: Raw whois text
+    :return: Registry name or "unknown"
+    """
+    head = output[:2000].lower()
+    for registry, marker in REGISTRY_MARKERS:
+        if marker in head:
+            return registry
+    return "unknown"
+
+
+def throttled(output):
+    # empty answers and answers saying we are throttled are retried and never cached
+    lowered = output.lower()
+    return not output.strip() or any(marker in lowered for marker in THROTTLE_MARKERS)
+
+
+def query_with_retries(query, ip, timeout=10, retries=2, backoff=2.0, limiter=None):
+    """
+    Run a whois query, retrying errors, timeouts and throttled or empty
+    answers with exponential backoff.
+    :param query: Function (ip, timeout) returning the raw whois text
+    :param retries: Extra attempts after the first
+    :param backoff: Seconds to wait before the first retry, doubled each time
+    :param limiter: Function returning the limiter to hold during each attempt
+    :return: Raw whois text, or None when every attempt failed
+    """
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(backoff * 2 ** (attempt - 1))
+
+        with limiter() if limiter else contextlib.nullcontext():
+            try:
+                output = query(ip, timeout)
+            except Exception as e:
+                print(f"Error running whois: {e} {ip}")
+                continue
+
+        if throttled(output):
+            print(f"Whois throttled or empty for {ip}, attempt {attempt + 1}")
+            continue
+        return output
+    return None
+
+
+def ip_prefix(ip):
+    # the /8 (IPv4) or /16 (IPv6) an IP is in, registries allocate along these lines
+    try:
+        target_ip = ipaddress.ip_address(ip)
+    except ValueError:
+        return None
+    if target_ip.version == 4:
+        return (4, int(target_ip) >> 24)
+    return (6, int(target_ip) >> 112)
+
+
+def ip_block(ip):
+    # the /16 (IPv4) or /32 (IPv6) an IP is in, IPs of one block often share a whois answer
+    try:
+        target_ip = ipaddress.ip_address(ip)
+    except ValueError:
+        return ip
+    if target_ip.version == 4:
+        return (4, int(target_ip) >> 16)
+    return (6, int(target_ip) >> 96)
+
+
+class RegistryLimiter:
+    """
+    Caps the in-flight queries and the request rate of one registry.
+    """
+
+    def __init__(self, concurrency, rate):
+        self.semaphore = threading.Semaphore(concurrency)
+        self.interval = 1 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_time = 0
+
+    def __enter__(self):
+        self.semaphore.acquire()
+        with self.lock:
+            now = time.monotonic()
+            wait = max(0, self.next_time - now)
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait:
+            time.sleep(wait)
+        return self
+
+    def __exit__(self, *args):
+        self.semaphore.release()
+
+
+class WhoisPool:
+    """
+    Resolves many IPs concurrently with a bounded thread pool.
+    Each registry gets its own concurrency and rate cap. The registry of an IP
+    is learned from earlier answers in the same /8 (or IPv6 /16), IPs from
+    unseen prefixes share the "unknown" limiter. Timeouts and throttled answers
+    are retried with exponential backoff.
+    """
+
+    def __init__(self, query, workers=16, per_registry=4, rate=2.0, timeout=10, retries=2, backoff=2.0):
+        """
+        :param query: Function (ip, timeout) returning the raw whois text
+        :param workers: Total number of queries in flight
+        :param per_registry: Queries in flight per registry
+        :param rate: Queries per second per registry
+        :param timeout: Seconds before a single query is abandoned
+        :param retries: Extra attempts after a timeout or throttled answer
+        :param backoff: Seconds to wait before the first retry, doubled each time
+        """
+        self.query = query
+        self.workers = workers
+        self.per_registry = per_registry
+        self.rate = rate
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.limiters = {}
+        self.prefix_registry = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def limiter(self, registry):
+        with self.lock:
+            if registry not in self.limiters:
+                self.limiters[registry] = RegistryLimiter(self.per_registry, self.rate)
+            return self.limiters[registry]
+
+    def resolve_one(self, ip):
+        prefix = ip_prefix(ip)
+        # the registry is looked up again on every attempt, another answer may have taught it meanwhile
+        output = query_with_retries(self.query, ip, self.timeout, self.retries, self.backoff,
+                                    lambda: self.limiter(self.prefix_registry.get(prefix, "unknown")))
+        if output is not None:
+            with self.lock:
+                self.prefix_registry[prefix] = detect_registry(output)
+        return output
+
+    def resolve(self, ips):
+        """
+        Query all IPs concurrently.
+        :param ips: Iterable of IP address strings
+        :return: Dict of ip to raw whois text, None where every attempt failed
+        """
+        ips = list(dict.fromkeys(ips))
+        outputs = self.executor.map(self.resolve_one, ips)
+        return dict(zip(ips, outputs))
+
+    def close(self):
+        self.executor.shutdown()